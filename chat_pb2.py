@@ -13,7 +13,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\x12\nhelloworld\"t\n\x0eMessageRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nauth_token\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t\x12\x1a\n\x12recipient_username\x18\x04 \x01(\t\x12\x0f\n\x07message\x18\x05 \x01(\t\"3\n\x0cMessageReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\"G\n\x0eRefreshRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nauth_token\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t\"D\n\x0cRefreshReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x12\n\nerror_code\x18\x03 \x01(\t\"C\n\x0cLoginRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x10\n\x08username\x18\x02 \x01(\t\x12\x10\n\x08password\x18\x03 \x01(\t\"W\n\nLoginReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\x12\x12\n\nauth_token\x18\x03 \x01(\t\x12\x10\n\x08\x66ullname\x18\x04 \x01(\t\"]\n\x14\x41\x63\x63ountCreateRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x10\n\x08username\x18\x02 \x01(\t\x12\x10\n\x08password\x18\x03 \x01(\t\x12\x10\n\x08\x66ullname\x18\x04 \x01(\t\"_\n\x12\x41\x63\x63ountCreateReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\x12\x12\n\nauth_token\x18\x03 \x01(\t\x12\x10\n\x08\x66ullname\x18\x04 \x01(\t\"v\n\x12ListAccountRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nauth_token\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t\x12\x1a\n\x12number_of_accounts\x18\x04 \x01(\x05\x12\r\n\x05regex\x18\x05 \x01(\t\"N\n\x10ListAccountReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\x12\x15\n\raccount_names\x18\x03 \x01(\t\"M\n\x14\x44\x65leteAccountRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nauth_token\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t\"9\n\x12\x44\x65leteAccountReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t2\xd7\x03\n\nChatServer\x12\x45\n\x0bSendMessage\x12\x1a.helloworld.MessageRequest\x1a\x18.helloworld.MessageReply\"\x00\x12K\n\x0f\x44\x65liverMessages\x12\x1a.helloworld.RefreshRequest\x1a\x18.helloworld.RefreshReply\"\x00\x30\x01\x12;\n\x05Login\x12\x18.helloworld.LoginRequest\x1a\x16.helloworld.LoginReply\"\x00\x12S\n\rCreateAccount\x12 .helloworld.AccountCreateRequest\x1a\x1e.helloworld.AccountCreateReply\"\x00\x12N\n\x0cListAccounts\x12\x1e.helloworld.ListAccountRequest\x1a\x1c.helloworld.ListAccountReply\"\x00\x12S\n\rDeleteAccount\x12 .helloworld.DeleteAccountRequest\x1a\x1e.helloworld.DeleteAccountReply\"\x00\x42\x36\n\x1aio.grpc.modules.chatserverB\x0f\x43hatServerProtoP\x01\xa2\x02\x04\x43HSRb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\x12\nhelloworld\"t\n\x0eMessageRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nauth_token\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t\x12\x1a\n\x12recipient_username\x18\x04 \x01(\t\x12\x0f\n\x07message\x18\x05 \x01(\t\",\n\x0bPrimaryHint\x12\x0f\n\x07\x61\x64\x64ress\x18\x01 \x01(\t\x12\x0c\n\x04term\x18\x02 \x01(\x03\"]\n\x0cMessageReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\x12(\n\x07primary\x18\x03 \x01(\x0b\x32\x17.helloworld.PrimaryHint\"G\n\x0eRefreshRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nauth_token\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t\"n\n\x0cRefreshReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x12\n\nerror_code\x18\x03 \x01(\t\x12(\n\x07primary\x18\x04 \x01(\x0b\x32\x17.helloworld.PrimaryHint\"C\n\x0cLoginRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x10\n\x08username\x18\x02 \x01(\t\x12\x10\n\x08password\x18\x03 \x01(\t\"\x81\x01\n\nLoginReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\x12\x12\n\nauth_token\x18\x03 \x01(\t\x12\x10\n\x08\x66ullname\x18\x04 \x01(\t\x12(\n\x07primary\x18\x05 \x01(\x0b\x32\x17.helloworld.PrimaryHint\"]\n\x14\x41\x63\x63ountCreateRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x10\n\x08username\x18\x02 \x01(\t\x12\x10\n\x08password\x18\x03 \x01(\t\x12\x10\n\x08\x66ullname\x18\x04 \x01(\t\"\x89\x01\n\x12\x41\x63\x63ountCreateReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\x12\x12\n\nauth_token\x18\x03 \x01(\t\x12\x10\n\x08\x66ullname\x18\x04 \x01(\t\x12(\n\x07primary\x18\x05 \x01(\x0b\x32\x17.helloworld.PrimaryHint\"v\n\x12ListAccountRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nauth_token\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t\x12\x1a\n\x12number_of_accounts\x18\x04 \x01(\x05\x12\r\n\x05regex\x18\x05 \x01(\t\"x\n\x10ListAccountReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\x12\x15\n\raccount_names\x18\x03 \x01(\t\x12(\n\x07primary\x18\x04 \x01(\x0b\x32\x17.helloworld.PrimaryHint\"M\n\x14\x44\x65leteAccountRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nauth_token\x18\x02 \x01(\t\x12\x10\n\x08username\x18\x03 \x01(\t\"c\n\x12\x44\x65leteAccountReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\x12(\n\x07primary\x18\x03 \x01(\x0b\x32\x17.helloworld.PrimaryHint\"Q\n\x0bVoteRequest\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x0c\n\x04port\x18\x02 \x01(\t\x12\x11\n\tdata_term\x18\x03 \x01(\x03\x12\x13\n\x0b\x61pplied_seq\x18\x04 \x01(\x03\"3\n\x04Vote\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x0c\n\x04port\x18\x02 \x01(\t\x12\x0f\n\x07granted\x18\x03 \x01(\x08\"\xf3\x01\n\x12ServerStatusUpdate\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x0c\n\x04port\x18\x02 \x01(\t\x12\x10\n\x08position\x18\x03 \x01(\t\x12\x0f\n\x07wal_seq\x18\x04 \x01(\x03\x12\x1a\n\x12replication_source\x18\x05 \x01(\t\x12\x16\n\x0ereplicated_seq\x18\x06 \x01(\x03\x12\x1a\n\x12membership_version\x18\x07 \x01(\x03\x12\x0c\n\x04term\x18\x08 \x01(\x03\x12\x15\n\rheartbeat_seq\x18\t \x01(\x03\x12\x13\n\x0b\x61pplied_seq\x18\n \x01(\x03\x12\x11\n\tdata_term\x18\x0b \x01(\x03\"A\n\x0cHeartbeatAck\x12\x0c\n\x04term\x18\x01 \x01(\x03\x12\x0c\n\x04port\x18\x02 \x01(\t\x12\x15\n\rheartbeat_seq\x18\x03 \x01(\x03\"\xaa\x01\n\nUserRecord\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x10\n\x08password\x18\x02 \x01(\t\x12\x10\n\x08\x66ullname\x18\x03 \x01(\t\x12\x12\n\nauth_token\x18\x04 \x01(\t\x12\x17\n\x0ftoken_timestamp\x18\x05 \x01(\x01\x12\r\n\x05inbox\x18\x06 \x03(\t\x12\x14\n\x0cinbox_offset\x18\x07 \x01(\x04\x12\x14\n\x0cinbox_length\x18\x08 \x01(\r\"\xde\x01\n\x17ServerStateBackupUpdate\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x0c\n\x04time\x18\x05 \x01(\x01\x12\x15\n\rstate_version\x18\x06 \x01(\x03\x12\x14\n\x0c\x62\x61se_version\x18\x07 \x01(\x03\x12\x0c\n\x04\x66ull\x18\x08 \x01(\x08\x12\x0f\n\x07wal_seq\x18\t \x01(\x03\x12%\n\x05users\x18\n \x03(\x0b\x32\x16.helloworld.UserRecord\x12\x0f\n\x07\x64\x65leted\x18\x0b \x03(\t\x12\x0e\n\x06source\x18\x0c \x01(\tJ\x04\x08\x02\x10\x03J\x04\x08\x03\x10\x04J\x04\x08\x04\x10\x05\"J\n\x13ReplicatedOperation\x12\x0b\n\x03seq\x18\x01 \x01(\x03\x12\x0c\n\x04time\x18\x02 \x01(\x01\x12\n\n\x02op\x18\x03 \x01(\t\x12\x0c\n\x04\x61rgs\x18\x04 \x01(\t\"b\n\x14ReplicatedOperations\x12\x0e\n\x06source\x18\x01 \x01(\t\x12,\n\x03ops\x18\x02 \x03(\x0b\x32\x1f.helloworld.ReplicatedOperation\x12\x0c\n\x04term\x18\x03 \x01(\x03\";\n\x0eReplicationAck\x12\x0c\n\x04port\x18\x01 \x01(\t\x12\x0e\n\x06source\x18\x02 \x01(\t\x12\x0b\n\x03seq\x18\x03 \x01(\x03\"o\n\x0fSnapshotRequest\x12\x0c\n\x04port\x18\x01 \x01(\t\x12\x13\n\x0bsnapshot_id\x18\x02 \x01(\t\x12\x0e\n\x06offset\x18\x03 \x01(\x04\x12\x15\n\rresume_source\x18\x04 \x01(\t\x12\x12\n\nresume_seq\x18\x05 \x01(\x03\"i\n\x11ReplicationResume\x12\x0e\n\x06source\x18\x01 \x01(\t\x12\x0c\n\x04term\x18\x02 \x01(\x03\x12\x15\n\rresume_source\x18\x03 \x01(\t\x12\x12\n\nresume_seq\x18\x04 \x01(\x03\x12\x0b\n\x03seq\x18\x05 \x01(\x03\"\x97\x01\n\rSnapshotChunk\x12\x0c\n\x04port\x18\x01 \x01(\t\x12\x13\n\x0bsnapshot_id\x18\x02 \x01(\t\x12\x0e\n\x06offset\x18\x03 \x01(\x04\x12\r\n\x05total\x18\x04 \x01(\x04\x12\x10\n\x08\x63hecksum\x18\x05 \x01(\r\x12\x16\n\x0e\x63hunk_checksum\x18\x06 \x01(\r\x12\x0c\n\x04\x64\x61ta\x18\x07 \x01(\x0c\x12\x0c\n\x04term\x18\x08 \x01(\x03\"\x93\x04\n\x0eReplicaMessage\x12\x30\n\x06status\x18\x01 \x01(\x0b\x32\x1e.helloworld.ServerStatusUpdateH\x00\x12\x36\n\noperations\x18\x04 \x01(\x0b\x32 .helloworld.ReplicatedOperationsH\x00\x12)\n\x03\x61\x63k\x18\x05 \x01(\x0b\x32\x1a.helloworld.ReplicationAckH\x00\x12\x37\n\x10snapshot_request\x18\x06 \x01(\x0b\x32\x1b.helloworld.SnapshotRequestH\x00\x12\x33\n\x0esnapshot_chunk\x18\x07 \x01(\x0b\x32\x19.helloworld.SnapshotChunkH\x00\x12\x33\n\nmembership\x18\x08 \x01(\x0b\x32\x1d.helloworld.ClusterMembershipH\x00\x12/\n\x0cvote_request\x18\t \x01(\x0b\x32\x17.helloworld.VoteRequestH\x00\x12 \n\x04vote\x18\n \x01(\x0b\x32\x10.helloworld.VoteH\x00\x12\x31\n\rheartbeat_ack\x18\x0b \x01(\x0b\x32\x18.helloworld.HeartbeatAckH\x00\x12/\n\x06resume\x18\x0c \x01(\x0b\x32\x1d.helloworld.ReplicationResumeH\x00\x42\x06\n\x04\x62odyJ\x04\x08\x02\x10\x03J\x04\x08\x03\x10\x04\"K\n\rReplicaMember\x12\x0c\n\x04host\x18\x01 \x01(\t\x12\x15\n\rexternal_port\x18\x02 \x01(\t\x12\x15\n\rinternal_port\x18\x03 \x01(\t\"Q\n\x11\x43lusterMembership\x12\x0f\n\x07version\x18\x01 \x01(\x03\x12+\n\x08replicas\x18\x02 \x03(\x0b\x32\x19.helloworld.ReplicaMember\"V\n\x17MembershipChangeRequest\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12*\n\x07replica\x18\x02 \x01(\x0b\x32\x19.helloworld.ReplicaMember\"\x99\x01\n\x15MembershipChangeReply\x12\x0f\n\x07version\x18\x01 \x01(\x05\x12\x12\n\nerror_code\x18\x02 \x01(\t\x12\x31\n\nmembership\x18\x03 \x01(\x0b\x32\x1d.helloworld.ClusterMembership\x12(\n\x07primary\x18\x04 \x01(\x0b\x32\x17.helloworld.PrimaryHint2\x8a\x05\n\nChatServer\x12\x45\n\x0bSendMessage\x12\x1a.helloworld.MessageRequest\x1a\x18.helloworld.MessageReply\"\x00\x12K\n\x0f\x44\x65liverMessages\x12\x1a.helloworld.RefreshRequest\x1a\x18.helloworld.RefreshReply\"\x00\x30\x01\x12;\n\x05Login\x12\x18.helloworld.LoginRequest\x1a\x16.helloworld.LoginReply\"\x00\x12S\n\rCreateAccount\x12 .helloworld.AccountCreateRequest\x1a\x1e.helloworld.AccountCreateReply\"\x00\x12N\n\x0cListAccounts\x12\x1e.helloworld.ListAccountRequest\x1a\x1c.helloworld.ListAccountReply\"\x00\x12S\n\rDeleteAccount\x12 .helloworld.DeleteAccountRequest\x1a\x1e.helloworld.DeleteAccountReply\"\x00\x12V\n\nAddReplica\x12#.helloworld.MembershipChangeRequest\x1a!.helloworld.MembershipChangeReply\"\x00\x12Y\n\rRemoveReplica\x12#.helloworld.MembershipChangeRequest\x1a!.helloworld.MembershipChangeReply\"\x00\x32^\n\x12ReplicationService\x12H\n\x08\x45xchange\x12\x1a.helloworld.ReplicaMessage\x1a\x1a.helloworld.ReplicaMessage\"\x00(\x01\x30\x01\x42\x36\n\x1aio.grpc.modules.chatserverB\x0f\x43hatServerProtoP\x01\xa2\x02\x04\x43HSRb\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chat_pb2', globals())
@@ -23,28 +23,66 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   DESCRIPTOR._serialized_options = b'\n\032io.grpc.modules.chatserverB\017ChatServerProtoP\001\242\002\004CHSR'
   _MESSAGEREQUEST._serialized_start=26
   _MESSAGEREQUEST._serialized_end=142
-  _MESSAGEREPLY._serialized_start=144
-  _MESSAGEREPLY._serialized_end=195
-  _REFRESHREQUEST._serialized_start=197
-  _REFRESHREQUEST._serialized_end=268
-  _REFRESHREPLY._serialized_start=270
-  _REFRESHREPLY._serialized_end=338
-  _LOGINREQUEST._serialized_start=340
-  _LOGINREQUEST._serialized_end=407
-  _LOGINREPLY._serialized_start=409
-  _LOGINREPLY._serialized_end=496
-  _ACCOUNTCREATEREQUEST._serialized_start=498
-  _ACCOUNTCREATEREQUEST._serialized_end=591
-  _ACCOUNTCREATEREPLY._serialized_start=593
-  _ACCOUNTCREATEREPLY._serialized_end=688
-  _LISTACCOUNTREQUEST._serialized_start=690
-  _LISTACCOUNTREQUEST._serialized_end=808
-  _LISTACCOUNTREPLY._serialized_start=810
-  _LISTACCOUNTREPLY._serialized_end=888
-  _DELETEACCOUNTREQUEST._serialized_start=890
-  _DELETEACCOUNTREQUEST._serialized_end=967
-  _DELETEACCOUNTREPLY._serialized_start=969
-  _DELETEACCOUNTREPLY._serialized_end=1026
-  _CHATSERVER._serialized_start=1029
-  _CHATSERVER._serialized_end=1500
+  _PRIMARYHINT._serialized_start=144
+  _PRIMARYHINT._serialized_end=188
+  _MESSAGEREPLY._serialized_start=190
+  _MESSAGEREPLY._serialized_end=283
+  _REFRESHREQUEST._serialized_start=285
+  _REFRESHREQUEST._serialized_end=356
+  _REFRESHREPLY._serialized_start=358
+  _REFRESHREPLY._serialized_end=468
+  _LOGINREQUEST._serialized_start=470
+  _LOGINREQUEST._serialized_end=537
+  _LOGINREPLY._serialized_start=540
+  _LOGINREPLY._serialized_end=669
+  _ACCOUNTCREATEREQUEST._serialized_start=671
+  _ACCOUNTCREATEREQUEST._serialized_end=764
+  _ACCOUNTCREATEREPLY._serialized_start=767
+  _ACCOUNTCREATEREPLY._serialized_end=904
+  _LISTACCOUNTREQUEST._serialized_start=906
+  _LISTACCOUNTREQUEST._serialized_end=1024
+  _LISTACCOUNTREPLY._serialized_start=1026
+  _LISTACCOUNTREPLY._serialized_end=1146
+  _DELETEACCOUNTREQUEST._serialized_start=1148
+  _DELETEACCOUNTREQUEST._serialized_end=1225
+  _DELETEACCOUNTREPLY._serialized_start=1227
+  _DELETEACCOUNTREPLY._serialized_end=1326
+  _VOTEREQUEST._serialized_start=1328
+  _VOTEREQUEST._serialized_end=1409
+  _VOTE._serialized_start=1411
+  _VOTE._serialized_end=1462
+  _SERVERSTATUSUPDATE._serialized_start=1465
+  _SERVERSTATUSUPDATE._serialized_end=1708
+  _HEARTBEATACK._serialized_start=1710
+  _HEARTBEATACK._serialized_end=1775
+  _USERRECORD._serialized_start=1778
+  _USERRECORD._serialized_end=1948
+  _SERVERSTATEBACKUPUPDATE._serialized_start=1951
+  _SERVERSTATEBACKUPUPDATE._serialized_end=2173
+  _REPLICATEDOPERATION._serialized_start=2175
+  _REPLICATEDOPERATION._serialized_end=2249
+  _REPLICATEDOPERATIONS._serialized_start=2251
+  _REPLICATEDOPERATIONS._serialized_end=2349
+  _REPLICATIONACK._serialized_start=2351
+  _REPLICATIONACK._serialized_end=2410
+  _SNAPSHOTREQUEST._serialized_start=2412
+  _SNAPSHOTREQUEST._serialized_end=2523
+  _REPLICATIONRESUME._serialized_start=2525
+  _REPLICATIONRESUME._serialized_end=2630
+  _SNAPSHOTCHUNK._serialized_start=2633
+  _SNAPSHOTCHUNK._serialized_end=2784
+  _REPLICAMESSAGE._serialized_start=2787
+  _REPLICAMESSAGE._serialized_end=3318
+  _REPLICAMEMBER._serialized_start=3320
+  _REPLICAMEMBER._serialized_end=3395
+  _CLUSTERMEMBERSHIP._serialized_start=3397
+  _CLUSTERMEMBERSHIP._serialized_end=3478
+  _MEMBERSHIPCHANGEREQUEST._serialized_start=3480
+  _MEMBERSHIPCHANGEREQUEST._serialized_end=3566
+  _MEMBERSHIPCHANGEREPLY._serialized_start=3569
+  _MEMBERSHIPCHANGEREPLY._serialized_end=3722
+  _CHATSERVER._serialized_start=3725
+  _CHATSERVER._serialized_end=4375
+  _REPLICATIONSERVICE._serialized_start=4377
+  _REPLICATIONSERVICE._serialized_end=4471
 # @@protoc_insertion_point(module_scope)
@@ -1,20 +1,23 @@
+from google.protobuf.internal import containers as _containers
 from google.protobuf import descriptor as _descriptor
 from google.protobuf import message as _message
-from typing import ClassVar as _ClassVar, Optional as _Optional
+from typing import ClassVar as _ClassVar, Iterable as _Iterable, Mapping as _Mapping, Optional as _Optional, Union as _Union
 
 DESCRIPTOR: _descriptor.FileDescriptor
 
 class AccountCreateReply(_message.Message):
-    __slots__ = ["auth_token", "error_code", "fullname", "version"]
+    __slots__ = ["auth_token", "error_code", "fullname", "primary", "version"]
     AUTH_TOKEN_FIELD_NUMBER: _ClassVar[int]
     ERROR_CODE_FIELD_NUMBER: _ClassVar[int]
     FULLNAME_FIELD_NUMBER: _ClassVar[int]
+    PRIMARY_FIELD_NUMBER: _ClassVar[int]
     VERSION_FIELD_NUMBER: _ClassVar[int]
     auth_token: str
     error_code: str
     fullname: str
+    primary: PrimaryHint
     version: int
-    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ..., auth_token: _Optional[str] = ..., fullname: _Optional[str] = ...) -> None: ...
+    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ..., auth_token: _Optional[str] = ..., fullname: _Optional[str] = ..., primary: _Optional[_Union[PrimaryHint, _Mapping]] = ...) -> None: ...
 
 class AccountCreateRequest(_message.Message):
     __slots__ = ["fullname", "password", "username", "version"]
@@ -28,13 +31,23 @@ class AccountCreateRequest(_message.Message):
     version: int
     def __init__(self, version: _Optional[int] = ..., username: _Optional[str] = ..., password: _Optional[str] = ..., fullname: _Optional[str] = ...) -> None: ...
 
+class ClusterMembership(_message.Message):
+    __slots__ = ["replicas", "version"]
+    REPLICAS_FIELD_NUMBER: _ClassVar[int]
+    VERSION_FIELD_NUMBER: _ClassVar[int]
+    replicas: _containers.RepeatedCompositeFieldContainer[ReplicaMember]
+    version: int
+    def __init__(self, version: _Optional[int] = ..., replicas: _Optional[_Iterable[_Union[ReplicaMember, _Mapping]]] = ...) -> None: ...
+
 class DeleteAccountReply(_message.Message):
-    __slots__ = ["error_code", "version"]
+    __slots__ = ["error_code", "primary", "version"]
     ERROR_CODE_FIELD_NUMBER: _ClassVar[int]
+    PRIMARY_FIELD_NUMBER: _ClassVar[int]
     VERSION_FIELD_NUMBER: _ClassVar[int]
     error_code: str
+    primary: PrimaryHint
     version: int
-    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ...) -> None: ...
+    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ..., primary: _Optional[_Union[PrimaryHint, _Mapping]] = ...) -> None: ...
 
 class DeleteAccountRequest(_message.Message):
     __slots__ = ["auth_token", "username", "version"]
@@ -46,15 +59,27 @@ class DeleteAccountRequest(_message.Message):
     version: int
     def __init__(self, version: _Optional[int] = ..., auth_token: _Optional[str] = ..., username: _Optional[str] = ...) -> None: ...
 
+class HeartbeatAck(_message.Message):
+    __slots__ = ["heartbeat_seq", "port", "term"]
+    HEARTBEAT_SEQ_FIELD_NUMBER: _ClassVar[int]
+    PORT_FIELD_NUMBER: _ClassVar[int]
+    TERM_FIELD_NUMBER: _ClassVar[int]
+    heartbeat_seq: int
+    port: str
+    term: int
+    def __init__(self, term: _Optional[int] = ..., port: _Optional[str] = ..., heartbeat_seq: _Optional[int] = ...) -> None: ...
+
 class ListAccountReply(_message.Message):
-    __slots__ = ["account_names", "error_code", "version"]
+    __slots__ = ["account_names", "error_code", "primary", "version"]
     ACCOUNT_NAMES_FIELD_NUMBER: _ClassVar[int]
     ERROR_CODE_FIELD_NUMBER: _ClassVar[int]
+    PRIMARY_FIELD_NUMBER: _ClassVar[int]
     VERSION_FIELD_NUMBER: _ClassVar[int]
     account_names: str
     error_code: str
+    primary: PrimaryHint
     version: int
-    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ..., account_names: _Optional[str] = ...) -> None: ...
+    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ..., account_names: _Optional[str] = ..., primary: _Optional[_Union[PrimaryHint, _Mapping]] = ...) -> None: ...
 
 class ListAccountRequest(_message.Message):
     __slots__ = ["auth_token", "number_of_accounts", "regex", "username", "version"]
@@ -71,16 +96,18 @@ class ListAccountRequest(_message.Message):
     def __init__(self, version: _Optional[int] = ..., auth_token: _Optional[str] = ..., username: _Optional[str] = ..., number_of_accounts: _Optional[int] = ..., regex: _Optional[str] = ...) -> None: ...
 
 class LoginReply(_message.Message):
-    __slots__ = ["auth_token", "error_code", "fullname", "version"]
+    __slots__ = ["auth_token", "error_code", "fullname", "primary", "version"]
     AUTH_TOKEN_FIELD_NUMBER: _ClassVar[int]
     ERROR_CODE_FIELD_NUMBER: _ClassVar[int]
     FULLNAME_FIELD_NUMBER: _ClassVar[int]
+    PRIMARY_FIELD_NUMBER: _ClassVar[int]
     VERSION_FIELD_NUMBER: _ClassVar[int]
     auth_token: str
     error_code: str
     fullname: str
+    primary: PrimaryHint
     version: int
-    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ..., auth_token: _Optional[str] = ..., fullname: _Optional[str] = ...) -> None: ...
+    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ..., auth_token: _Optional[str] = ..., fullname: _Optional[str] = ..., primary: _Optional[_Union[PrimaryHint, _Mapping]] = ...) -> None: ...
 
 class LoginRequest(_message.Message):
     __slots__ = ["password", "username", "version"]
@@ -92,13 +119,35 @@ class LoginRequest(_message.Message):
     version: int
     def __init__(self, version: _Optional[int] = ..., username: _Optional[str] = ..., password: _Optional[str] = ...) -> None: ...
 
+class MembershipChangeReply(_message.Message):
+    __slots__ = ["error_code", "membership", "primary", "version"]
+    ERROR_CODE_FIELD_NUMBER: _ClassVar[int]
+    MEMBERSHIP_FIELD_NUMBER: _ClassVar[int]
+    PRIMARY_FIELD_NUMBER: _ClassVar[int]
+    VERSION_FIELD_NUMBER: _ClassVar[int]
+    error_code: str
+    membership: ClusterMembership
+    primary: PrimaryHint
+    version: int
+    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ..., membership: _Optional[_Union[ClusterMembership, _Mapping]] = ..., primary: _Optional[_Union[PrimaryHint, _Mapping]] = ...) -> None: ...
+
+class MembershipChangeRequest(_message.Message):
+    __slots__ = ["replica", "version"]
+    REPLICA_FIELD_NUMBER: _ClassVar[int]
+    VERSION_FIELD_NUMBER: _ClassVar[int]
+    replica: ReplicaMember
+    version: int
+    def __init__(self, version: _Optional[int] = ..., replica: _Optional[_Union[ReplicaMember, _Mapping]] = ...) -> None: ...
+
 class MessageReply(_message.Message):
-    __slots__ = ["error_code", "version"]
+    __slots__ = ["error_code", "primary", "version"]
     ERROR_CODE_FIELD_NUMBER: _ClassVar[int]
+    PRIMARY_FIELD_NUMBER: _ClassVar[int]
     VERSION_FIELD_NUMBER: _ClassVar[int]
     error_code: str
+    primary: PrimaryHint
     version: int
-    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ...) -> None: ...
+    def __init__(self, version: _Optional[int] = ..., error_code: _Optional[str] = ..., primary: _Optional[_Union[PrimaryHint, _Mapping]] = ...) -> None: ...
 
 class MessageRequest(_message.Message):
     __slots__ = ["auth_token", "message", "recipient_username", "username", "version"]
@@ -114,15 +163,25 @@ class MessageRequest(_message.Message):
     version: int
     def __init__(self, version: _Optional[int] = ..., auth_token: _Optional[str] = ..., username: _Optional[str] = ..., recipient_username: _Optional[str] = ..., message: _Optional[str] = ...) -> None: ...
 
+class PrimaryHint(_message.Message):
+    __slots__ = ["address", "term"]
+    ADDRESS_FIELD_NUMBER: _ClassVar[int]
+    TERM_FIELD_NUMBER: _ClassVar[int]
+    address: str
+    term: int
+    def __init__(self, address: _Optional[str] = ..., term: _Optional[int] = ...) -> None: ...
+
 class RefreshReply(_message.Message):
-    __slots__ = ["error_code", "message", "version"]
+    __slots__ = ["error_code", "message", "primary", "version"]
     ERROR_CODE_FIELD_NUMBER: _ClassVar[int]
     MESSAGE_FIELD_NUMBER: _ClassVar[int]
+    PRIMARY_FIELD_NUMBER: _ClassVar[int]
     VERSION_FIELD_NUMBER: _ClassVar[int]
     error_code: str
     message: str
+    primary: PrimaryHint
     version: int
-    def __init__(self, version: _Optional[int] = ..., message: _Optional[str] = ..., error_code: _Optional[str] = ...) -> None: ...
+    def __init__(self, version: _Optional[int] = ..., message: _Optional[str] = ..., error_code: _Optional[str] = ..., primary: _Optional[_Union[PrimaryHint, _Mapping]] = ...) -> None: ...
 
 class RefreshRequest(_message.Message):
     __slots__ = ["auth_token", "username", "version"]
@@ -133,3 +192,207 @@ class RefreshRequest(_message.Message):
     username: str
     version: int
     def __init__(self, version: _Optional[int] = ..., auth_token: _Optional[str] = ..., username: _Optional[str] = ...) -> None: ...
+
+class ReplicaMember(_message.Message):
+    __slots__ = ["external_port", "host", "internal_port"]
+    EXTERNAL_PORT_FIELD_NUMBER: _ClassVar[int]
+    HOST_FIELD_NUMBER: _ClassVar[int]
+    INTERNAL_PORT_FIELD_NUMBER: _ClassVar[int]
+    external_port: str
+    host: str
+    internal_port: str
+    def __init__(self, host: _Optional[str] = ..., external_port: _Optional[str] = ..., internal_port: _Optional[str] = ...) -> None: ...
+
+class ReplicaMessage(_message.Message):
+    __slots__ = ["ack", "heartbeat_ack", "membership", "operations", "resume", "snapshot_chunk", "snapshot_request", "status", "vote", "vote_request"]
+    ACK_FIELD_NUMBER: _ClassVar[int]
+    HEARTBEAT_ACK_FIELD_NUMBER: _ClassVar[int]
+    MEMBERSHIP_FIELD_NUMBER: _ClassVar[int]
+    OPERATIONS_FIELD_NUMBER: _ClassVar[int]
+    RESUME_FIELD_NUMBER: _ClassVar[int]
+    SNAPSHOT_CHUNK_FIELD_NUMBER: _ClassVar[int]
+    SNAPSHOT_REQUEST_FIELD_NUMBER: _ClassVar[int]
+    STATUS_FIELD_NUMBER: _ClassVar[int]
+    VOTE_FIELD_NUMBER: _ClassVar[int]
+    VOTE_REQUEST_FIELD_NUMBER: _ClassVar[int]
+    ack: ReplicationAck
+    heartbeat_ack: HeartbeatAck
+    membership: ClusterMembership
+    operations: ReplicatedOperations
+    resume: ReplicationResume
+    snapshot_chunk: SnapshotChunk
+    snapshot_request: SnapshotRequest
+    status: ServerStatusUpdate
+    vote: Vote
+    vote_request: VoteRequest
+    def __init__(self, status: _Optional[_Union[ServerStatusUpdate, _Mapping]] = ..., operations: _Optional[_Union[ReplicatedOperations, _Mapping]] = ..., ack: _Optional[_Union[ReplicationAck, _Mapping]] = ..., snapshot_request: _Optional[_Union[SnapshotRequest, _Mapping]] = ..., snapshot_chunk: _Optional[_Union[SnapshotChunk, _Mapping]] = ..., membership: _Optional[_Union[ClusterMembership, _Mapping]] = ..., vote_request: _Optional[_Union[VoteRequest, _Mapping]] = ..., vote: _Optional[_Union[Vote, _Mapping]] = ..., heartbeat_ack: _Optional[_Union[HeartbeatAck, _Mapping]] = ..., resume: _Optional[_Union[ReplicationResume, _Mapping]] = ...) -> None: ...
+
+class ReplicatedOperation(_message.Message):
+    __slots__ = ["args", "op", "seq", "time"]
+    ARGS_FIELD_NUMBER: _ClassVar[int]
+    OP_FIELD_NUMBER: _ClassVar[int]
+    SEQ_FIELD_NUMBER: _ClassVar[int]
+    TIME_FIELD_NUMBER: _ClassVar[int]
+    args: str
+    op: str
+    seq: int
+    time: float
+    def __init__(self, seq: _Optional[int] = ..., time: _Optional[float] = ..., op: _Optional[str] = ..., args: _Optional[str] = ...) -> None: ...
+
+class ReplicatedOperations(_message.Message):
+    __slots__ = ["ops", "source", "term"]
+    OPS_FIELD_NUMBER: _ClassVar[int]
+    SOURCE_FIELD_NUMBER: _ClassVar[int]
+    TERM_FIELD_NUMBER: _ClassVar[int]
+    ops: _containers.RepeatedCompositeFieldContainer[ReplicatedOperation]
+    source: str
+    term: int
+    def __init__(self, source: _Optional[str] = ..., ops: _Optional[_Iterable[_Union[ReplicatedOperation, _Mapping]]] = ..., term: _Optional[int] = ...) -> None: ...
+
+class ReplicationAck(_message.Message):
+    __slots__ = ["port", "seq", "source"]
+    PORT_FIELD_NUMBER: _ClassVar[int]
+    SEQ_FIELD_NUMBER: _ClassVar[int]
+    SOURCE_FIELD_NUMBER: _ClassVar[int]
+    port: str
+    seq: int
+    source: str
+    def __init__(self, port: _Optional[str] = ..., source: _Optional[str] = ..., seq: _Optional[int] = ...) -> None: ...
+
+class ReplicationResume(_message.Message):
+    __slots__ = ["resume_seq", "resume_source", "seq", "source", "term"]
+    RESUME_SEQ_FIELD_NUMBER: _ClassVar[int]
+    RESUME_SOURCE_FIELD_NUMBER: _ClassVar[int]
+    SEQ_FIELD_NUMBER: _ClassVar[int]
+    SOURCE_FIELD_NUMBER: _ClassVar[int]
+    TERM_FIELD_NUMBER: _ClassVar[int]
+    resume_seq: int
+    resume_source: str
+    seq: int
+    source: str
+    term: int
+    def __init__(self, source: _Optional[str] = ..., term: _Optional[int] = ..., resume_source: _Optional[str] = ..., resume_seq: _Optional[int] = ..., seq: _Optional[int] = ...) -> None: ...
+
+class ServerStateBackupUpdate(_message.Message):
+    __slots__ = ["base_version", "deleted", "full", "source", "state_version", "time", "users", "version", "wal_seq"]
+    BASE_VERSION_FIELD_NUMBER: _ClassVar[int]
+    DELETED_FIELD_NUMBER: _ClassVar[int]
+    FULL_FIELD_NUMBER: _ClassVar[int]
+    SOURCE_FIELD_NUMBER: _ClassVar[int]
+    STATE_VERSION_FIELD_NUMBER: _ClassVar[int]
+    TIME_FIELD_NUMBER: _ClassVar[int]
+    USERS_FIELD_NUMBER: _ClassVar[int]
+    VERSION_FIELD_NUMBER: _ClassVar[int]
+    WAL_SEQ_FIELD_NUMBER: _ClassVar[int]
+    base_version: int
+    deleted: _containers.RepeatedScalarFieldContainer[str]
+    full: bool
+    source: str
+    state_version: int
+    time: float
+    users: _containers.RepeatedCompositeFieldContainer[UserRecord]
+    version: int
+    wal_seq: int
+    def __init__(self, version: _Optional[int] = ..., time: _Optional[float] = ..., state_version: _Optional[int] = ..., base_version: _Optional[int] = ..., full: bool = ..., wal_seq: _Optional[int] = ..., users: _Optional[_Iterable[_Union[UserRecord, _Mapping]]] = ..., deleted: _Optional[_Iterable[str]] = ..., source: _Optional[str] = ...) -> None: ...
+
+class ServerStatusUpdate(_message.Message):
+    __slots__ = ["applied_seq", "data_term", "heartbeat_seq", "membership_version", "port", "position", "replicated_seq", "replication_source", "term", "version", "wal_seq"]
+    APPLIED_SEQ_FIELD_NUMBER: _ClassVar[int]
+    DATA_TERM_FIELD_NUMBER: _ClassVar[int]
+    HEARTBEAT_SEQ_FIELD_NUMBER: _ClassVar[int]
+    MEMBERSHIP_VERSION_FIELD_NUMBER: _ClassVar[int]
+    PORT_FIELD_NUMBER: _ClassVar[int]
+    POSITION_FIELD_NUMBER: _ClassVar[int]
+    REPLICATED_SEQ_FIELD_NUMBER: _ClassVar[int]
+    REPLICATION_SOURCE_FIELD_NUMBER: _ClassVar[int]
+    TERM_FIELD_NUMBER: _ClassVar[int]
+    VERSION_FIELD_NUMBER: _ClassVar[int]
+    WAL_SEQ_FIELD_NUMBER: _ClassVar[int]
+    applied_seq: int
+    data_term: int
+    heartbeat_seq: int
+    membership_version: int
+    port: str
+    position: str
+    replicated_seq: int
+    replication_source: str
+    term: int
+    version: int
+    wal_seq: int
+    def __init__(self, version: _Optional[int] = ..., port: _Optional[str] = ..., position: _Optional[str] = ..., wal_seq: _Optional[int] = ..., replication_source: _Optional[str] = ..., replicated_seq: _Optional[int] = ..., membership_version: _Optional[int] = ..., term: _Optional[int] = ..., heartbeat_seq: _Optional[int] = ..., applied_seq: _Optional[int] = ..., data_term: _Optional[int] = ...) -> None: ...
+
+class SnapshotChunk(_message.Message):
+    __slots__ = ["checksum", "chunk_checksum", "data", "offset", "port", "snapshot_id", "term", "total"]
+    CHECKSUM_FIELD_NUMBER: _ClassVar[int]
+    CHUNK_CHECKSUM_FIELD_NUMBER: _ClassVar[int]
+    DATA_FIELD_NUMBER: _ClassVar[int]
+    OFFSET_FIELD_NUMBER: _ClassVar[int]
+    PORT_FIELD_NUMBER: _ClassVar[int]
+    SNAPSHOT_ID_FIELD_NUMBER: _ClassVar[int]
+    TERM_FIELD_NUMBER: _ClassVar[int]
+    TOTAL_FIELD_NUMBER: _ClassVar[int]
+    checksum: int
+    chunk_checksum: int
+    data: bytes
+    offset: int
+    port: str
+    snapshot_id: str
+    term: int
+    total: int
+    def __init__(self, port: _Optional[str] = ..., snapshot_id: _Optional[str] = ..., offset: _Optional[int] = ..., total: _Optional[int] = ..., checksum: _Optional[int] = ..., chunk_checksum: _Optional[int] = ..., data: _Optional[bytes] = ..., term: _Optional[int] = ...) -> None: ...
+
+class SnapshotRequest(_message.Message):
+    __slots__ = ["offset", "port", "resume_seq", "resume_source", "snapshot_id"]
+    OFFSET_FIELD_NUMBER: _ClassVar[int]
+    PORT_FIELD_NUMBER: _ClassVar[int]
+    RESUME_SEQ_FIELD_NUMBER: _ClassVar[int]
+    RESUME_SOURCE_FIELD_NUMBER: _ClassVar[int]
+    SNAPSHOT_ID_FIELD_NUMBER: _ClassVar[int]
+    offset: int
+    port: str
+    resume_seq: int
+    resume_source: str
+    snapshot_id: str
+    def __init__(self, port: _Optional[str] = ..., snapshot_id: _Optional[str] = ..., offset: _Optional[int] = ..., resume_source: _Optional[str] = ..., resume_seq: _Optional[int] = ...) -> None: ...
+
+class UserRecord(_message.Message):
+    __slots__ = ["auth_token", "fullname", "inbox", "inbox_length", "inbox_offset", "password", "token_timestamp", "username"]
+    AUTH_TOKEN_FIELD_NUMBER: _ClassVar[int]
+    FULLNAME_FIELD_NUMBER: _ClassVar[int]
+    INBOX_FIELD_NUMBER: _ClassVar[int]
+    INBOX_LENGTH_FIELD_NUMBER: _ClassVar[int]
+    INBOX_OFFSET_FIELD_NUMBER: _ClassVar[int]
+    PASSWORD_FIELD_NUMBER: _ClassVar[int]
+    TOKEN_TIMESTAMP_FIELD_NUMBER: _ClassVar[int]
+    USERNAME_FIELD_NUMBER: _ClassVar[int]
+    auth_token: str
+    fullname: str
+    inbox: _containers.RepeatedScalarFieldContainer[str]
+    inbox_length: int
+    inbox_offset: int
+    password: str
+    token_timestamp: float
+    username: str
+    def __init__(self, username: _Optional[str] = ..., password: _Optional[str] = ..., fullname: _Optional[str] = ..., auth_token: _Optional[str] = ..., token_timestamp: _Optional[float] = ..., inbox: _Optional[_Iterable[str]] = ..., inbox_offset: _Optional[int] = ..., inbox_length: _Optional[int] = ...) -> None: ...
+
+class Vote(_message.Message):
+    __slots__ = ["granted", "port", "term"]
+    GRANTED_FIELD_NUMBER: _ClassVar[int]
+    PORT_FIELD_NUMBER: _ClassVar[int]
+    TERM_FIELD_NUMBER: _ClassVar[int]
+    granted: bool
+    port: str
+    term: int
+    def __init__(self, term: _Optional[int] = ..., port: _Optional[str] = ..., granted: bool = ...) -> None: ...
+
+class VoteRequest(_message.Message):
+    __slots__ = ["applied_seq", "data_term", "port", "term"]
+    APPLIED_SEQ_FIELD_NUMBER: _ClassVar[int]
+    DATA_TERM_FIELD_NUMBER: _ClassVar[int]
+    PORT_FIELD_NUMBER: _ClassVar[int]
+    TERM_FIELD_NUMBER: _ClassVar[int]
+    applied_seq: int
+    data_term: int
+    port: str
+    term: int
+    def __init__(self, term: _Optional[int] = ..., port: _Optional[str] = ..., data_term: _Optional[int] = ..., applied_seq: _Optional[int] = ...) -> None: ...
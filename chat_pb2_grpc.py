@@ -46,6 +46,16 @@ class ChatServerStub(object):
                 request_serializer=chat__pb2.DeleteAccountRequest.SerializeToString,
                 response_deserializer=chat__pb2.DeleteAccountReply.FromString,
                 )
+        self.AddReplica = channel.unary_unary(
+                '/helloworld.ChatServer/AddReplica',
+                request_serializer=chat__pb2.MembershipChangeRequest.SerializeToString,
+                response_deserializer=chat__pb2.MembershipChangeReply.FromString,
+                )
+        self.RemoveReplica = channel.unary_unary(
+                '/helloworld.ChatServer/RemoveReplica',
+                request_serializer=chat__pb2.MembershipChangeRequest.SerializeToString,
+                response_deserializer=chat__pb2.MembershipChangeReply.FromString,
+                )
 
 
 class ChatServerServicer(object):
@@ -89,6 +99,19 @@ class ChatServerServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def AddReplica(self, request, context):
+        """Cluster membership changes, handled by the primary
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def RemoveReplica(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatServerServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -122,6 +145,16 @@ def add_ChatServerServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.DeleteAccountRequest.FromString,
                     response_serializer=chat__pb2.DeleteAccountReply.SerializeToString,
             ),
+            'AddReplica': grpc.unary_unary_rpc_method_handler(
+                    servicer.AddReplica,
+                    request_deserializer=chat__pb2.MembershipChangeRequest.FromString,
+                    response_serializer=chat__pb2.MembershipChangeReply.SerializeToString,
+            ),
+            'RemoveReplica': grpc.unary_unary_rpc_method_handler(
+                    servicer.RemoveReplica,
+                    request_deserializer=chat__pb2.MembershipChangeRequest.FromString,
+                    response_serializer=chat__pb2.MembershipChangeReply.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'helloworld.ChatServer', rpc_method_handlers)
@@ -235,3 +268,107 @@ class ChatServer(object):
             chat__pb2.DeleteAccountReply.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def AddReplica(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/helloworld.ChatServer/AddReplica',
+            chat__pb2.MembershipChangeRequest.SerializeToString,
+            chat__pb2.MembershipChangeReply.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+    @staticmethod
+    def RemoveReplica(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/helloworld.ChatServer/RemoveReplica',
+            chat__pb2.MembershipChangeRequest.SerializeToString,
+            chat__pb2.MembershipChangeReply.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
+
+class ReplicationServiceStub(object):
+    """Replica to replica traffic. Every replica opens one Exchange stream to
+    each of its peers and sends its heartbeats, election messages and
+    replication traffic to that peer on it.
+    """
+
+    def __init__(self, channel):
+        """Constructor.
+
+        Args:
+            channel: A grpc.Channel.
+        """
+        self.Exchange = channel.stream_stream(
+                '/helloworld.ReplicationService/Exchange',
+                request_serializer=chat__pb2.ReplicaMessage.SerializeToString,
+                response_deserializer=chat__pb2.ReplicaMessage.FromString,
+                )
+
+
+class ReplicationServiceServicer(object):
+    """Replica to replica traffic. Every replica opens one Exchange stream to
+    each of its peers and sends its heartbeats, election messages and
+    replication traffic to that peer on it.
+    """
+
+    def Exchange(self, request_iterator, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+
+def add_ReplicationServiceServicer_to_server(servicer, server):
+    rpc_method_handlers = {
+            'Exchange': grpc.stream_stream_rpc_method_handler(
+                    servicer.Exchange,
+                    request_deserializer=chat__pb2.ReplicaMessage.FromString,
+                    response_serializer=chat__pb2.ReplicaMessage.SerializeToString,
+            ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+            'helloworld.ReplicationService', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+
+
+ # This class is part of an EXPERIMENTAL API.
+class ReplicationService(object):
+    """Replica to replica traffic. Every replica opens one Exchange stream to
+    each of its peers and sends its heartbeats, election messages and
+    replication traffic to that peer on it.
+    """
+
+    @staticmethod
+    def Exchange(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(request_iterator, target, '/helloworld.ReplicationService/Exchange',
+            chat__pb2.ReplicaMessage.SerializeToString,
+            chat__pb2.ReplicaMessage.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
@@ -1,22 +1,37 @@
 from __future__ import print_function
 
+import argparse
 import logging
 import threading as mp
-import concurrent.futures
 import time
 from tkinter import *
 from tkinter import simpledialog
-from collections.abc import Iterable
 
 import grpc
 
 import chat_pb2
 import chat_pb2_grpc
+import membership
 
-ADDRESSES = ["10.250.21.56", '10.250.156.238', '10.250.156.238']  # "10.250.240.43"
-PORTS = [50051, 50052, 50053]
+# the default replicas, a membership file given with --cluster-config
+# replaces them
+ADDRESSES, PORTS = membership.Membership().client_addresses()
 MAX_CHAR_COUNT = 280
 SECONDARY_ERROR_CODE = "Secondary server response"
+# seconds a server gets to answer a request, above the server's replication
+# timeout so that a write held for acknowledgements is still answered.
+# DeliverMessages streams have no deadline, the server removes the messages
+# it streams and a stream cut short would lose them.
+REQUEST_TIMEOUT = 5.0
+# requests a second copy of would be applied again, they are only sent to
+# another server when the first one cannot have received them
+NON_IDEMPOTENT_REQUESTS = ("CreateAccount", "SendMessage", "DeleteAccount")
+# servers a request is sent to, following redirects or in turn, before the
+# client gives up
+ROUTING_ATTEMPTS = 20
+# seconds the client waits before trying the next server when the last one
+# was down or knew no primary, the attempts together outlast an election
+ROUTING_PAUSE = 0.05
 
 def try_except_RPC_error(func):
     def try_func(*args, **kwargs):
@@ -26,18 +41,36 @@ def try_except_RPC_error(func):
             return None
     return try_func
 
+def status_code(error):
+    # The status of a failed RPC, None if the error carries none
+    code = getattr(error, "code", None)
+    return code() if callable(code) else None
+
 class ClientStub:
+    """
+    Sends every request to one server, the primary as far as the client
+    knows. A secondary answers with the address and term of the primary it
+    knows of and the request is sent there instead. If the server cannot be
+    reached, or no primary is known, the request goes to the next server in
+    turn. So does a request that is safe to repeat and got no answer within
+    REQUEST_TIMEOUT. A write that may have been applied is not sent again,
+    its error is raised instead.
+    """
+
     def __init__(self,
                  addresses,
                  ports
                  ):
         assert len(addresses) == len(ports)
-        self.num_servers = len(addresses)
-        self.addresses = addresses
-        self.ports = ports
-        self.channels = [grpc.insecure_channel(f"{address}:{port}") for \
-                         address, port in zip(self.addresses, self.ports)]
+        self.targets = [f"{address}:{port}" for address, port in zip(addresses, ports)]
+        self.channels = [grpc.insecure_channel(target) for target in self.targets]
         self.stubs = [chat_pb2_grpc.ChatServerStub(channel) for channel in self.channels]
+        # index of the server requests go to, and the latest term a redirect
+        # named, older redirects come from servers that are behind
+        self.primary = 0
+        self.term = 0
+        # requests of the GUI and the listening thread may re-route at once
+        self.routing_lock = mp.Lock()
         self.request_names = [
             "CreateAccount",
             "Login",
@@ -53,27 +86,74 @@ class ClientStub:
                 return lambda msg: self.SendRequest(req_name, msg)
             setattr(self, req_name, func(req_name))
 
+    def Call(self, index, request_name, msg):
+        """
+        Sends one request to the server at `index`.
+
+        Returns:
+            The reply, a list of the replies for DeliverMessages, None if
+            the request may be sent to another server.
+
+        Raises:
+            grpc.RpcError: If a request in NON_IDEMPOTENT_REQUESTS failed
+            after it may have reached the server.
+        """
+        method = getattr(self.stubs[index], request_name)
+        if request_name == "DeliverMessages":
+            replies = []
+            try:
+                for reply in method(msg):
+                    replies.append(reply)
+            except grpc.RpcError:
+                # the messages received are no longer on the server
+                return replies if len(replies) > 0 else None
+            return replies
+        try:
+            return method(msg, timeout=REQUEST_TIMEOUT)
+        except grpc.RpcError as e:
+            if request_name in NON_IDEMPOTENT_REQUESTS and status_code(e) != grpc.StatusCode.UNAVAILABLE:
+                raise
+            return None
+
+    def Redirect(self, reply):
+        """
+        Returns:
+            int: The index of the server a secondary's reply names as
+            primary, None if it names none or is of an older term than a
+            redirect already followed. A server missing from the list, one
+            added to the cluster since the client started, is added.
+        """
+        hint = reply.primary
+        if hint.address == "" or hint.term < self.term:
+            return None
+        self.term = hint.term
+        if hint.address not in self.targets:
+            self.targets.append(hint.address)
+            self.channels.append(grpc.insecure_channel(hint.address))
+            self.stubs.append(chat_pb2_grpc.ChatServerStub(self.channels[-1]))
+        return self.targets.index(hint.address)
+
     def SendRequest(self, request_name, msg):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(try_except_RPC_error(getattr(self.stubs[i], request_name)), msg) \
-                       for i in range(self.num_servers)]  
-            results = [f.result() for f in futures]
-
-        print(results)
-        resp = None
-        for result in results:
-            if request_name == "DeliverMessages":
-                return results
-            # result will be None in the case a gRPC request to an individuul server timeouts
-            elif result is None or result.error_code == SECONDARY_ERROR_CODE:
-                continue
-            elif resp is not None:
-                raise Exception("Two servers believe they are the primary!")
-            else:
-                resp = result
-        if resp is None:
-            raise Exception("No servers believe they are the primary!")
-        return resp
+        for _ in range(ROUTING_ATTEMPTS):
+            with self.routing_lock:
+                index = self.primary
+            result = self.Call(index, request_name, msg)
+            # a secondary answers DeliverMessages with a single reply, the
+            # primary with the messages, if any
+            reply = result[0] if request_name == "DeliverMessages" and result else result
+            if result == [] or (reply is not None and reply.error_code != SECONDARY_ERROR_CODE):
+                return result
+            with self.routing_lock:
+                redirect = None if reply is None else self.Redirect(reply)
+                if redirect is not None and redirect != index:
+                    self.primary = redirect
+                    continue
+                if self.primary == index:
+                    self.primary = (index + 1) % len(self.stubs)
+            # the server is down or knows no primary, an election may be
+            # under way
+            time.sleep(ROUTING_PAUSE)
+        raise Exception("No servers believe they are the primary!")
 
 class ClientApplication:
     def __init__(self,
@@ -171,16 +251,12 @@ class ClientApplication:
 
             if event.is_set():
                 break
-            for server_iterator in self.client_stub.DeliverMessages(auth_msg_request):
-                if isinstance(server_iterator, Iterable):
-                    try:
-                        for msg in server_iterator:
-                            self.messages.insert(END, msg.message + '\n')
-                    except:
-                        pass
-                else:
-                    print("Received non-iterable from secondary")
-                
+            try:
+                for msg in self.client_stub.DeliverMessages(auth_msg_request):
+                    self.messages.insert(END, msg.message + '\n')
+            except Exception as e:
+                print(e)
+
             time.sleep(0.5)
 
                
@@ -311,12 +387,16 @@ class ClientApplication:
                 self.messages.insert(END, "[ERR] " + resp.error_code + "\n")
 
 
-def Run() -> None:
+def Run(addresses=ADDRESSES, ports=PORTS) -> None:
     """
     Initializes the Chat Application listening loop
     and the GUI. Get the relevant information from the user
     and creates an account. GRPC / Socket Server Agnostic
 
+    Args:
+        addresses (list): Hosts of the replicas.
+        ports (list): External ports of the replicas.
+
     Returns:
         None
     """
@@ -350,8 +430,8 @@ def Run() -> None:
         password=password,
         fullname=fullname,
         account_status=account_status,
-        addresses=ADDRESSES,
-        ports=PORTS,
+        addresses=addresses,
+        ports=ports,
         application_window=frame)
 
     app.Start()
@@ -359,4 +439,15 @@ def Run() -> None:
 
 if __name__ == '__main__':
     logging.basicConfig()
-    Run()
+    parser = argparse.ArgumentParser(
+        prog='client',
+        description='Chat client, sends requests to the primary of the cluster')
+    parser.add_argument(
+        '--cluster-config',
+        default=None,
+        help="JSON file listing the replicas of the cluster, the default three replicas if not set")
+    args = parser.parse_args()
+    if args.cluster_config is not None:
+        Run(*membership.Membership.load(args.cluster_config).client_addresses())
+    else:
+        Run()
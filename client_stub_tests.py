@@ -6,9 +6,19 @@ from colorama import Fore, Style
 
 import grpc
 
+import chat_pb2
+
 class MockReply:
-    def __init__(self, error_code):
+    def __init__(self, error_code, primary="", term=0):
         self.error_code = error_code
+        self.primary = chat_pb2.PrimaryHint(address=primary, term=term)
+
+class MockRpcError(grpc.RpcError):
+    def __init__(self, code):
+        self.status = code
+
+    def code(self):
+        return self.status
 
 class TestClientStub(unittest.TestCase):
 
@@ -28,7 +38,7 @@ class TestClientStub(unittest.TestCase):
     def test_SendRequest_with_RPC_error(self):
         # Mock ChatServerStub
         mock_stub = MagicMock()
-        mock_stub.CreateAccount.side_effect = grpc.RpcError()
+        mock_stub.CreateAccount.side_effect = MockRpcError(grpc.StatusCode.UNAVAILABLE)
 
         # Create ClientStub with mock ChatServerStub
         client_stub = ClientStub(['localhost'], [50051])
@@ -67,25 +77,93 @@ class TestClientStub(unittest.TestCase):
 
         self.assertEqual(result.val, 100)
 
-    def test_SendRequest_with_Multiple_Primaries(self):
-        # Mock ChatServerStub
+    def test_SendRequest_to_one_server(self):
+        # Requests only go to the server the client takes for the primary
         mock_stub_1 = MagicMock()
         mock_stub_1.CreateAccount.return_value = MockReply(error_code="")
 
         mock_stub_2 = MagicMock()
         mock_stub_2.CreateAccount.return_value = MockReply(error_code="")
 
-        # Create ClientStub with mock ChatServerStub
         client_stub = ClientStub(['localhost', 'localhost'], [50051, 50052])
-
-        # Replace self.stubs with mock_stub
         client_stub.stubs = [mock_stub_1, mock_stub_2]
 
-        # Call SendRequest
-        with self.assertRaises(Exception) as context:
+        for _ in range(3):
             result = client_stub.SendRequest('CreateAccount', {'username': 'test_user', 'password': 'test_password', 'fullname': 'Test User'})
+            self.assertEqual(result.error_code, "")
+        self.assertEqual(mock_stub_1.CreateAccount.call_count, 3)
+        mock_stub_2.CreateAccount.assert_not_called()
 
-        self.assertEqual(str(context.exception), "Two servers believe they are the primary!")
+    def test_SendRequest_follows_redirect(self):
+        # A secondary's reply names the primary, the request and the ones
+        # after it go there directly. A redirect of an older term is ignored.
+        mock_stub_1 = MagicMock()
+        mock_stub_1.CreateAccount.return_value = MockReply(
+            error_code=SECONDARY_ERROR_CODE, primary="localhost:50053", term=2)
+
+        mock_stub_2 = MagicMock()
+
+        mock_stub_3 = MagicMock()
+        mock_reply = MockReply(error_code="")
+        mock_reply.val = 100
+        mock_stub_3.CreateAccount.return_value = mock_reply
+
+        client_stub = ClientStub(['localhost', 'localhost', 'localhost'], [50051, 50052, 50053])
+        client_stub.stubs = [mock_stub_1, mock_stub_2, mock_stub_3]
+
+        result = client_stub.SendRequest('CreateAccount', {'username': 'test_user', 'password': 'test_password', 'fullname': 'Test User'})
+        self.assertEqual(result.val, 100)
+        result = client_stub.SendRequest('CreateAccount', {'username': 'test_user', 'password': 'test_password', 'fullname': 'Test User'})
+        self.assertEqual(result.val, 100)
+        self.assertEqual(mock_stub_1.CreateAccount.call_count, 1)
+        mock_stub_2.CreateAccount.assert_not_called()
+        self.assertEqual(mock_stub_3.CreateAccount.call_count, 2)
+
+        # the primary lost its lease, a server behind names the old primary
+        mock_stub_3.CreateAccount.return_value = MockReply(
+            error_code=SECONDARY_ERROR_CODE, primary="localhost:50051", term=1)
+        mock_stub_1.CreateAccount.return_value = MockReply(error_code="")
+        client_stub.SendRequest('CreateAccount', {'username': 'test_user', 'password': 'test_password', 'fullname': 'Test User'})
+        self.assertEqual(client_stub.primary, 0)
+        self.assertEqual(client_stub.term, 2)
+
+    def test_SendRequest_not_resent_after_timeout(self):
+        # A write that timed out may have been applied, it is not sent to
+        # another server. Reads are, and so are writes that never reached
+        # the server.
+        mock_stub_1 = MagicMock()
+        mock_stub_1.CreateAccount.side_effect = MockRpcError(grpc.StatusCode.DEADLINE_EXCEEDED)
+        mock_stub_1.ListAccounts.side_effect = MockRpcError(grpc.StatusCode.DEADLINE_EXCEEDED)
+        mock_stub_2 = MagicMock()
+        mock_stub_2.ListAccounts.return_value = MockReply(error_code="")
+        mock_stub_2.SendMessage.return_value = MockReply(error_code="")
+
+        client_stub = ClientStub(['localhost', 'localhost'], [50051, 50052])
+        client_stub.stubs = [mock_stub_1, mock_stub_2]
+
+        with self.assertRaises(grpc.RpcError):
+            client_stub.SendRequest('CreateAccount', {'username': 'test_user'})
+        self.assertEqual(mock_stub_1.CreateAccount.call_count, 1)
+        mock_stub_2.CreateAccount.assert_not_called()
+        self.assertEqual(client_stub.SendRequest('ListAccounts', {}).error_code, "")
+        mock_stub_1.SendMessage.side_effect = MockRpcError(grpc.StatusCode.UNAVAILABLE)
+        client_stub.primary = 0
+        self.assertEqual(client_stub.SendRequest('SendMessage', {}).error_code, "")
+        self.assertEqual(mock_stub_2.SendMessage.call_count, 1)
+
+    def test_DeliverMessages_without_deadline(self):
+        # The message stream has no deadline, and the messages received
+        # before it broke are kept
+        def stream(msg, **kwargs):
+            self.assertNotIn("timeout", kwargs)
+            yield MockReply(error_code="")
+            raise MockRpcError(grpc.StatusCode.UNAVAILABLE)
+        mock_stub = MagicMock()
+        mock_stub.DeliverMessages.side_effect = stream
+
+        client_stub = ClientStub(['localhost'], [50051])
+        client_stub.stubs = [mock_stub]
+        self.assertEqual(len(client_stub.SendRequest('DeliverMessages', {})), 1)
 
 if __name__ == "__main__":
     print("Beginning Unit Tests for Client gRPC Stubs")
@@ -93,6 +171,9 @@ if __name__ == "__main__":
     test_obj.test_try_except_RPC_error()
     test_obj.test_SendRequest_with_RPC_error()
     test_obj.test_SendRequest_with_One_Primary_Multiple_Secondaries()
-    test_obj.test_SendRequest_with_Multiple_Primaries()
+    test_obj.test_SendRequest_to_one_server()
+    test_obj.test_SendRequest_follows_redirect()
+    test_obj.test_SendRequest_not_resent_after_timeout()
+    test_obj.test_DeliverMessages_without_deadline()
     print("Final Result:")
-    print(Fore.GREEN + "Passed 4/4 Tests!")
\ No newline at end of file
+    print(Fore.GREEN + "Passed 7/7 Tests!")
\ No newline at end of file
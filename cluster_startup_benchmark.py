@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import grpc
+from colorama import Fore, Style
+
+import chat_pb2
+import chat_pb2_grpc
+import grpc_server
+from replication_benchmark import FreePort, Percentile
+
+# seconds a replica gets to start serving before the trial is given up
+START_TIMEOUT = 30
+
+
+def WriteClusterConfig(path: str, size: int):
+    """
+    Writes the membership file of a loopback cluster of `size` replicas.
+
+    Returns:
+        list: (external port, internal port) of every replica.
+    """
+    ports = [(FreePort(), FreePort()) for _ in range(size)]
+    config = {"version": 1,
+              "replicas": [{"host": "127.0.0.1", "external_port": external, "internal_port": internal}
+                           for external, internal in ports]}
+    with open(path, "w") as config_file:
+        json.dump(config, config_file)
+    return ports
+
+
+def Launch(ports, config_path: str, log_dir: str, first_start: bool):
+    # Starts every replica as its own process, the first one of a new
+    # cluster as primary
+    processes = []
+    for i, (external, internal) in enumerate(ports):
+        position = "p" if first_start and i == 0 else "s"
+        processes.append(subprocess.Popen(
+            [sys.executable, "grpc_server.py", position, external, internal, f"startup{i}",
+             "--cluster-config", config_path, "--log-dir", log_dir],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))))
+    return processes
+
+
+def Probe(ports):
+    """
+    Sends every replica a CreateAccount. Every probe opens a channel of its
+    own, one left in gRPC's reconnect backoff would lag behind the server
+    coming up.
+
+    Returns:
+        (bool, bool): Whether some replica answered at all, and whether
+        one accepted the write.
+    """
+    answered = False
+    for external, _ in ports:
+        with grpc.insecure_channel(f"127.0.0.1:{external}") as channel:
+            try:
+                reply = chat_pb2_grpc.ChatServerStub(channel).CreateAccount(chat_pb2.AccountCreateRequest(
+                    version=1, username=uuid.uuid4().hex[:12], password="password", fullname="probe"), timeout=0.5)
+            except grpc.RpcError:
+                continue
+        answered = True
+        if reply.error_code != grpc_server.SECONDARY_ERROR_CODE:
+            return True, True
+    return answered, False
+
+
+def TimeToServing(ports, config_path: str, log_dir: str, first_start: bool):
+    """
+    Launches the replicas and probes them until one of them accepts a
+    write.
+
+    Returns:
+        (float, float, list): Seconds from launch until the first replica
+        answered and until the cluster served a write, and the replica
+        processes.
+    """
+    start = time.perf_counter()
+    processes = Launch(ports, config_path, log_dir, first_start)
+    answered_at = None
+    while True:
+        answered, serving = Probe(ports)
+        if answered and answered_at is None:
+            answered_at = time.perf_counter() - start
+        if serving:
+            return answered_at, time.perf_counter() - start, processes
+        if time.perf_counter() - start > START_TIMEOUT:
+            raise RuntimeError(f"No replica served within {START_TIMEOUT} s")
+        time.sleep(0.005)
+
+
+def Stop(processes):
+    for process in processes:
+        process.send_signal(signal.SIGKILL)
+    for process in processes:
+        process.wait()
+
+
+def Run(trials: int, size: int) -> None:
+    """
+    Measures how long a cluster of `size` replica processes takes from
+    launch to serving, started for the first time and restarted with the
+    state and terms of an earlier run. The time until the first replica
+    answers at all is reported separately, it is spent starting the
+    interpreter and loading gRPC.
+    """
+    results = {"first start": ([], []), "restart": ([], [])}
+    for trial in range(trials):
+        log_dir = tempfile.mkdtemp()
+        config_path = os.path.join(log_dir, "cluster.json")
+        ports = WriteClusterConfig(config_path, size)
+        for name, first_start in (("first start", True), ("restart", False)):
+            answered, serving, processes = TimeToServing(ports, config_path, log_dir, first_start)
+            results[name][0].append(answered)
+            results[name][1].append(serving - answered)
+            Stop(processes)
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+    print(f"{trials} starts of a {size} replica cluster, each replica its own process")
+    print(f"{'':<14}{'process up p50 (ms)':>21}{'then serving p50 (ms)':>23}{'max (ms)':>10}")
+    for name, (answered, serving) in results.items():
+        print(f"{name:<14}{Percentile(answered, 0.5) * 1000:>21.0f}{Percentile(serving, 0.5) * 1000:>23.0f}"
+              f"{max(serving) * 1000:>10.0f}")
+
+    # the interpreter and gRPC start up before a replica can do anything,
+    # the handshake starts once the first one answers
+    if max(max(serving) for _, serving in results.values()) < 1.0:
+        print(Fore.GREEN + "The cluster served within a second of coming up" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "The cluster took a second or more to serve after coming up" + Style.RESET_ALL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='cluster_startup_benchmark',
+        description='Measures the time from launching the replica processes of a loopback cluster to '
+                    'the first write it serves')
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--replicas', type=int, default=3)
+    args = parser.parse_args()
+    Run(args.trials, args.replicas)
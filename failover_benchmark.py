@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import random
+import shutil
+import statistics
+import tempfile
+import threading as th
+import time
+
+from colorama import Fore, Style
+
+import grpc_server
+import membership
+from grpc_server import ChatServer, ServerInterface, ServerState
+from replication_benchmark import FreePort, OnLoop, Percentile
+
+
+async def LateHeartbeats(interface: ServerInterface, longest: float, gaps: list):
+    # Heartbeat task of a replica on a busy host, whose ticks come up to
+    # `longest` seconds apart. Records the gaps between the ticks of a
+    # primary.
+    last = None
+    while True:
+        await asyncio.sleep(random.uniform(grpc_server.REFRESH_TIME, longest))
+        if interface.servicer_object.server_state == ServerState.PRIMARY:
+            now = time.perf_counter()
+            if last is not None:
+                gaps.append(now - last)
+            last = now
+        else:
+            last = None
+        interface.Tick()
+
+
+def StartCluster(loop, log_dir: str, size: int, longest_tick=None, gaps=None):
+    """
+    Starts `size` replicas as secondaries in this process, connected to each
+    other over loopback, with heartbeats and elections running like on a
+    real deployment, and waits until they elected a primary. With
+    `longest_tick` the replicas tick at random intervals up to that long,
+    and the gaps between a primary's ticks are added to `gaps`.
+
+    Returns:
+        (list, list, float): The interfaces of the replicas, their heartbeat
+        tasks, and the seconds the first election took.
+    """
+    ports = [FreePort() for _ in range(size)]
+    members = [membership.Replica("127.0.0.1", "0", port) for port in ports]
+    interfaces = []
+    for i, port in enumerate(ports):
+        servicer = ChatServer(ServerState.SECONDARY, f"failover{i}", log_dir=log_dir)
+        servicer.membership = membership.Membership(members)
+        interface = ServerInterface(servicer, port)
+        interface.attach_loop(loop)
+        OnLoop(interface, interface.init_listening_interface())
+        interfaces.append(interface)
+    for interface in interfaces:
+        for port in ports:
+            if port != interface.port:
+                OnLoop(interface, interface.ConnectPeer(port, f"127.0.0.1:{port}"))
+    while not all(stream.ready for interface in interfaces for stream in interface.heartbeat_dict.values()):
+        time.sleep(0.01)
+
+    async def Start():
+        for interface in interfaces:
+            interface.StartElections()
+        if longest_tick is not None:
+            return [loop.create_task(LateHeartbeats(interface, longest_tick, gaps)) for interface in interfaces]
+        return [loop.create_task(interface.heartbeat_task()) for interface in interfaces]
+    start = time.perf_counter()
+    tasks = OnLoop(interfaces[0], Start())
+    while len(Primaries(interfaces)) == 0:
+        time.sleep(0.001)
+    return interfaces, tasks, time.perf_counter() - start
+
+
+def Primaries(interfaces):
+    return [interface for interface in interfaces
+            if interface.servicer_object.server_state == ServerState.PRIMARY]
+
+
+def Crash(interface: ServerInterface, task):
+    # Stops a replica as if its process died: no more heartbeats, votes or
+    # connections
+    async def Stop():
+        task.cancel()
+        interface.elections = False
+        interface.servicer_object.server_state = ServerState.BROKEN
+        await interface.ClosePeers()
+        await interface.replication_server.stop(None)
+    OnLoop(interface, Stop())
+
+
+def StopCluster(interfaces, tasks):
+    for interface, task in zip(interfaces, tasks):
+        if interface.servicer_object.server_state != ServerState.BROKEN:
+            Crash(interface, task)
+        interface.servicer_object.wal.close()
+
+
+def MeasureFailover(interfaces, tasks):
+    """
+    Crashes the primary and waits until the survivors elected a new one, all
+    of them follow it, and it holds a lease.
+
+    Returns:
+        (float, float, float): Seconds until a new primary was elected, until
+        every survivor knew it and until the new primary served requests.
+    """
+    old = Primaries(interfaces)[0]
+    survivors = [interface for interface in interfaces if interface is not old]
+    start = time.perf_counter()
+    Crash(old, tasks[interfaces.index(old)])
+    while len(Primaries(survivors)) == 0:
+        time.sleep(0.001)
+    elected = time.perf_counter() - start
+    new = Primaries(survivors)[0]
+    while not all(interface is new or interface.KnownPrimary() == new.port for interface in survivors):
+        time.sleep(0.001)
+    converged = time.perf_counter() - start
+    while not new.servicer_object.has_lease():
+        time.sleep(0.001)
+    return elected, converged, time.perf_counter() - start
+
+
+def MeasureLateTicks(loop, size: int, longest_tick: float, seconds: float):
+    """
+    Runs a cluster whose replicas tick up to `longest_tick` apart for
+    `seconds`, after a warm-up in which the failure detectors learn the
+    intervals.
+
+    Returns:
+        (int, int): The gaps between the primary's heartbeats longer than
+        the longest election timeout, each of which would have started an
+        election without the failure detector, and the elections held.
+    """
+    log_dir = tempfile.mkdtemp()
+    gaps = []
+    interfaces, tasks, _ = StartCluster(loop, log_dir, size, longest_tick, gaps)
+    time.sleep(2)
+    gaps.clear()
+    term = max(interface.servicer_object.term for interface in interfaces)
+    time.sleep(seconds)
+    elections = max(interface.servicer_object.term for interface in interfaces) - term
+    late = len([gap for gap in gaps if gap > grpc_server.ELECTION_TIMEOUT_MAX])
+    StopCluster(interfaces, tasks)
+    shutil.rmtree(log_dir, ignore_errors=True)
+    return late, elections
+
+
+def Run(trials: int, size: int, longest_tick: float, seconds: float) -> None:
+    """
+    Measures how long a cluster of `size` replicas is without a primary after
+    its primary dies.
+    """
+    loop = asyncio.new_event_loop()
+    th.Thread(target=loop.run_forever, daemon=True).start()
+    first_elections, elections, convergences, leases = [], [], [], []
+    for trial in range(trials):
+        log_dir = tempfile.mkdtemp()
+        interfaces, tasks, first_election = StartCluster(loop, log_dir, size)
+        elected, converged, leased = MeasureFailover(interfaces, tasks)
+        first_elections.append(first_election)
+        elections.append(elected)
+        convergences.append(converged)
+        leases.append(leased)
+        StopCluster(interfaces, tasks)
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+    print(f"{trials} failovers of a {size} replica cluster, heartbeat every {grpc_server.REFRESH_TIME * 1000:.0f} ms, "
+          f"election timeout {grpc_server.ELECTION_TIMEOUT_MIN * 1000:.0f}-{grpc_server.ELECTION_TIMEOUT_MAX * 1000:.0f} ms")
+    print(f"{'':<22}{'p50 (ms)':>10}{'p99 (ms)':>10}{'max (ms)':>10}{'mean (ms)':>11}")
+    for name, times in (("first election", first_elections),
+                        ("new primary elected", elections),
+                        ("all replicas follow", convergences),
+                        ("new primary serves", leases)):
+        print(f"{name:<22}{Percentile(times, 0.5) * 1000:>10.1f}{Percentile(times, 0.99) * 1000:>10.1f}"
+              f"{max(times) * 1000:>10.1f}{statistics.mean(times) * 1000:>11.1f}")
+
+    if max(leases) < 1.0:
+        print(Fore.GREEN + "Every failover finished within a second" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "Some failovers took a second or more" + Style.RESET_ALL)
+
+    late, needless = MeasureLateTicks(loop, size, longest_tick, seconds)
+    print(f"Ticks up to {longest_tick * 1000:.0f} ms apart for {seconds:.0f} s: {late} heartbeat gaps of the primary "
+          f"longer than the election timeout, {needless} elections")
+    if needless < late:
+        print(Fore.GREEN + "The failure detector kept late heartbeats from deposing the primary" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "Late heartbeats deposed the primary" + Style.RESET_ALL)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='failover_benchmark',
+        description='Measures the time from a primary crash to a new primary on a loopback cluster')
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--longest-tick', type=float, default=0.4,
+                        help="seconds between the ticks of the replicas of a busy cluster, at most")
+    parser.add_argument('--seconds', type=float, default=10,
+                        help="seconds the busy cluster is watched for elections")
+    args = parser.parse_args()
+    Run(args.trials, args.replicas, args.longest_tick, args.seconds)
@@ -0,0 +1,135 @@
+import math
+import threading as th
+import time
+from collections import deque
+
+# heartbeat inter-arrival times remembered per peer
+DEFAULT_WINDOW = 100
+# lower bound of the standard deviation of the intervals, a peer that has
+# sent perfectly regular heartbeats is not suspected the moment one is late
+DEFAULT_MIN_STD = 0.010
+# phi at which a peer is suspected, the chance that a heartbeat this late
+# still comes is then about 10^-8
+DEFAULT_THRESHOLD = 8.0
+# a gap longer than this is a restart or a healed partition rather than a
+# sample of the peer's heartbeat interval, it is not learned
+DEFAULT_MAX_INTERVAL = 2.0
+
+
+class HeartbeatHistory:
+    """
+    The last `window` inter-arrival times of one peer's heartbeats, with
+    running sums for their mean and standard deviation.
+    """
+
+    def __init__(self, window, first_interval):
+        self.intervals = deque()
+        self.window = window
+        self.total = 0.0
+        self.squares = 0.0
+        self.add(first_interval)
+
+    def add(self, interval):
+        if len(self.intervals) == self.window:
+            dropped = self.intervals.popleft()
+            self.total -= dropped
+            self.squares -= dropped * dropped
+        self.intervals.append(interval)
+        self.total += interval
+        self.squares += interval * interval
+
+    def mean(self):
+        return self.total / len(self.intervals)
+
+    def std(self):
+        mean = self.mean()
+        return math.sqrt(max(0.0, self.squares / len(self.intervals) - mean * mean))
+
+
+class PhiAccrualDetector:
+    """
+    Phi accrual failure detector (Hayashibara et al., as in Cassandra and
+    Akka). Rather than declaring a peer dead after a fixed timeout, it
+    learns the distribution of the intervals between the peer's heartbeats
+    and reports how unlikely it is that the peer is still alive given the
+    time since its last one:
+
+        phi = -log10(P(a heartbeat arrives later than now))
+
+    with the intervals taken as normally distributed. A peer whose
+    heartbeats have been regular is suspected soon after one is late, one
+    whose heartbeats come with pauses (garbage collection, large sends on a
+    busy host) is given correspondingly longer.
+
+    Peers are keyed by port. Until a peer's history has more samples, its
+    intervals are assumed to be `expected_interval`.
+    """
+
+    def __init__(self,
+                 expected_interval,
+                 threshold=DEFAULT_THRESHOLD,
+                 window=DEFAULT_WINDOW,
+                 min_std=DEFAULT_MIN_STD,
+                 max_interval=DEFAULT_MAX_INTERVAL):
+        self.expected_interval = expected_interval
+        self.threshold = threshold
+        self.window = window
+        self.min_std = min_std
+        self.max_interval = max_interval
+        # port -> time.monotonic() of the last heartbeat, HeartbeatHistory
+        self.last_arrival = {}
+        self.histories = {}
+        # heartbeats arrive on the event loop, suspicion is also read by
+        # request threads
+        self.lock = th.Lock()
+
+    def heartbeat(self, port, now=None):
+        """
+        Records a heartbeat from the peer at `port`.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            last = self.last_arrival.get(port)
+            self.last_arrival[port] = now
+            if port not in self.histories:
+                self.histories[port] = HeartbeatHistory(self.window, self.expected_interval)
+            elif now - last <= self.max_interval:
+                self.histories[port].add(now - last)
+
+    def phi(self, port, now=None):
+        """
+        Returns:
+            float: The suspicion level of the peer at `port`, 0 if it has
+            never been heard from and there is nothing to go by.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if port not in self.last_arrival:
+                return 0.0
+            elapsed = now - self.last_arrival[port]
+            history = self.histories[port]
+            mean, std = history.mean(), max(history.std(), self.min_std)
+        # logistic approximation of the normal distribution, written so
+        # that neither branch overflows
+        y = (elapsed - mean) / std
+        z = y * (1.5976 + 0.070566 * y * y)
+        if z > 0:
+            return (z + math.log1p(math.exp(-z))) / math.log(10)
+        return math.log1p(math.exp(z)) / math.log(10)
+
+    def suspected(self, port, now=None):
+        return self.phi(port, now) >= self.threshold
+
+    def suspicion(self, now=None):
+        """
+        Returns:
+            dict: port -> phi of every peer heard from.
+        """
+        with self.lock:
+            ports = list(self.last_arrival)
+        return {port: self.phi(port, now) for port in ports}
+
+    def remove(self, port):
+        with self.lock:
+            self.last_arrival.pop(port, None)
+            self.histories.pop(port, None)
@@ -14,28 +14,109 @@ from collections import defaultdict
 from concurrent import futures
 import time 
 import json
+import itertools
+import asyncio
+import zlib
+from collections import OrderedDict, deque
+from functools import partial
+from collections.abc import Mapping
 import grpc
-from _thread import *
-import socket
-import wire_protocol as wp
+import storage
 import random
+import membership
+import failure_detector
 
 SECONDARY_ERROR_CODE = "Secondary server response"
-INITIALIZE_WAIT_TIME = 10
-REFRESH_TIME = 0.250
-ELECTION_CHECK_TIME = 2 * REFRESH_TIME
-ELECTION_ITERS = 100
-
-
-EXTERNAL_SERVER_ADDRS = [("10.250.21.56", '50051'),
-                         ('10.250.156.238', '50052'), ('10.250.156.238', '50053')]
-INTERNAL_SERVER_ADDRS = [("10.250.21.56", '50054'),
-                         ('10.250.156.238', '50055'), ('10.250.156.238', '50056')]
-
-# EXTERNAL_SERVER_ADDRS = [("0.0.0.0", '50051'),
-#                          ('0.0.0.0', '50052'), ('0.0.0.0', '50053')]
-# INTERNAL_SERVER_ADDRS = [("0.0.0.0", '50054'),
-#                          ('0.0.0.0', '50055'), ('0.0.0.0', '50056')]
+# trailing metadata of a call a secondary turned down: the address of the
+# primary it knows of, and its term
+PRIMARY_ADDRESS_KEY = "primary-address"
+PRIMARY_TERM_KEY = "primary-term"
+# heartbeats are sent every tick
+REFRESH_TIME = 0.050
+# a replica that has not heard from the primary of its term for a random
+# time in this range stands for election in the next term. The range is
+# several heartbeats wide so that candidates rarely split the vote.
+ELECTION_TIMEOUT_MIN = 0.150
+ELECTION_TIMEOUT_MAX = 0.300
+# once the election timeout runs out, a replica only stands if the failure
+# detector suspects the primary, that is if the primary's heartbeats are
+# later than the ones it learned from it make likely. A primary that pauses
+# now and then is not deposed for it, a regular one is suspected about
+# 100 ms after its last heartbeat.
+PHI_THRESHOLD = failure_detector.DEFAULT_THRESHOLD
+# ticks between the status lines a server prints
+STATUS_PRINT_ITERS = 20
+# a primary holds a lease until LEASE_TIME after sending the last heartbeat
+# a majority acknowledged. Replicas that heard from the primary within
+# ELECTION_TIMEOUT_MIN do not vote, so no other primary can be elected
+# before then. The margin covers clocks running at slightly different rates.
+LEASE_TIME = 0.9 * ELECTION_TIMEOUT_MIN
+# heartbeats whose send time the primary remembers for their acks
+HEARTBEATS_KEPT = 64
+# committed operations the primary keeps in memory for shipping to
+# secondaries, a secondary further behind is resynced with a full state
+REPLICATION_BACKLOG = 10000
+# operations shipped to a secondary in one message
+OPS_PER_MESSAGE = 64
+# ticks without an acknowledgement before operations are sent again, or
+# without a snapshot chunk before a catch-up transfer is requested again
+RETRANSMIT_ITERS = 40
+# catch-up snapshots are sent in chunks of SNAPSHOT_CHUNK_BYTES, at most
+# SNAPSHOT_WINDOW_CHUNKS of them per request
+SNAPSHOT_CHUNK_BYTES = 256 * 1024
+SNAPSHOT_WINDOW_CHUNKS = 4
+
+# when the primary replies to a write: right away, once one secondary
+# acknowledged it, or once every secondary did
+REPLICATION_ASYNC = "async"
+REPLICATION_SEMI_SYNC = "semi-sync"
+REPLICATION_SYNC = "sync"
+REPLICATION_MODES = (REPLICATION_ASYNC, REPLICATION_SEMI_SYNC, REPLICATION_SYNC)
+DEFAULT_REPLICATION_MODE = REPLICATION_ASYNC
+# seconds a write waits for acknowledgements before it is replied to anyway,
+# kept below the client's REQUEST_TIMEOUT so the reply arrives in time
+DEFAULT_REPLICATION_TIMEOUT = 1.0
+# writes that may wait for acknowledgements at the same time. Every waiting
+# write holds a gRPC worker thread for up to the replication timeout, so the
+# server gets this many workers on top of RPC_WORKERS, and a write finding
+# all of them taken is replied to right away, as if its wait had timed out.
+# With the secondaries down, a primary in sync mode therefore replies after
+# waiting to at most waiters / replication timeout writes per second.
+DEFAULT_REPLICATION_WAITERS = 32
+# gRPC worker threads left for requests that do not wait for replication
+RPC_WORKERS = 10
+
+# replicas talk to each other over the ReplicationService, operation batches
+# and snapshot chunks may exceed gRPC's default 4MB message limit
+REPLICATION_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+]
+REPLICATION_COMPRESSION = grpc.Compression.Gzip
+# messages waiting to be sent to one peer, further ones are dropped until
+# the stream catches up, the replication protocol sends them again
+PEER_QUEUE_SIZE = 256
+# seconds between attempts to reopen a broken stream to a peer
+PEER_RECONNECT_TIME = REFRESH_TIME
+# a peer that is not up yet is dialled again after PEER_BACKOFF_MIN, backing
+# off to at most PEER_BACKOFF_MAX between attempts. gRPC's own backoff grows
+# to two minutes, a replica started late would go unnoticed for that long.
+# A connection attempt is given up after PEER_CONNECT_TIMEOUT rather than
+# gRPC's 20 s, a peer whose port is bound before its server is started
+# accepts the connection but does not answer it.
+PEER_BACKOFF_MIN = 0.020
+PEER_BACKOFF_MAX = 0.100
+PEER_CONNECT_TIMEOUT = 1.0
+PEER_CHANNEL_OPTIONS = REPLICATION_CHANNEL_OPTIONS + [
+    ("grpc.initial_reconnect_backoff_ms", int(PEER_BACKOFF_MIN * 1000)),
+    ("grpc.max_reconnect_backoff_ms", int(PEER_BACKOFF_MAX * 1000)),
+    ("grpc.min_reconnect_backoff_ms", int(PEER_CONNECT_TIMEOUT * 1000)),
+]
+# heartbeats and election messages travel on a connection of their own so
+# they never wait behind operations or snapshot chunks, only the newest
+# HEARTBEAT_QUEUE_SIZE of them wait to be sent
+HEARTBEAT_QUEUE_SIZE = 8
+HEARTBEAT_CHANNEL_OPTIONS = PEER_CHANNEL_OPTIONS + [("grpc.use_local_subchannel_pool", 1)]
 
 
 class ServerState(Enum):
@@ -45,21 +126,58 @@ class ServerState(Enum):
     ELECTION = 4
 
 
+def json_default(value):
+    # Encodes the mappings and inboxes of storage backends that are not
+    # plain dictionaries and lists
+    if isinstance(value, Mapping):
+        return dict(value)
+    return list(value)
+
+
 class ChatServer(chat_pb2_grpc.ChatServerServicer):
-    def __init__(self, position, log_filename) -> None:
+    def __init__(self,
+                 position,
+                 log_filename,
+                 log_dir="logs",
+                 durability=storage.wal.DEFAULT_DURABILITY,
+                 wal_batch_window=storage.wal.DEFAULT_BATCH_WINDOW,
+                 wal_queue_size=storage.wal.DEFAULT_QUEUE_SIZE,
+                 lazy_inboxes=True,
+                 inbox_segments=False,
+                 storage_backend=storage.backends.DEFAULT_BACKEND,
+                 sqlite_batch=storage.backends.DEFAULT_SQLITE_BATCH,
+                 replication_mode=DEFAULT_REPLICATION_MODE,
+                 replication_timeout=DEFAULT_REPLICATION_TIMEOUT,
+                 replication_waiters=DEFAULT_REPLICATION_WAITERS,
+                 cluster=None) -> None:
         super().__init__()
-        self.user_inbox = defaultdict(lambda: [])
+        if inbox_segments and storage_backend != storage.backends.BACKEND_MEMORY:
+            raise ValueError("Inbox segment files are only used with the memory backend")
+        if replication_mode not in REPLICATION_MODES:
+            raise ValueError(f"Unknown replication mode: {replication_mode}")
+        # the three mappings below live in dictionaries or in a SQLite
+        # database, depending on the storage backend
+        self.storage = storage.backends.open_backend(
+            storage_backend,
+            sqlite_path=f"{log_dir}/state_store_{log_filename}.db",
+            sqlite_batch=sqlite_batch)
+        user_metadata_store, token_hub, user_inbox = self.storage.create()
+
+        # inboxes are kept in per-user segment files under inbox_dir with
+        # inbox_segments, and as lists in memory otherwise
+        self.inbox_dir = f"{log_dir}/inboxes_{log_filename}" if inbox_segments else None
+        self.user_inbox = self.make_inboxes(user_inbox)
 
         # format of metadata store
         # key - username (must be unique)
         # per value entry (password, name)
-        self.user_metadata_store = {}
+        self.user_metadata_store = user_metadata_store
         self.token_length = 15
         self.server_state = position
 
         # token hub keys are usernames and the values are token, timestamp
         # pairs
-        self.token_hub = {}
+        self.token_hub = token_hub
 
         # keeping track of time by standardizing to UTC
         self.utc_time_gen = datetime.datetime
@@ -70,70 +188,835 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
         # inbox lock
         self.inbox_lock = th.Lock()
 
+        # serializes applying an operation with assigning its state version
+        # and WAL sequence
+        self.version_lock = th.Lock()
+
+        # innermost lock, guards the backlog below together with wal_seq and
+        # install_point. Only held for a few instructions, the event loop
+        # takes it to ship operations
+        self.backlog_lock = th.Lock()
+
+        # monotonically increasing version of the state, bumped by every
+        # operation
+        self.state_version = 0
+
+        # the last committed operations, as WAL records, for shipping to
+        # secondaries while primary. Each record keeps its origin, the
+        # (primary, WAL sequence) it was shipped as, None if committed here.
+        self.op_backlog = deque(maxlen=REPLICATION_BACKLOG)
+        # the origin of the last state installed and the WAL sequence it was
+        # installed at, this server's log describes the state from there on
+        self.install_point = (None, 0)
+        # while secondary, the primary whose operations are applied and the
+        # last of its WAL sequences applied here. A primary follows its own
+        # log, and so does a deposed one until it follows another primary.
+        self.replication_source = None
+        self.replicated_seq = 0
+        # while primary, the snapshot secondaries catching up download
+        self.transfer_snapshot = None
+
+        # while primary, writes are replied to once the secondaries the
+        # replication mode asks for acknowledged them, replicas holds the
+        # secondaries and replica_acks the last WAL sequence each of them
+        # acknowledged
+        self.replication_mode = replication_mode
+        self.replication_timeout = replication_timeout
+        # taken by every write waiting for acknowledgements
+        self.replication_waiters = th.BoundedSemaphore(replication_waiters)
+        self.replicas = set()
+        self.replica_acks = {}
+        self.ack_condition = th.Condition()
+        # called after an operation commits, wakes the task shipping
+        # operations
+        self.on_commit = None
+
+        # the replicas of the cluster, changed through AddReplica and
+        # RemoveReplica while primary. on_membership_change tells the
+        # interface to connect to the new membership.
+        self.membership = cluster if cluster is not None else membership.Membership()
+        self.on_membership_change = None
+        # port of this replica's replication service, set by its interface.
+        # known_primary returns the internal port of the primary the
+        # interface knows of, for the redirect hints of secondary replies.
+        self.internal_port = None
+        self.known_primary = None
+        # replica_live tells whether the secondary at a port is connected and
+        # not suspected down, only those are waited for by a write.
+        self.replica_live = None
+
+        # the election term this server is in, the replica it voted for in
+        # that term, and the term of the primary whose state it holds. Kept
+        # in a file so that a restarted server never votes twice in a term.
+        self.election_file = f"{log_dir}/election_{log_filename}.json"
+        self.election_lock = th.Lock()
+        self.term = 0
+        self.voted_for = None
+        self.data_term = 0
+        # while primary, the time.monotonic() until which no other primary
+        # can have been elected. None while leases are not in use, when no
+        # server interface runs elections for this server.
+        self.lease_expiry = None
+
         # where to store state in case of being primary
-        self.state_file = f"logs/state_store_{log_filename}.txt"
+        self.state_file = f"{log_dir}/state_store_{log_filename}.txt"
+        # the snapshot handed out to secondaries catching up
+        self.transfer_file = f"{log_dir}/transfer_{log_filename}.snap"
         self.state_save_time = None
-
-        self.commit_log_path = "logs/commit_log.txt"
-
-        if os.path.exists(self.state_file):
+        self.prev_commit_hash = None
+
+        # one record per snapshot written, with the checksum of its contents
+        self.commit_log = storage.commitlog.CommitLog(f"{log_dir}/commits_{log_filename}")
+
+        # every mutation is appended to the write-ahead log, the state file
+        # only holds a snapshot and the last log sequence it covers
+        self.wal = storage.wal.WriteAheadLog(
+            f"{log_dir}/wal_{log_filename}",
+            durability=durability,
+            batch_window=wal_batch_window,
+            queue_size=wal_queue_size)
+        self.wal_seq = 0
+        self.read_election_state()
+        if self.term > 0 and self.server_state == ServerState.PRIMARY:
+            # the cluster elected primaries since it was first started, this
+            # server has to win an election like any other
+            print(f"Starting as secondary in term {self.term}")
+            self.server_state = ServerState.SECONDARY
+        # WAL sequence covered by the snapshot on disk
+        self.snapshot_seq = 0
+        # snapshots are written one at a time and in state version order,
+        # also when written from copies after the state locks are released
+        self.snapshot_lock = th.Lock()
+        self.snapshot_version = 0
+        # inboxes of an indexed snapshot are read when first touched and
+        # loaded in the background by the warm-up thread
+        self.lazy_inboxes = lazy_inboxes
+        self.warm_up_thread = None
+
+        recovery_start = time.perf_counter()
+        # the last intact commit is found through the commit log index
+        last_commit = self.commit_log.last_commit
+        recovered = self.storage.recovered()
+        if recovered is not None:
+            # the database already holds the state, no snapshot to load
+            self.install_recovered_state(recovered)
+        elif os.path.exists(self.state_file):
+            if not self.snapshot_file_intact(last_commit):
+                # the operations the snapshot covers are no longer in the
+                # log, starting without them would lose committed writes
+                raise storage.snapshot.SnapshotError(
+                    f"{self.state_file} does not match the checksum of commit {last_commit['id']} "
+                    f"(WAL seq {last_commit['wal_seq']}), restore the snapshot or catch up from the primary "
+                    f"after removing it")
             self.read_state_from_file()
-    
+        replayed = self.replay_wal()
+        self.recovery_time = time.perf_counter() - recovery_start
+        print(f"Recovered state in {self.recovery_time * 1000:.1f} ms "
+              f"(snapshot seq {self.snapshot_seq}, replayed {replayed} WAL records)")
+        if last_commit is not None:
+            self.prev_commit_hash = last_commit["checksum"]
+            if last_commit["wal_seq"] != self.snapshot_seq:
+                print(f"Last commit {last_commit['id']} covers WAL seq {last_commit['wal_seq']}, "
+                      f"the loaded state covers {self.snapshot_seq}")
+        if isinstance(self.user_inbox, storage.lazy.LazyInboxes) and len(self.user_inbox.pending) > 0:
+            # the inboxes nobody asked for yet are loaded in the background
+            print(f"Loading {len(self.user_inbox.pending)} inboxes in the background")
+            self.warm_up_thread = self.user_inbox.start_warm_up(self.inbox_lock)
+
+    def state_dict(self):
+        # Caller must hold both locks
+        return {
+            "time": self.state_save_time,
+            "user_inbox": self.user_inbox,
+            "user_metadata_store": self.user_metadata_store,
+            "token_hub": self.token_hub,
+            "commit_hash": self.prev_commit_hash
+            }
+
     def get_state(self):
         # Returns state as a string that can be set by other servers
         with self.metadata_lock:
             with self.inbox_lock:
                 self.state_save_time = time.time()
-                self.prev_commit_hash = hash(self.state_save_time)
-                return json.dumps(
-                    {
-                    "time": self.state_save_time,
-                    "user_inbox": self.user_inbox,
-                    "user_metadata_store": self.user_metadata_store, 
-                    "token_hub": self.token_hub,
-                    "commit_hash": self.prev_commit_hash
-                    })
+                return json.dumps(self.state_dict(), default=json_default)
 
     def get_state_time_created(self, state):
         try:
             tm = json.loads(state)["time"]
         except:
             tm = 0 
-            log_file = open(self.commit_log_path, "a")  # append mode
-            log_file.write(f"Failing state: {state}\n")
-            log_file.close()
+            self.commit_log.error(f"Failing state: {state}")
         return tm
     
+    def make_inboxes(self, user_inbox):
+        # Moves a username -> messages mapping to the configured inbox storage
+        if self.inbox_dir is None or isinstance(user_inbox, storage.inbox.SegmentInboxes):
+            return user_inbox
+        inboxes = storage.inbox.SegmentInboxes(self.inbox_dir)
+        for username, messages in user_inbox.items():
+            inboxes[username] = messages
+        return inboxes
+
+    def install_state(self, state, origin=None):
+        # Caller must hold both locks. `origin` is the (primary, WAL
+        # sequence) the state was shipped at, None if it was not shipped
+        self.user_metadata_store, self.token_hub, self.user_inbox = self.storage.install(
+            state["user_metadata_store"],
+            state["token_hub"],
+            self.make_inboxes(state["user_inbox"]))
+        self.state_save_time = state["time"]
+        with self.version_lock:
+            self.state_version = max(self.state_version + 1, state.get("state_version", 0))
+            with self.backlog_lock:
+                # the installed state replaces everything the local log
+                # describes, and operations from before it cannot be
+                # replayed on top of it
+                self.wal_seq = self.wal.last_seq
+                self.op_backlog.clear()
+                self.install_point = (origin, self.wal_seq)
+
+    def get_transfer_snapshot(self, source):
+        """
+        Returns the snapshot secondaries catching up download in chunks, as a
+        dict with its id, the WAL sequence it covers, the path of the
+        indexed snapshot file, its size and its CRC32. `source` is the
+        internal port of this server.
+
+        The same snapshot is handed out, so that interrupted transfers can
+        resume, for as long as the operations after it are in the backlog.
+        A new one is written like a checkpoint, from a copy of the state
+        taken under the locks. Only called on the state worker.
+        """
+        with self.metadata_lock:
+            with self.inbox_lock:
+                snapshot = self.transfer_snapshot
+                if (snapshot is not None and snapshot["source"] == source
+                        and self.ops_after(snapshot["wal_seq"], limit=0) is not None):
+                    return snapshot
+                state = self.copy_state()
+                seq = self.wal_seq
+        try:
+            checksum = self.encode_snapshot_file(self.transfer_file, state, seq)
+        finally:
+            if isinstance(state["user_inbox"], (storage.inbox.FrozenInboxes, storage.lazy.FrozenLazyInboxes)):
+                state["user_inbox"].close()
+        snapshot = {
+            "id": f"{seq}-{checksum:08x}",
+            "source": source,
+            "wal_seq": seq,
+            "path": self.transfer_file,
+            "size": os.path.getsize(self.transfer_file),
+            "checksum": checksum,
+            }
+        self.transfer_snapshot = snapshot
+        return snapshot
+
+    def install_transfer_snapshot(self, path, source):
+        """
+        Installs a snapshot file downloaded from the primary at `source`,
+        whatever its time. The users are decoded one at a time before the
+        locks are taken, and the operations the primary ships are applied
+        from the snapshot's WAL sequence on. The installed state is written
+        as this server's snapshot from a copy, after the locks are released.
+        Only called on the state worker, which applies the shipped
+        operations only once it is written.
+
+        Returns:
+            bool: False if the file cannot be read.
+        """
+        try:
+            header, users, _ = storage.snapshot.read_snapshot_file(path)
+            user_metadata_store, token_hub, user_inbox = {}, {}, defaultdict(list)
+            for username, metadata, token, inbox in users:
+                user_metadata_store[username] = metadata
+                token_hub[username] = token
+                if len(inbox) > 0:
+                    user_inbox[username] = inbox
+        except Exception as e:
+            self.commit_log.error(f"Failing snapshot from {source}: {path} ({e})")
+            return False
+        with self.metadata_lock:
+            with self.inbox_lock:
+                self.install_state({
+                    "time": header["time"],
+                    "state_version": header["state_version"],
+                    "user_inbox": user_inbox,
+                    "user_metadata_store": user_metadata_store,
+                    "token_hub": token_hub,
+                    }, origin=(source, header["wal_seq"]))
+                self.replication_source = source
+                self.replicated_seq = header["wal_seq"]
+                # persisted before new operations build on it
+                state, seq = self.freeze_snapshot()
+        self.write_frozen_snapshot(state, seq)
+        return True
+
     def set_state(self, state):
         # Accepts string and sets state
         with self.metadata_lock:
             with self.inbox_lock:
                 try:
-                    state = json.loads(state)
-                    self.user_inbox = state["user_inbox"]
-                    self.user_metadata_store = state["user_metadata_store"]
-                    self.token_hub = state["token_hub"]
-                    self.state_save_time = state["time"]
+                    self.install_state(json.loads(state))
                 except:
-                    log_file = open(self.commit_log_path, "a")  # append mode
-                    log_file.write(f"Failing state: {state}\n")
-                    log_file.close()
-    
+                    self.commit_log.error(f"Failing state: {state}")
+                    return
+                # persisted before new operations build on it
+                frozen, seq = self.freeze_snapshot()
+        self.write_frozen_snapshot(frozen, seq)
+
+    def encode_snapshot_file(self, path, state, seq):
+        # Writes an indexed snapshot of state covering the WAL up to seq to
+        # path and returns its CRC32, the rename makes the switch to the new
+        # file atomic
+        writer = storage.snapshot.SnapshotWriter(
+            path,
+            time=state["time"],
+            state_version=state["state_version"],
+            wal_seq=seq)
+        try:
+            # users are encoded and compressed one at a time
+            for username, metadata in state["user_metadata_store"].items():
+                writer.write_user(
+                    username, metadata, state["token_hub"][username], state["user_inbox"][username])
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        return writer.checksum
+
+    def write_snapshot_file(self, state, seq):
+        # Writes the snapshot covering the WAL up to seq and commits it. A
+        # copy older than the snapshot already written is dropped
+        with self.snapshot_lock:
+            if state["state_version"] < self.snapshot_version:
+                return
+            checksum = self.encode_snapshot_file(self.state_file, state, seq)
+            self.snapshot_seq = seq
+            self.snapshot_version = state["state_version"]
+            self.prev_commit_hash = checksum
+            self.commit_log.commit(checksum, state["time"], seq, state["state_version"])
+
+    def install_recovered_state(self, header):
+        # Takes over the state a persistent storage backend committed
+        self.state_save_time = header["time"]
+        with self.version_lock:
+            self.state_version = header["state_version"]
+        self.wal_seq = header["wal_seq"]
+        self.snapshot_seq = self.wal_seq
+        self.wal.advance_to(self.wal_seq)
+
+    def commit_storage(self):
+        # Caller must hold both locks. Commits a persistent storage backend
+        # in place of writing a snapshot file, there is no file to checksum
+        self.storage.commit(self.wal_seq, self.state_version, self.state_save_time)
+        self.snapshot_seq = self.wal_seq
+        self.prev_commit_hash = None
+        self.commit_log.commit(None, self.state_save_time, self.wal_seq, self.state_version)
+
+    def write_snapshot(self):
+        # Caller must hold both locks
+        if self.storage.persistent:
+            self.commit_storage()
+            return
+        state = self.state_dict()
+        state["state_version"] = self.state_version
+        self.write_snapshot_file(state, self.wal_seq)
+
     def write_state(self):
-        state = self.get_state()
-        text_file = open(self.state_file, "w")
-        text_file.write(state)
-        text_file.close()
-        
-        log_file = open(self.commit_log_path, "a")  # append mode
-        log_file.write(f"Commit Hash: {self.prev_commit_hash}, Time: {self.state_save_time} \n")
-        log_file.close()
+        with self.metadata_lock:
+            with self.inbox_lock:
+                self.write_snapshot()
+
+    def checkpoint(self):
+        """
+        Writes a consistent snapshot without holding the locks while it is
+        encoded and written. Only the copy of the state is taken under the
+        locks. Inboxes kept in segment files are not copied into memory,
+        their segments are hard linked and the snapshot is streamed from
+        the links. A persistent storage backend is simply committed.
+
+        Returns:
+            int: The WAL sequence number the snapshot covers.
+        """
+        with self.metadata_lock:
+            with self.inbox_lock:
+                state, seq = self.freeze_snapshot()
+        self.write_frozen_snapshot(state, seq)
+        return seq
+
+    def freeze_snapshot(self):
+        # Caller must hold both locks. Takes the copy of the state that
+        # write_frozen_snapshot writes once they are released, a persistent
+        # storage backend is committed right away instead
+        if self.storage.persistent:
+            self.write_snapshot()
+            return None, self.wal_seq
+        return self.copy_state(), self.wal_seq
+
+    def write_frozen_snapshot(self, state, seq):
+        # Writes the snapshot of a copy taken by freeze_snapshot
+        if state is None:
+            return
+        try:
+            self.write_snapshot_file(state, seq)
+        finally:
+            if isinstance(state["user_inbox"], (storage.inbox.FrozenInboxes, storage.lazy.FrozenLazyInboxes)):
+                state["user_inbox"].close()
+
+    def copy_state(self):
+        # Caller must hold both locks. Copies the state to be written out
+        # after they are released. Inbox segments and inboxes still in the
+        # snapshot are frozen rather than read, the copy of the inboxes is
+        # closed once written.
+        if isinstance(self.user_inbox, (storage.inbox.SegmentInboxes, storage.lazy.LazyInboxes)):
+            user_inbox = self.user_inbox.freeze()
+        else:
+            user_inbox = defaultdict(list, {username: list(inbox) for username, inbox in self.user_inbox.items()})
+        return {
+            "time": self.state_save_time,
+            "user_inbox": user_inbox,
+            "user_metadata_store": dict(self.user_metadata_store),
+            "token_hub": dict(self.token_hub),
+            "state_version": self.state_version,
+            }
     
+    def snapshot_file_intact(self, commit):
+        """
+        Compares the CRC32 of the snapshot file with the checksum `commit`
+        recorded for it.
+
+        Returns:
+            bool: False if the file differs from the one committed. A file
+            written after the last commit, by a server that stopped before
+            committing it, is left to the checksums of its records.
+        """
+        if commit is None or commit["checksum"] is None:
+            return True
+        checksum = 0
+        with open(self.state_file, "rb") as state_file:
+            for chunk in iter(lambda: state_file.read(SNAPSHOT_CHUNK_BYTES), b""):
+                checksum = zlib.crc32(chunk, checksum)
+        if checksum == commit["checksum"]:
+            return True
+        try:
+            header, _, reader = storage.snapshot.read_snapshot_file(self.state_file)
+        except Exception:
+            return False
+        if reader is not None:
+            reader.close()
+        return header["wal_seq"] > commit["wal_seq"]
+
     def read_state_from_file(self):
-        text_file = open(self.state_file, "r") # open text file in read mode
-        state = text_file.read() # read whole file to a string
-        text_file.close() # close file
-        self.set_state(state)
+        with self.metadata_lock:
+            with self.inbox_lock:
+                try:
+                    # files written before the indexed format are still read
+                    header, users, reader = storage.snapshot.read_snapshot_file(
+                        self.state_file,
+                        lazy_inboxes=self.lazy_inboxes and self.inbox_dir is None and not self.storage.persistent)
+                    user_inbox = {}
+                    pending = []
+                    user_metadata_store = {}
+                    token_hub = {}
+                    # decoded user by user straight into the state dictionaries,
+                    # inboxes of indexed snapshots stay on disk until touched
+                    for username, metadata, token, inbox in users:
+                        user_metadata_store[username] = metadata
+                        token_hub[username] = token
+                        if inbox is None:
+                            pending.append(username)
+                        else:
+                            user_inbox[username] = inbox
+                    if len(pending) > 0:
+                        user_inbox = storage.lazy.LazyInboxes(reader, pending, user_inbox)
+                    else:
+                        user_inbox = defaultdict(list, user_inbox)
+                    self.install_state({
+                        "time": header["time"],
+                        "state_version": header["state_version"],
+                        "user_inbox": user_inbox,
+                        "user_metadata_store": user_metadata_store,
+                        "token_hub": token_hub,
+                        })
+                except Exception as e:
+                    self.commit_log.error(f"Failing state file: {self.state_file} ({e})")
+                    return
+                self.wal_seq = header["wal_seq"]
+                self.snapshot_seq = self.wal_seq
+                if self.storage.persistent:
+                    # the snapshot is imported once, the database takes over from here
+                    self.commit_storage()
+        # the log may have been removed while the snapshot was kept
+        self.wal.advance_to(self.wal_seq)
+
+    def replay_wal(self):
+        """
+        Re-applies the logged operations that are newer than the loaded
+        snapshot. Replay stops at the first gap in the sequence numbers.
+
+        Returns:
+            int: The number of replayed operations.
+        """
+        replayed = 0
+        with self.metadata_lock:
+            with self.inbox_lock:
+                for record in self.wal.replay(after_seq=self.wal_seq):
+                    if record["seq"] != self.wal_seq + 1:
+                        print(f"WAL gap after seq {self.wal_seq}, stopping replay")
+                        break
+                    with self.version_lock:
+                        self.apply_operation(record["op"], record["args"])
+                    self.wal_seq = record["seq"]
+                    self.state_save_time = record["time"]
+                    replayed += 1
+        return replayed
+
+    def apply_operation(self, op, args):
+        """
+        Applies a single logged operation to the in-memory state.
+
+        Args:
+            op (str): The operation type.
+            args (dict): The operation arguments as stored in the log.
+
+        The caller must hold the locks guarding the structures the operation
+        touches as well as the version lock. Every operation bumps the state
+        version.
+        """
+        if op == "create_account":
+            username = args["username"]
+            self.user_metadata_store[username] = (args["password"], args["fullname"])
+            self.token_hub[username] = (args["token"], args["timestamp"])
+            self.user_inbox[username] = []
+
+        elif op == "set_token":
+            self.token_hub[args["username"]] = (args["token"], args["timestamp"])
+
+        elif op == "send_message":
+            self.user_inbox[args["recipient"]].append(args["message"])
+
+        elif op == "pop_message":
+            self.user_inbox[args["username"]].pop(0)
+
+        elif op == "delete_account":
+            username = args["username"]
+            self.token_hub.pop(username)
+            self.user_metadata_store.pop(username)
+            self.user_inbox.pop(username)
+
+        else:
+            raise ValueError(f"Unknown operation: {op}")
+
+        self.state_version += 1
+
+    def commit_operation(self, op, **args):
+        """
+        Applies an operation to the in-memory state and appends it to the
+        write-ahead log. Must be called while holding the locks that guard
+        the touched structures so that log order matches apply order.
+
+        Returns:
+            int: The WAL sequence number of the operation. Callers pass it to
+            `self.sync` once the locks are released and before replying.
+        """
+        return self.commit_record(op, args)
+
+    def commit_record(self, op, args, origin=None):
+        # commit_operation of an operation shipped by a primary as the WAL
+        # sequence `origin` = (primary, seq), or committed here if None
+        with self.version_lock:
+            self.apply_operation(op, args)
+            self.state_save_time = time.time()
+            # never blocks, a full log queue holds the caller up in sync
+            seq = self.wal.append(op, args, self.state_save_time)
+            with self.backlog_lock:
+                self.wal_seq = seq
+                self.op_backlog.append(
+                    {"seq": seq, "time": self.state_save_time, "op": op, "args": args, "origin": origin})
+            self.storage.operation_applied(seq, self.state_version, self.state_save_time)
+        if self.on_commit is not None:
+            self.on_commit()
+        return seq
+
+    def read_election_state(self):
+        if os.path.exists(self.election_file):
+            with open(self.election_file) as election_file:
+                state = json.load(election_file)
+            self.term = state["term"]
+            self.voted_for = state["voted_for"]
+            self.data_term = state["data_term"]
+
+    def write_election_state(self):
+        # Caller must hold election_lock
+        tmp_path = self.election_file + ".tmp"
+        with open(tmp_path, "w") as election_file:
+            json.dump({"term": self.term, "voted_for": self.voted_for, "data_term": self.data_term},
+                      election_file)
+            election_file.flush()
+            os.fsync(election_file.fileno())
+        os.replace(tmp_path, self.election_file)
+
+    def set_term(self, term, voted_for=None):
+        """
+        Moves to election term `term`, having voted for `voted_for` in it.
+        On disk before it returns, so the vote is not forgotten.
+        """
+        with self.election_lock:
+            if (term, voted_for) != (self.term, self.voted_for):
+                self.term = term
+                self.voted_for = voted_for
+                self.write_election_state()
+
+    def set_data_term(self, term):
+        """
+        Records that the state holds the operations of the primary of `term`.
+        """
+        with self.election_lock:
+            if term != self.data_term:
+                self.data_term = term
+                self.write_election_state()
+
+    def has_lease(self):
+        """
+        Returns:
+            bool: True if this server is primary and, when leases are in use,
+            its lease is valid. Only then are requests served, reads right
+            from the local state.
+        """
+        if self.server_state != ServerState.PRIMARY:
+            return False
+        return self.lease_expiry is None or time.monotonic() < self.lease_expiry
+
+    def primary_hint(self, context):
+        """
+        Where this server believes the primary is, for the reply to a
+        request it turns down as a secondary. The hint is also set as the
+        trailing metadata of the call, so a client can be redirected
+        without looking into the reply.
+
+        Returns:
+            chat_pb2.PrimaryHint: The "host:external port" of the primary,
+            empty if no primary is known, and this server's term.
+        """
+        port = self.known_primary() if self.known_primary is not None else None
+        replica = self.membership.replicas.get(port) if port is not None else None
+        hint = chat_pb2.PrimaryHint(
+            address="" if replica is None else f"{replica.host}:{replica.external_port}",
+            term=self.term)
+        if context is not None:
+            context.set_trailing_metadata(((PRIMARY_ADDRESS_KEY, hint.address),
+                                           (PRIMARY_TERM_KEY, str(hint.term))))
+        return hint
+
+    def applied_position(self):
+        """
+        Returns:
+            (str, int): The primary whose log this server's state follows and
+            the last sequence of that log applied here. A primary follows its
+            own log, at its WAL sequence.
+        """
+        if self.server_state == ServerState.PRIMARY or \
+                (self.replication_source is not None and self.replication_source == self.internal_port):
+            return self.internal_port, self.wal_seq
+        return self.replication_source, self.replicated_seq
+
+    def log_position(self):
+        """
+        Returns:
+            (int, int): The term of the primary whose state this server holds
+            and the last sequence of that primary's log applied here, larger
+            for a more recent state. Unlike the state version, both are the
+            same on every replica holding the same state.
+        """
+        return self.data_term, self.applied_position()[1]
+
+    def local_seq(self, source, seq):
+        """
+        Finds the state a replica reached by applying the log of the primary
+        at `source` up to `seq` in this server's log.
+
+        Returns:
+            int: The WAL sequence this server held that state at, None if its
+            log since the last install does not go through that state.
+        """
+        with self.backlog_lock:
+            origin, installed_at = self.install_point
+            if source == self.internal_port:
+                return seq if installed_at < seq <= self.wal_seq else None
+            if origin == (source, seq):
+                return installed_at
+            for record in reversed(self.op_backlog):
+                if record["origin"] == (source, seq):
+                    return record["seq"]
+            return None
+
+    def resume_replication(self, source, seq, position):
+        """
+        Follows the log of the primary at `source` from its WAL sequence
+        `seq` on, provided this server's state is still at `position`, the
+        (primary, sequence) the primary found in its log.
+
+        Returns:
+            bool: False if the state moved on since.
+        """
+        with self.metadata_lock:
+            with self.inbox_lock:
+                if self.applied_position() != position:
+                    return False
+                self.replication_source = source
+                self.replicated_seq = seq
+        return True
+
+    def record_replica_ack(self, port, seq):
+        """
+        Records the last WAL sequence the secondary at `port` applied, None
+        if it does not follow this server's operations.
+        """
+        with self.ack_condition:
+            if seq is None:
+                self.replica_acks.pop(port, None)
+            else:
+                self.replica_acks[port] = seq
+            self.ack_condition.notify_all()
+
+    def live_replicas(self):
+        """
+        Returns:
+            set: The ports of the secondaries a write waits for, every
+            replica if the interface does not tell which ones are live.
+        """
+        replicas = set(self.replicas)
+        if self.replica_live is None:
+            return replicas
+        return {port for port in replicas if self.replica_live(port)}
+
+    def wait_for_replication(self, seq):
+        """
+        Blocks until as many live secondaries as the replication mode asks
+        for acknowledged WAL sequence `seq`, or until the replication
+        timeout. A secondary that goes down during the wait stops being
+        waited for. Returns right away in async mode and when not primary,
+        and returns False right away when the most writes that may wait
+        are already waiting.
+
+        Returns:
+            bool: False if the wait timed out.
+        """
+        if self.replication_mode == REPLICATION_ASYNC or self.server_state != ServerState.PRIMARY:
+            return True
+        if not self.replication_waiters.acquire(blocking=False):
+            print(f"Replying to WAL seq {seq} without waiting for the {self.replication_mode} "
+                  f"acknowledgements, too many writes are waiting")
+            return False
+        try:
+            deadline = time.monotonic() + self.replication_timeout
+            with self.ack_condition:
+                while True:
+                    live = self.live_replicas()
+                    acks = sum(1 for port in live if self.replica_acks.get(port, 0) >= seq)
+                    needed = min(1, len(live)) if self.replication_mode == REPLICATION_SEMI_SYNC else len(live)
+                    if acks >= needed:
+                        return True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    # liveness changes are not notified, look again every tick
+                    self.ack_condition.wait(min(remaining, REFRESH_TIME))
+        finally:
+            self.replication_waiters.release()
+        print(f"Replying to WAL seq {seq} before the {self.replication_mode} acknowledgements "
+              f"arrived, waited {self.replication_timeout} s")
+        return False
+
+    def sync(self, seq):
+        """
+        Waits until the operation with WAL sequence `seq` is as durable as the
+        durability mode asks and as replicated as the replication mode asks.
+        Called with no locks held, before replying to the write.
+        """
+        self.sync_log(seq)
+        self.wait_for_replication(seq)
+
+    def sync_log(self, seq):
+        """
+        Waits for `self.wal.sync(seq)`. Operations whose record could not be
+        written are in the state but not in the log, and nothing the log
+        takes after them could be replayed, so a server whose log failed
+        stops taking part in the cluster: it serves no more requests and is
+        not elected. A restart recovers the state from the snapshot and the
+        log up to the failed record.
+
+        Raises:
+            Exception: The error the log failed with.
+        """
+        try:
+            self.wal.sync(seq)
+        except Exception as e:
+            if self.server_state != ServerState.BROKEN:
+                print(f"WAL failed at seq {self.wal.failed_seq}, no longer serving: {e}")
+                self.commit_log.error(f"Failing WAL at seq {self.wal.failed_seq}: {e}")
+                self.server_state = ServerState.BROKEN
+            raise
+
+    def ops_after(self, seq, limit=OPS_PER_MESSAGE):
+        """
+        Returns the committed operations that follow WAL sequence `seq`.
+
+        Args:
+            seq (int): The last sequence the receiver applied.
+            limit (int): The most operations to return.
+
+        Returns:
+            list: Up to `limit` WAL records ({"seq", "time", "op", "args"}) in
+            sequence order, None if the operations after `seq` are no longer
+            in the backlog and the receiver needs a full state instead.
+        """
+        with self.backlog_lock:
+            if seq >= self.wal_seq:
+                return []
+            if len(self.op_backlog) == 0 or self.op_backlog[0]["seq"] > seq + 1:
+                return None
+            start = seq + 1 - self.op_backlog[0]["seq"]
+            return list(itertools.islice(self.op_backlog, start, start + limit))
+
+    def apply_replicated_ops(self, source, records):
+        """
+        Applies operations shipped by the primary at `source`, in sequence
+        order. Operations already applied are skipped, and everything after a
+        gap is dropped so that the primary sends it again.
+
+        Returns:
+            int: The last sequence of `source` applied, the one to acknowledge,
+            None if they could not be logged.
+        """
+        last_seq = None
+        with self.metadata_lock:
+            with self.inbox_lock:
+                if source != self.replication_source:
+                    # operations only apply on top of a resync from their primary
+                    return self.replicated_seq
+                for record in records:
+                    if record["seq"] <= self.replicated_seq:
+                        continue
+                    if record["seq"] != self.replicated_seq + 1:
+                        break
+                    try:
+                        last_seq = self.commit_record(record["op"], record["args"], origin=(source, record["seq"]))
+                    except Exception as e:
+                        # the states diverged, wait for a resync
+                        self.commit_log.error(f"Failing operation {record['seq']} from {source}: {e}")
+                        self.replication_source = None
+                        self.replicated_seq = 0
+                        break
+                    self.replicated_seq = record["seq"]
+                replicated_seq = self.replicated_seq
+        if last_seq is not None:
+            # acknowledged operations are durable here
+            try:
+                self.sync_log(last_seq)
+            except Exception:
+                return None
+        return replicated_seq
     
     def update_state(self, state):
         with self.metadata_lock:
@@ -226,9 +1109,9 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
         If the recipient does not exist, the function returns a
         `MessageReply` object with an error code indicating an invalid recipient.
         """
-        if self.server_state == ServerState.SECONDARY:
+        if not self.has_lease():
             return chat_pb2.MessageReply(
-                version=1, error_code=SECONDARY_ERROR_CODE)
+                version=1, error_code=SECONDARY_ERROR_CODE, primary=self.primary_hint(context))
         token = request.auth_token
         username = request.username
         recipient = request.recipient_username
@@ -241,11 +1124,13 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
         modified_string = f"[{username}]: {message_string}"
 
         with self.inbox_lock:
-            if recipient not in self.user_inbox.keys():
+            if recipient not in self.user_inbox:
                 return chat_pb2.MessageReply(version=1,
                                              error_code="Invalid Recipient")
-            self.user_inbox[recipient].append(modified_string)
-        self.write_state()
+            seq = self.commit_operation("send_message",
+                                        recipient=recipient,
+                                        message=modified_string)
+        self.sync(seq)
         return chat_pb2.MessageReply(version=1, error_code="")
 
     def CheckInboxLength(self, username: str) -> int:
@@ -288,23 +1173,38 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
         # every client will end up running this
         token = request.auth_token
         username = request.username
-        if self.server_state == ServerState.SECONDARY:
-            return chat_pb2.RefreshReply(
-                version=1, error_code=SECONDARY_ERROR_CODE)
+        if not self.has_lease():
+            # a reply rather than an empty stream, which a client could not
+            # tell from an empty inbox
+            yield chat_pb2.RefreshReply(
+                version=1, error_code=SECONDARY_ERROR_CODE, primary=self.primary_hint(context))
+            return
 
         if self.ValidateToken(username=username,
                               token=token) < 0:
             return chat_pb2.RefreshReply(version=1,
                                          error_code="Invalid Token")
-        # Check if there are any new messages
+        # Check if there are any new messages. A message is only removed
+        # once the stream asks for the next one with the client still
+        # there, one that did not reach the client is delivered again
         while self.CheckInboxLength(username=username) > 0:
+            if context is not None and not context.is_active():
+                return
             with self.inbox_lock:
-                msg = self.user_inbox[username].pop(0)
+                msg = self.user_inbox[username][0]
             # ended lock context before yield
-            self.write_state()
             yield chat_pb2.RefreshReply(version=1,
                                         error_code="",
                                         message=msg)
+            if context is not None and not context.is_active():
+                return
+            with self.inbox_lock:
+                inbox = self.user_inbox[username]
+                # another stream of the same user may have taken it already
+                if len(inbox) == 0 or inbox[0] != msg:
+                    continue
+                seq = self.commit_operation("pop_message", username=username)
+            self.sync(seq)
 
     def Login(self, request, context) -> chat_pb2.LoginReply:
         """
@@ -331,11 +1231,12 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
         """
         # get the given username and do basic error checking
         username = request.username
-        if self.server_state == ServerState.SECONDARY:
+        if not self.has_lease():
             return chat_pb2.LoginReply(
                 error_code=SECONDARY_ERROR_CODE,
                 auth_token="",
-                fullname="")
+                fullname="",
+                primary=self.primary_hint(context))
         with self.metadata_lock:
             if username not in self.user_metadata_store.keys():
                 return chat_pb2.LoginReply(
@@ -356,8 +1257,11 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
             timestamp = self.utc_time_gen.now().timestamp()
 
             # register token in token hub
-            self.token_hub[username] = (token, timestamp)
-        self.write_state()
+            seq = self.commit_operation("set_token",
+                                        username=username,
+                                        token=token,
+                                        timestamp=timestamp)
+        self.sync(seq)
         return chat_pb2.LoginReply(
             version=1,
             error_code="",
@@ -378,12 +1282,13 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
         """
         # get the given username and do basic error checking
         username = request.username
-        if self.server_state == ServerState.SECONDARY:
+        if not self.has_lease():
             return chat_pb2.AccountCreateReply(
                 version=1,
                 error_code=SECONDARY_ERROR_CODE,
                 auth_token="",
-                fullname="")
+                fullname="",
+                primary=self.primary_hint(context))
         with self.metadata_lock:
             if username in self.user_metadata_store.keys():
                 return chat_pb2.AccountCreateReply(
@@ -403,15 +1308,16 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
             token = self.GenerateToken()
             timestamp = self.utc_time_gen.now().timestamp()
 
-            # create user metadata
-            self.user_metadata_store[username] = (password, fullname)
-            # register user in token hub / stores last given token
-            self.token_hub[username] = (token, timestamp)
-
             with self.inbox_lock:
+                # create user metadata, register user in token hub and
                 # create user chat inbox
-                self.user_inbox[username] = []
-        self.write_state()
+                seq = self.commit_operation("create_account",
+                                            username=username,
+                                            password=password,
+                                            fullname=fullname,
+                                            token=token,
+                                            timestamp=timestamp)
+        self.sync(seq)
         return chat_pb2.AccountCreateReply(version=1,
                                             error_code="",
                                             auth_token=token,
@@ -432,10 +1338,11 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
         """
         token = request.auth_token
         username = request.username
-        if self.server_state == ServerState.SECONDARY:
+        if not self.has_lease():
             return chat_pb2.ListAccountReply(version=1,
                                              error_code=SECONDARY_ERROR_CODE,
-                                             account_names="")
+                                             account_names="",
+                                             primary=self.primary_hint(context))
         if self.ValidateToken(username=username,
                               token=token) < 0:
             return chat_pb2.ListAccountReply(version=1,
@@ -477,9 +1384,10 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
             The message contains a version number, an error code (if any),
             and an empty string as a payload.
         """
-        if self.server_state == ServerState.SECONDARY:
+        if not self.has_lease():
             return chat_pb2.DeleteAccountReply(version=1,
-                                               error_code=SECONDARY_ERROR_CODE)
+                                               error_code=SECONDARY_ERROR_CODE,
+                                               primary=self.primary_hint(context))
         token = request.auth_token
         username = request.username
         if self.ValidateToken(username=username,
@@ -489,14 +1397,190 @@ class ChatServer(chat_pb2_grpc.ChatServerServicer):
 
         # delete all relevant metadata
         with self.metadata_lock:
-            self.token_hub.pop(username)
-            self.user_metadata_store.pop(username)
             with self.inbox_lock:
-                self.user_inbox.pop(username)
-        self.write_state()
+                seq = self.commit_operation("delete_account", username=username)
+        self.sync(seq)
         return chat_pb2.DeleteAccountReply(version=1,
                                             error_code="")
 
+    def AddReplica(self, request, context) -> chat_pb2.MembershipChangeReply:
+        """
+        Adds a replica to the cluster. The primary connects to it and the
+        new replica catches up like any secondary that is behind, by
+        requesting a snapshot and then following the operations.
+
+        Args:
+            request (chat_pb2.MembershipChangeRequest): The replica to add.
+
+        Returns:
+            chat_pb2.MembershipChangeReply: The membership after the change.
+        """
+        if not self.has_lease():
+            return chat_pb2.MembershipChangeReply(version=1,
+                                                  error_code=SECONDARY_ERROR_CODE,
+                                                  primary=self.primary_hint(context))
+        replica = request.replica
+        if replica.host == "" or replica.external_port == "" or replica.internal_port == "":
+            return chat_pb2.MembershipChangeReply(version=1,
+                                                  error_code="Replica needs a host and both ports")
+        self.membership.add(membership.Replica(replica.host, replica.external_port, replica.internal_port))
+        if self.on_membership_change is not None:
+            self.on_membership_change()
+        return chat_pb2.MembershipChangeReply(version=1,
+                                              error_code="",
+                                              membership=self.membership.to_proto())
+
+    def RemoveReplica(self, request, context) -> chat_pb2.MembershipChangeReply:
+        """
+        Removes the replica with the internal port of the request from the
+        cluster. The primary cannot remove itself.
+
+        Args:
+            request (chat_pb2.MembershipChangeRequest): The replica to remove.
+
+        Returns:
+            chat_pb2.MembershipChangeReply: The membership after the change.
+        """
+        if not self.has_lease():
+            return chat_pb2.MembershipChangeReply(version=1,
+                                                  error_code=SECONDARY_ERROR_CODE,
+                                                  primary=self.primary_hint(context))
+        if request.replica.internal_port == self.internal_port:
+            return chat_pb2.MembershipChangeReply(version=1,
+                                                  error_code="Cannot remove the primary")
+        if not self.membership.remove(request.replica.internal_port):
+            return chat_pb2.MembershipChangeReply(version=1,
+                                                  error_code="Unknown replica")
+        if self.on_membership_change is not None:
+            self.on_membership_change()
+        return chat_pb2.MembershipChangeReply(version=1,
+                                              error_code="",
+                                              membership=self.membership.to_proto())
+
+
+class PeerStream:
+    """
+    Connection to the replication service of one peer, driven by the event
+    loop of the server interface. Messages wait in a per-peer queue and are
+    sent in order on one Exchange stream over a channel kept for the life
+    of the server, the stream is opened again whenever it breaks. While the
+    peer is unreachable messages are dropped, like they were lost on a
+    broken connection, so a slow or dead peer never holds up the others.
+
+    A heartbeat stream gets a connection of its own, sends uncompressed,
+    and makes room for new messages by dropping the oldest.
+
+    `on_ready` is called on the event loop every time the connection to the
+    peer comes up.
+    """
+
+    def __init__(self, address, loop, queue_size=PEER_QUEUE_SIZE, heartbeat=False, on_ready=None):
+        self.address = address
+        self.loop = loop
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.queue = deque(maxlen=queue_size if heartbeat else None)
+        self.wakeup = asyncio.Event()
+        self.channel = None
+        self.call = None
+        # bumped whenever a call ends, ends the request iterator of the call
+        self.generation = 0
+        self.ready = False
+        self.on_ready = on_ready
+        self.closed = False
+        self.tasks = []
+
+    def connect(self):
+        # Called on the event loop
+        if self.heartbeat:
+            self.channel = grpc.aio.insecure_channel(self.address, options=HEARTBEAT_CHANNEL_OPTIONS)
+        else:
+            self.channel = grpc.aio.insecure_channel(
+                self.address, options=PEER_CHANNEL_OPTIONS, compression=REPLICATION_COMPRESSION)
+        self.tasks = [self.loop.create_task(self.watch_connectivity()),
+                      self.loop.create_task(self.stream_task())]
+
+    async def watch_connectivity(self):
+        connectivity = self.channel.get_state(try_to_connect=True)
+        while True:
+            was_ready = self.ready
+            self.ready = connectivity == grpc.ChannelConnectivity.READY
+            if not self.ready:
+                # messages queued for a lost connection are stale by the
+                # time it comes back
+                self.queue.clear()
+            elif not was_ready and self.on_ready is not None:
+                self.on_ready()
+            await self.channel.wait_for_state_change(connectivity)
+            connectivity = self.channel.get_state(try_to_connect=True)
+
+    def send(self, message):
+        """
+        Queues `message` for the peer, without blocking. Safe to call from
+        any thread.
+
+        Returns:
+            bool: False if the message was dropped.
+        """
+        if not self.ready or self.closed:
+            return False
+        if not self.heartbeat and len(self.queue) >= self.queue_size:
+            return False
+        self.queue.append(message)
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+        return True
+
+    async def outgoing(self, generation):
+        # Request iterator of one Exchange call
+        while generation == self.generation:
+            while len(self.queue) > 0:
+                yield self.queue.popleft()
+            self.wakeup.clear()
+            if len(self.queue) == 0:
+                await self.wakeup.wait()
+
+    def end_call(self):
+        self.generation += 1
+        self.wakeup.set()
+
+    async def stream_task(self):
+        stub = chat_pb2_grpc.ReplicationServiceStub(self.channel)
+        while not self.closed:
+            self.call = stub.Exchange(self.outgoing(self.generation), wait_for_ready=True)
+            try:
+                # the peer does not reply on the stream for now
+                async for _ in self.call:
+                    pass
+            except grpc.RpcError:
+                pass
+            self.end_call()
+            await asyncio.sleep(PEER_RECONNECT_TIME)
+
+    async def close(self):
+        self.closed = True
+        if self.call is not None:
+            self.call.cancel()
+        self.end_call()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.channel is not None:
+            await self.channel.close()
+
+
+class ReplicationServicer(chat_pb2_grpc.ReplicationServiceServicer):
+    """
+    Hands the messages peers send on their Exchange streams to the server
+    interface, in the order they were sent.
+    """
+
+    def __init__(self, interface):
+        self.interface = interface
+
+    async def Exchange(self, request_iterator, context):
+        async for message in request_iterator:
+            await self.interface.ReceiveMessage(message)
+
 
 class ServerInterface:
     """
@@ -508,278 +1592,971 @@ class ServerInterface:
         Initialize the server interface with the servicer object and port number.
         """
         self.servicer_object = servicer_object
+        self.servicer_object.internal_port = port
+        self.servicer_object.known_primary = self.KnownPrimary
+        self.servicer_object.replica_live = self.ReplicaLive
+        if self.servicer_object.server_state == ServerState.PRIMARY:
+            # a primary follows its own log
+            self.servicer_object.replication_source = port
         self.port = port
+        # per peer, the stream for replication traffic and the one for
+        # heartbeats and election messages
         self.sockets_dict = {}
+        self.heartbeat_dict = {}
         self.replica_metadata = {}
-        self.ballot_box = []
+        # per peer, the replication position from its last heartbeat:
+        # (wal_seq, replication_source, replicated_seq)
+        self.peer_positions = {}
+        # per peer, from its last status: the position of the peer and its
+        # (data_term, applied_seq)
+        self.peer_status = {}
+        # learns the intervals between every peer's statuses, and tells how
+        # likely a peer that has gone quiet is down
+        self.detector = failure_detector.PhiAccrualDetector(REFRESH_TIME, threshold=PHI_THRESHOLD)
         self.iter_value = 0
-        self.election_time = False
-
-    def init_listening_interface(self) -> None:
+        # while candidate, the replicas that voted for this server. Unless
+        # the primary is heard from, election_timer starts the next election,
+        # once elections are on.
+        self.votes = set()
+        self.election_timer = None
+        self.elections = False
+        # while primary, the send time of its recent heartbeats by sequence,
+        # and per peer the send time of the last one it acknowledged
+        self.heartbeat_seq = 0
+        self.heartbeats_sent = OrderedDict()
+        self.peer_heartbeat_acked = {}
+        # while secondary, the time.monotonic() the primary of the current
+        # term was last heard from
+        self.primary_heard = None
+        # while primary, per peer: the last WAL sequence it acknowledged
+        # (absent until it installed a snapshot from this server), the last
+        # one shipped to it, and the tick since which it owes an ack
+        self.peer_acked = {}
+        self.peer_sent = {}
+        self.peer_waiting_since = {}
+        # while secondary, the snapshot transfer in progress and the tick of
+        # the last catch-up request or chunk received. Only used on the state
+        # worker thread, see CatchUp
+        self.download = None
+        self.catch_up_iter = -RETRANSMIT_ITERS
+        self.replication_server = None
+        # the interface runs on one event loop thread. Messages that touch
+        # the replicated state are handled in order on one worker thread, so
+        # applying operations or building and installing snapshots never
+        # holds up heartbeats
+        self.loop = None
+        self.state_executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.ops_available = asyncio.Event()
+        self.ops_pending = False
+        # whether this server has been in the membership, a member that is
+        # no longer in it was removed from the cluster
+        self.member = False
+
+    def attach_loop(self, loop):
+        # Binds the interface to the event loop it runs on
+        self.loop = loop
+        self.servicer_object.on_commit = self.OperationsCommitted
+        self.servicer_object.on_membership_change = self.MembershipChanged
+
+    async def ConnectPeer(self, port, address):
         """
-        Creates a new machine thread that monitors
-        and accepts new client connections and hands
-        them off to a newly created consumer thread.
-
-        Args:
-            None
+        Opens the replication and heartbeat streams to the peer at `address`,
+        they are (re)established in the background whenever the peer is
+        reachable.
+        """
+        if port in self.sockets_dict:
+            return
+        self.sockets_dict[port] = PeerStream(address, self.loop)
+        self.heartbeat_dict[port] = PeerStream(address, self.loop, HEARTBEAT_QUEUE_SIZE, heartbeat=True,
+                                               on_ready=partial(self.PeerReady, port))
+        self.servicer_object.replicas.add(port)
+        self.sockets_dict[port].connect()
+        self.heartbeat_dict[port].connect()
+
+    async def DisconnectPeer(self, port):
+        """
+        Closes the streams to the peer at `port` and forgets what this server
+        knew about it.
+        """
+        streams = [self.sockets_dict.pop(port, None), self.heartbeat_dict.pop(port, None)]
+        self.servicer_object.replicas.discard(port)
+        self.servicer_object.record_replica_ack(port, None)
+        self.detector.remove(port)
+        for peer_state in (self.replica_metadata, self.peer_positions, self.peer_status, self.peer_acked,
+                           self.peer_sent, self.peer_waiting_since):
+            peer_state.pop(port, None)
+        for s in streams:
+            if s is not None:
+                await s.close()
+
+    async def ClosePeers(self):
+        for s in list(self.sockets_dict.values()) + list(self.heartbeat_dict.values()):
+            await s.close()
+
+    async def init_listening_interface(self):
+        """
+        Starts the replication service on the internal port. Every peer keeps
+        one Exchange stream open to it, on which it sends this server its
+        heartbeats, election messages and replication traffic.
 
         Returns:
-            None
+            grpc.Server: The started server.
         """
         print(f"setting up listening interface for port {self.port}")
-        # create the socket port for listening
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # bind to the port number
-        s.bind(('0.0.0.0', int(self.port)))
-
-        # start listening on port
-        s.listen()
+        server = grpc.aio.server(options=REPLICATION_CHANNEL_OPTIONS)
+        chat_pb2_grpc.add_ReplicationServiceServicer_to_server(ReplicationServicer(self), server)
+        server.add_insecure_port('[::]:' + self.port)
+        await server.start()
+        self.replication_server = server
+        return server
+
+    async def ReceiveMessage(self, message):
+        # Called on the event loop for every message a peer sends
+        kind = message.WhichOneof("body")
+        if kind in ("operations", "snapshot_request", "snapshot_chunk", "resume"):
+            if kind != "snapshot_request":
+                # a later term is taken on here, the state worker only drops
+                # messages of earlier ones
+                self.ObserveTerm(getattr(message, kind).term)
+            await self.loop.run_in_executor(self.state_executor, self.HandleMessage, message)
+        else:
+            self.HandleMessage(message)
 
-        for _ in range(2):
-            conn, addr = s.accept()
-            start_new_thread(self.consumer, (conn,))
+    def RunStateWork(self, function, *args):
+        # Runs work on the replicated state on the state worker thread, or
+        # right away while the interface is not attached to an event loop
+        if self.loop is None:
+            function(*args)
+        else:
+            self.state_executor.submit(function, *args)
 
-    def consumer(self, conn) -> None:
+    def HandleMessage(self, message) -> None:
         """
-        Consumes data from a network connection and adds it to a queue.
+        Acts on one message received from another server.
 
         Args:
-            conn (socket.socket): The network connection to consume data from.
-
-        Returns:
-            None
-
+            message (chat_pb2.ReplicaMessage): The message.
         """
-        # Record the start time so we know when to stop consuming.
-        while True:
-
-            try:
-                data = conn.recv(2048)
-            except Exception as e:
-                print("Connection Disrupted:", e, " - softhandler resolved")
-                conn.close()
+        kind = message.WhichOneof("body")
+        if kind == "status":
+            result = message.status
+            self.ObserveTerm(result.term)
+            position = result.position
+            if position == f"{ServerState.PRIMARY}" and result.term < self.servicer_object.term:
+                # a deposed primary that has not heard of the new term yet
+                position = f"{ServerState.BROKEN}"
+            self.replica_metadata[result.port] = (
+                position, self.servicer_object.utc_time_gen.now().timestamp())
+            self.peer_positions[result.port] = (
+                result.wal_seq, result.replication_source, result.replicated_seq)
+            self.peer_status[result.port] = (position, (result.data_term, result.applied_seq))
+            self.detector.heartbeat(result.port)
+            if result.membership_version < self.servicer_object.membership.version:
+                # the peer missed a membership change
+                self.SendHeartbeat(result.port, self.MembershipMessage())
+            if self.servicer_object.server_state == ServerState.PRIMARY and result.position == f"{ServerState.SECONDARY}":
+                # a secondary's heartbeat acknowledges what it applied
+                self.ReceiveAck(result.port, result.replication_source, result.replicated_seq)
+            if position == f"{ServerState.PRIMARY}":
+                self.FollowPrimary(result.port)
+                if result.heartbeat_seq > 0:
+                    self.SendHeartbeat(result.port, chat_pb2.ReplicaMessage(heartbeat_ack=chat_pb2.HeartbeatAck(
+                        term=self.servicer_object.term, port=self.port, heartbeat_seq=result.heartbeat_seq)))
+
+        elif kind == "heartbeat_ack":
+            self.ReceiveHeartbeatAck(message.heartbeat_ack)
+
+        elif kind == "vote_request":
+            self.ReceiveVoteRequest(message.vote_request)
+
+        elif kind == "vote":
+            self.ReceiveVote(message.vote)
+
+        elif kind == "operations":
+            result = message.operations
+            if result.term < self.servicer_object.term:
+                # shipped by a deposed primary
                 return
-            decoded = ""
-            try:
-                decoded = data.decode("UTF-8")
-            except UnicodeDecodeError:
-                print("Unable to decode the message")
-                conn.close()
-
-            args = decoded.split("||")
-            if len(args) == 0:
-                conn.close()
-                return
-
-            try:
-                opcode = int(args[0])
-            except ValueError:
-                opcode = -1
-
-            if opcode == 6:
-                result = wp.socket_types.ServerStatusUpdate(data)
-                if result is not None and result.port is not None:
-                    self.replica_metadata[result.port] = (
-                        result.position, self.servicer_object.utc_time_gen.now().timestamp())
-                    if self.servicer_object.server_state == ServerState.PRIMARY and result.position == f"{ServerState.PRIMARY}":
-                        print("Getting two primaries due to latency, triggering election!")
-                        self.election_time = True
-                        self.TriggerElection()
-                        self.ballot_box = []
-                        self.SubmitBallot()
-
-
-            elif opcode == 7:
-                result = wp.socket_types.ServerElectionTrigger(data)
-                self.election_time = True
-                self.ballot_box = []
-                self.SubmitBallot()
-
-            elif opcode == 8:
-                result = wp.socket_types.ServerElectionBallot(data)
-                if result is not None and result.port is not None:
-                    self.ballot_box.append(
-                        (result.port, result.value, self.servicer_object.utc_time_gen.now().timestamp()))
-            
-            elif opcode == 9:
-                result = wp.socket_types.ServerSendState(data)
-                # print(result.state)
-                if result.state is not None:
-                    self.servicer_object.update_state(result.state)
-                else:
-                    print(f"Sending None state: {result}")
+            if self.servicer_object.server_state == ServerState.SECONDARY:
+                ops = [{"seq": op.seq, "time": op.time, "op": op.op, "args": json.loads(op.args)}
+                       for op in result.ops]
+                if self.servicer_object.apply_replicated_ops(result.source, ops) is None:
+                    # not logged, not acknowledged
+                    return
+                if self.servicer_object.replication_source == result.source:
+                    self.servicer_object.set_data_term(result.term)
+                # acknowledged right away, the primary may hold writes for it
+                self.SendTo(result.source, self.AckMessage())
+
+        elif kind == "ack":
+            result = message.ack
+            if self.servicer_object.server_state == ServerState.PRIMARY:
+                self.ReceiveAck(result.port, result.source, result.seq)
+
+        elif kind == "snapshot_request":
+            result = message.snapshot_request
+            if self.servicer_object.server_state == ServerState.PRIMARY:
+                if result.snapshot_id == "" and result.resume_source and \
+                        self.ResumeReplication(result.port, result.resume_source, result.resume_seq):
+                    return
+                self.SendSnapshotChunks(result.port, result.snapshot_id, result.offset)
+
+        elif kind == "resume":
+            result = message.resume
+            if result.term >= self.servicer_object.term and \
+                    self.servicer_object.server_state == ServerState.SECONDARY and \
+                    self.servicer_object.resume_replication(
+                        result.source, result.seq, (result.resume_source, result.resume_seq)):
+                self.servicer_object.set_data_term(result.term)
+                # the primary starts shipping operations once it hears where to start
+                self.SendTo(result.source, self.AckMessage())
+
+        elif kind == "snapshot_chunk":
+            if message.snapshot_chunk.term >= self.servicer_object.term and \
+                    self.servicer_object.server_state == ServerState.SECONDARY:
+                self.ReceiveSnapshotChunk(message.snapshot_chunk)
+
+        elif kind == "membership":
+            if self.servicer_object.membership.adopt(message.membership):
+                self.ApplyMembership()
 
     def inter_server_communication_thread(self):
         """
-        This function starts a thread for inter-server communication.
-        It listens for updates from other servers, initiates an election if necessary,
-        and determines the winner of an election.
+        This function runs the inter-server communication on an event loop
+        on the calling thread. It listens for updates from other servers,
+        initiates an election if necessary, and determines the winner of an
+        election.
         """
+        asyncio.run(self.run())
 
+    async def run(self):
+        self.attach_loop(asyncio.get_running_loop())
         print("starting intercomms - checking internal state")
         print("Current Position State: ", self.servicer_object.server_state)
 
         print("Starting listening interface")
-        # Start the thread for the listening interface
-        init_thread = th.Thread(target=self.init_listening_interface)
-        init_thread.start()
-
-        # Add delay to initialize the server-side logic on all processes
-        time.sleep(INITIALIZE_WAIT_TIME)
-
-        # Connect to each server except for the current one
-        for i in range(len(INTERNAL_SERVER_ADDRS)):
-            host, port = INTERNAL_SERVER_ADDRS[i]
-            if port != self.port:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sockets_dict[port] = s
-                # self.replica_metadata[port] = (
-                #     None, self.servicer_object.utc_time_gen.now().timestamp())
+        await self.init_listening_interface()
 
-                try:
-                    s.connect((host, int(port)))
-                except Exception as e:
-                    print(e)
-        
-        # time.sleep(2 * ELECTION_CHECK_TIME)
+        # Connect to each replica of the membership except for the current
+        # one. Peers that are not up yet are dialled again with a short
+        # backoff, both sides exchange their status as soon as a connection
+        # comes up, see PeerReady
+        self.ApplyMembership()
 
-        if self.servicer_object.state_save_time is not None:
-            state_msg = wp.encode.ServerSendState(version=1, state=self.servicer_object.get_state())
-        else:
-            state_msg = None
-        
-        for port in self.sockets_dict.keys():
-            if state_msg is not None:
-                try:
-                    s = self.sockets_dict[port]
-                    s.send(state_msg)
-                except:
-                    pass
+        # the primary ships operations as they commit, secondaries catch up
+        # by requesting a snapshot from the primary, see CatchUpRequest. The
+        # replication task stops with the heartbeats
+        replication = self.loop.create_task(self.replication_task())
+
+        self.StartElections()
+        try:
+            await self.heartbeat_task()
+        finally:
+            replication.cancel()
 
-        # Loop indefinitely
+    async def heartbeat_task(self):
+        # Loop indefinitely, a failed tick is logged and the next one runs
         while True:
-            # Pause for a certain amount of time
-            time.sleep(REFRESH_TIME)
-            self.iter_value += 1
-
-            # If an election is not in progress
-            if not self.election_time:
-                # Check if there is a primary server
-                primary_found = False if self.servicer_object.server_state == ServerState.SECONDARY else True
-                for port in self.sockets_dict.keys():
-                    s = self.sockets_dict[port]
-                    # Send an update on the current server's status to each
-                    # connected server
-                    msg = wp.encode.ServerStatusUpdate(
-                        version=1, port=self.port, position=self.servicer_object.server_state)
-                    if self.servicer_object.server_state == ServerState.PRIMARY:
-                        state_msg = wp.encode.ServerSendState(version=1, state=self.servicer_object.get_state())
-                    else:
-                        state_msg = None
-                    try:
-                        s.send(msg)
-                        if self.servicer_object.server_state == ServerState.PRIMARY:
-                            s.send(state_msg)
-                    except BrokenPipeError:
-                        pass
-
-                    # Check the metadata of each connected server to see if it
-                    # has a primary server
-                    if port in self.replica_metadata.keys():
-                        pos, t = self.replica_metadata[port]
-                        if self.servicer_object.utc_time_gen.now().timestamp() - t < ELECTION_CHECK_TIME:
-                            if pos == f"{ServerState.PRIMARY}":
-                                primary_found = True
-
-                print(self.replica_metadata, " primary found: ", primary_found)
-
-                # If no primary server is found after a certain number of
-                # iterations, trigger an election
-                if self.iter_value > ELECTION_ITERS and not primary_found:
-                    print(f"Triggering Election: {self.port}")
-                    self.election_time = True
-                    self.TriggerElection()
-                    time.sleep(2 * ELECTION_CHECK_TIME)
-                    self.SubmitBallot()
-
-            # If an election is in progress, determine the winner
-            if self.election_time:
-                self.GetElectionWinner()
-
-    def SubmitBallot(self):
-        """
-        This function submits a ballot to each connected server during an election process.
-        It generates a random election value and adds it to the ballot box along with the server's port and timestamp.
-        It then sends a message to each connected server with the election value.
-        """
-        election_value = random.randint(1, 100)
-        self.ballot_box.append(
-            (self.port,
-             election_value,
-             self.servicer_object.utc_time_gen.now().timestamp()))
-        for port in self.sockets_dict.keys():
-            s = self.sockets_dict[port]
-            msg = wp.encode.ServerElectionBallot(version=1,
-                                                 port=self.port,
-                                                 value=election_value)
+            await asyncio.sleep(REFRESH_TIME)
             try:
-                s.send(msg)
-            except BrokenPipeError:
-                pass
+                self.Tick()
+            except Exception:
+                logging.exception("Heartbeat tick failed")
 
-    def TriggerElection(self):
+    def Tick(self):
         """
-        This function triggers an election process.
-        It clears the ballot box and sends a message to each connected server indicating that an election has been triggered.
+        Sends the heartbeats of one refresh tick, and while secondary asks for
+        a catch-up snapshot if needed. Elections are started by the election
+        timer, not by the tick. Runs on the event loop, sends never block.
         """
-        self.ballot_box = []
-        for port in self.sockets_dict.keys():
-            s = self.sockets_dict[port]
-            msg = wp.encode.ServerElectionTrigger(version=1)
+        self.iter_value += 1
+
+        # Send an update on the current server's status to each connected
+        # server, operations are shipped by the replication task
+        self.SendHeartbeats()
+
+        servicer = self.servicer_object
+        if servicer.server_state == ServerState.PRIMARY and servicer.lease_expiry is not None and \
+                time.monotonic() - servicer.lease_expiry > ELECTION_TIMEOUT_MAX:
+            # a majority has not answered for longer than any election takes,
+            # another primary may have been elected
+            print(f"Lost touch with the majority, stepping down: {self.port}")
+            servicer.server_state = ServerState.SECONDARY
+            self.ResetElectionTimer()
+
+        if self.iter_value % STATUS_PRINT_ITERS == 0:
+            if self.servicer_object.server_state == ServerState.PRIMARY:
+                print(f"term {self.servicer_object.term}", self.replica_metadata, " lag: ", self.ReplicationLag())
+            else:
+                print(f"term {self.servicer_object.term}", self.replica_metadata, " primary: ", self.KnownPrimary(),
+                      " suspicion: ", {port: round(phi, 1) for port, phi in self.detector.suspicion().items()})
+
+        if self.servicer_object.server_state == ServerState.SECONDARY:
+            # the transfer in progress is only touched on the state worker,
+            # where its chunks are received
+            self.RunStateWork(self.CatchUp)
+
+    def CatchUp(self):
+        # Sends the catch-up request of this tick, if any
+        request = self.CatchUpRequest()
+        if request is not None and not self.SendTo(*request):
+            # the connection to the primary is not up yet, ask again on the
+            # next tick rather than a retransmit interval later
+            self.catch_up_iter = self.iter_value - RETRANSMIT_ITERS
+
+    def ReplicationMessage(self, port, built=None):
+        """
+        Picks the operations the primary ships to the peer at `port` this
+        tick: the ones after the last one shipped, or after the last one
+        acknowledged once the peer has not acknowledged anything for
+        RETRANSMIT_ITERS ticks. Peers that have not installed a snapshot from
+        this server request one themselves. A peer that needs operations no
+        longer in the backlog is sent the first chunks of a snapshot instead.
+
+        Args:
+            port (str): The peer.
+            built (dict): Messages built for other peers this round, keyed by
+            the sequence they start after. Peers at the same position share
+            one message instead of encoding the operations again.
+
+        Returns:
+            chat_pb2.ReplicaMessage: The message, None if there is nothing to
+            send.
+        """
+        acked = self.peer_acked.get(port)
+        if acked is None:
+            return None
+        waiting_since = self.peer_waiting_since.get(port)
+        timed_out = waiting_since is not None and self.iter_value - waiting_since >= RETRANSMIT_ITERS
+        after = acked if timed_out else self.peer_sent.get(port, acked)
+        if built is not None and after in built:
+            ops, msg = built[after]
+        else:
+            ops, msg = self.servicer_object.ops_after(after), None
+        if ops is None:
+            self.peer_acked.pop(port, None)
+            self.peer_sent.pop(port, None)
+            self.peer_waiting_since.pop(port, None)
+            self.RunStateWork(self.SendSnapshotChunks, port, "", 0)
+            return None
+        if len(ops) == 0:
+            return None
+        if waiting_since is None or timed_out:
+            self.peer_waiting_since[port] = self.iter_value
+        self.peer_sent[port] = ops[-1]["seq"]
+        if msg is None:
+            msg = chat_pb2.ReplicaMessage(operations=chat_pb2.ReplicatedOperations(
+                source=self.port,
+                term=self.servicer_object.term,
+                ops=[chat_pb2.ReplicatedOperation(
+                    seq=op["seq"], time=op["time"], op=op["op"], args=json.dumps(op["args"]))
+                    for op in ops]))
+            if built is not None:
+                built[after] = (ops, msg)
+        return msg
+
+    def OperationsCommitted(self):
+        # Called by request threads after every commit, wakes the
+        # replication task unless it is about to run anyway
+        if not self.ops_pending:
+            self.ops_pending = True
+            self.loop.call_soon_threadsafe(self.ops_available.set)
+
+    async def replication_task(self):
+        """
+        Ships operations to the secondaries as soon as they commit rather than
+        on the next refresh tick, without waiting for the acknowledgements of
+        earlier ones, so that writes waiting for acknowledgements are only
+        held up by the round trip.
+        """
+        while True:
             try:
-                s.send(msg)
-            except BrokenPipeError:
+                await asyncio.wait_for(self.ops_available.wait(), REFRESH_TIME)
+            except asyncio.TimeoutError:
                 pass
+            self.ops_available.clear()
+            self.ops_pending = False
+            if self.servicer_object.server_state != ServerState.PRIMARY:
+                continue
+            built = {}
+            for port in list(self.sockets_dict.keys()):
+                msg = self.ReplicationMessage(port, built)
+                if msg is not None:
+                    self.SendTo(port, msg)
+
+    def MembershipChanged(self):
+        # Called by the request thread that changed the membership
+        self.loop.call_soon_threadsafe(self.ApplyMembership)
+
+    def ApplyMembership(self):
+        """
+        Connects to the replicas that joined the membership and lets go of
+        the ones that left it, after telling them. Peers that are connected
+        already hear of the change right away, the others through the
+        heartbeats they send. Runs on the event loop.
+
+        A server that starts outside the membership connects to the replicas
+        it knows of until the primary adds it. A member that is removed stops
+        taking part in the cluster.
+        """
+        cluster = self.servicer_object.membership
+        peers = cluster.peers(self.port)
+        if self.port in cluster.replicas:
+            self.member = True
+        elif self.member:
+            print(f"Removed from the cluster: {self.port}")
+            self.servicer_object.server_state = ServerState.BROKEN
+            peers = {}
+        msg = self.MembershipMessage()
+        for port in list(self.sockets_dict.keys()):
+            if port not in peers:
+                self.SendHeartbeat(port, msg)
+                self.loop.call_later(REFRESH_TIME, self.DropPeer, port)
+        for port, address in peers.items():
+            if port not in self.sockets_dict:
+                self.loop.create_task(self.ConnectPeer(port, address))
+            else:
+                self.SendHeartbeat(port, msg)
+
+    def DropPeer(self, port):
+        # Disconnects a peer that left the membership, unless it was added
+        # back in the meantime
+        if self.servicer_object.server_state == ServerState.BROKEN or \
+                port not in self.servicer_object.membership.peers(self.port):
+            self.loop.create_task(self.DisconnectPeer(port))
+
+    def MembershipMessage(self):
+        return chat_pb2.ReplicaMessage(membership=self.servicer_object.membership.to_proto())
+
+    def PeerReady(self, port):
+        """
+        Sends this server's status to the peer at `port` as soon as the
+        connection to it comes up, rather than on the next tick. Both sides
+        do so, which is the readiness handshake of replicas starting up: each
+        learns that the other is up, its term, position and log position.
+        """
+        self.SendHeartbeat(port, self.StatusMessage())
 
-    def GetElectionWinner(self):
-        """
-        This function waits for a certain amount of time after an election has been triggered and then determines the winner.
-        It sorts the ballot box by election value and timestamp and selects the candidate with the highest value and most recent timestamp.
-        If the current server is the winner, it updates its status to `ServerState.PRIMARY`.
-        """
-        time.sleep(8 * ELECTION_CHECK_TIME)
-        # declare winner
-        print("Ballot Box", self.ballot_box)
-        primary_winner = sorted(
-            self.ballot_box, key=lambda x: (x[1], -x[2]))[-1][0]
-        print("Primary Winner: ", primary_winner)
-        if self.port == primary_winner:
-            self.servicer_object.server_state = ServerState.PRIMARY
-            print(
-                f"This Server is the new primary: {self.port}",
-                "state: ",
-                self.servicer_object.server_state)
+    def StatusMessage(self):
+        # This server's heartbeat, with its replication position
+        data_term, applied_seq = self.servicer_object.log_position()
+        return chat_pb2.ReplicaMessage(status=chat_pb2.ServerStatusUpdate(
+            version=1,
+            port=self.port,
+            position=f"{self.servicer_object.server_state}",
+            wal_seq=self.servicer_object.wal_seq,
+            replication_source=self.servicer_object.replication_source or "",
+            replicated_seq=self.servicer_object.replicated_seq,
+            membership_version=self.servicer_object.membership.version,
+            term=self.servicer_object.term,
+            applied_seq=applied_seq,
+            data_term=data_term))
+
+    def SendHeartbeats(self):
+        """
+        Sends this server's status to every peer. A primary numbers its
+        heartbeats and remembers when it sent them, the secondaries' acks
+        renew its lease.
+        """
+        msg = self.StatusMessage()
+        if self.servicer_object.server_state == ServerState.PRIMARY:
+            self.heartbeat_seq += 1
+            msg.status.heartbeat_seq = self.heartbeat_seq
+            self.heartbeats_sent[self.heartbeat_seq] = time.monotonic()
+            if len(self.heartbeats_sent) > HEARTBEATS_KEPT:
+                self.heartbeats_sent.popitem(last=False)
+            self.RenewLease()
+        for port in self.sockets_dict.keys():
+            self.SendHeartbeat(port, msg)
+
+    def ReceiveHeartbeatAck(self, ack):
+        servicer = self.servicer_object
+        if servicer.server_state != ServerState.PRIMARY or ack.term != servicer.term:
+            return
+        sent = self.heartbeats_sent.get(ack.heartbeat_seq)
+        if sent is not None and sent > self.peer_heartbeat_acked.get(ack.port, 0.0):
+            self.peer_heartbeat_acked[ack.port] = sent
+            self.RenewLease()
+
+    def RenewLease(self):
+        """
+        Extends the primary's lease to LEASE_TIME after the latest heartbeat
+        acknowledged by a majority of the membership, this server included.
+        """
+        servicer = self.servicer_object
+        if servicer.lease_expiry is None:
+            return
+        members = servicer.membership.replicas
+        needed = self.Quorum() - (1 if self.port in members else 0)
+        if needed <= 0:
+            renewed = time.monotonic()
         else:
-            self.servicer_object.server_state = ServerState.SECONDARY
-        # label any broken ports
-        for port in self.replica_metadata.keys():
-            if port != primary_winner and self.replica_metadata[
-                    port][0] == f"{ServerState.PRIMARY}":
-                self.replica_metadata[port] = (f"{ServerState.BROKEN}", self.servicer_object.utc_time_gen.now().timestamp())
-        self.election_time = False
+            acked = sorted((self.peer_heartbeat_acked.get(port, 0.0) for port in members if port != self.port),
+                           reverse=True)
+            if len(acked) < needed or acked[needed - 1] == 0.0:
+                return
+            renewed = acked[needed - 1]
+        servicer.lease_expiry = max(servicer.lease_expiry, renewed + LEASE_TIME)
+
+    def ReplicationLag(self):
+        """
+        Returns:
+            dict: port -> operations the peer is behind this server, per peer
+            whose last heartbeat said it follows this server.
+        """
+        return {port: self.servicer_object.wal_seq - replicated_seq
+                for port, (_, source, replicated_seq) in self.peer_positions.items()
+                if source == self.port}
+
+    def AckMessage(self):
+        # The secondary's acknowledgement of the operations it applied
+        return chat_pb2.ReplicaMessage(ack=chat_pb2.ReplicationAck(
+            port=self.port,
+            source=self.servicer_object.replication_source or "",
+            seq=self.servicer_object.replicated_seq))
+
+    def ReceiveAck(self, port, source, seq):
+        """
+        Records that the peer at `port` applied the operations of the primary
+        at `source` up to `seq`.
+        """
+        if source != self.port:
+            # the peer still follows another primary
+            self.peer_acked.pop(port, None)
+            self.servicer_object.record_replica_ack(port, None)
+            return
+        previous = self.peer_acked.get(port)
+        if previous is not None and seq < previous:
+            # heartbeats carry acks as well, and may overtake a newer one
+            return
+        self.servicer_object.record_replica_ack(port, seq)
+        self.peer_acked[port] = seq
+        if seq >= self.peer_sent.get(port, seq):
+            self.peer_sent[port] = seq
+            self.peer_waiting_since.pop(port, None)
+        elif previous is None or seq > previous:
+            # still behind but making progress
+            self.peer_waiting_since[port] = self.iter_value
+
+    def SendTo(self, port, msg):
+        # Queues msg for the peer without blocking, returns False if the peer
+        # is not connected or its queue is full
+        s = self.sockets_dict.get(port)
+        if s is None:
+            return False
+        return s.send(msg)
+
+    def SendHeartbeat(self, port, msg):
+        # Like SendTo, on the heartbeat stream of the peer if it has one
+        s = self.heartbeat_dict.get(port, self.sockets_dict.get(port))
+        if s is None:
+            return False
+        return s.send(msg)
+
+    def SendSnapshotChunks(self, port, snapshot_id, offset):
+        """
+        Sends the peer at `port` one window of SNAPSHOT_WINDOW_CHUNKS chunks
+        of the catch-up snapshot, from `offset` on. A transfer of a snapshot
+        that is no longer handed out starts over with the current one.
+        """
+        snapshot = self.servicer_object.get_transfer_snapshot(self.port)
+        if snapshot["id"] != snapshot_id:
+            offset = 0
+        end = min(snapshot["size"], offset + SNAPSHOT_WINDOW_CHUNKS * SNAPSHOT_CHUNK_BYTES)
+        # only the window is read from the snapshot file
+        with open(snapshot["path"], "rb") as snapshot_file:
+            snapshot_file.seek(offset)
+            for chunk_offset in range(offset, end, SNAPSHOT_CHUNK_BYTES):
+                chunk = snapshot_file.read(min(end, chunk_offset + SNAPSHOT_CHUNK_BYTES) - chunk_offset)
+                msg = chat_pb2.ReplicaMessage(snapshot_chunk=chat_pb2.SnapshotChunk(
+                    port=self.port,
+                    snapshot_id=snapshot["id"],
+                    offset=chunk_offset,
+                    total=snapshot["size"],
+                    checksum=snapshot["checksum"],
+                    chunk_checksum=zlib.crc32(chunk),
+                    data=chunk,
+                    term=self.servicer_object.term))
+                if not self.SendTo(port, msg):
+                    return
+
+    def KnownPrimary(self):
+        # The peer that most recently reported being primary, unless the
+        # failure detector suspects it is down. Also called from request
+        # threads, for redirect hints.
+        primaries = [(t, port) for port, (pos, t) in list(self.replica_metadata.items())
+                     if pos == f"{ServerState.PRIMARY}" and not self.detector.suspected(port)]
+        if len(primaries) == 0:
+            return None
+        return max(primaries)[1]
+
+    def ReplicaLive(self, port):
+        # Whether the replication stream to the peer is up and the failure
+        # detector does not suspect it. Called from request threads.
+        stream = self.sockets_dict.get(port)
+        return stream is not None and stream.ready and not self.detector.suspected(port)
+
+    def CatchUpRequest(self):
+        """
+        Asks the primary to bring this secondary up to date while it does not
+        follow the primary's operations. The first request offers where this
+        server's state is in the log it last followed, which the primary
+        resumes from if its own log goes through that state. Otherwise the
+        primary sends a snapshot, and the current transfer is resumed from
+        the last chunk received. Nothing is asked while chunks keep
+        arriving, and at most once every RETRANSMIT_ITERS ticks otherwise.
 
+        Returns:
+            (str, chat_pb2.ReplicaMessage): The port to send the request to
+            and the request, None if there is nothing to ask.
+        """
+        servicer = self.servicer_object
+        download = self.download
+        primary = download["source"] if download is not None else self.KnownPrimary()
+        if primary is None or servicer.replication_source == primary:
+            return None
+        if self.iter_value - self.catch_up_iter < RETRANSMIT_ITERS:
+            return None
+        self.catch_up_iter = self.iter_value
+        if download is not None:
+            download["window_end"] = download["offset"] + SNAPSHOT_WINDOW_CHUNKS * SNAPSHOT_CHUNK_BYTES
+            return primary, chat_pb2.ReplicaMessage(snapshot_request=chat_pb2.SnapshotRequest(
+                port=self.port, snapshot_id=download["id"], offset=download["offset"]))
+        source, seq = servicer.applied_position()
+        return primary, chat_pb2.ReplicaMessage(snapshot_request=chat_pb2.SnapshotRequest(
+            port=self.port, resume_source=source or "", resume_seq=seq))
+
+    def ResumeReplication(self, port, source, seq):
+        """
+        Lets the secondary at `port`, whose state is the one reached by the
+        log of the primary at `source` up to `seq`, follow this server's
+        operations from where that state is in this server's log.
 
-def serve(position, external_port, internal_port, log_file, timeout=None):
+        Returns:
+            bool: False if this server's log does not go through that state
+            or no longer holds the operations after it, the secondary needs
+            a snapshot then.
+        """
+        servicer = self.servicer_object
+        local_seq = servicer.local_seq(source, seq)
+        if local_seq is None or servicer.ops_after(local_seq) is None:
+            return False
+        self.SendTo(port, chat_pb2.ReplicaMessage(resume=chat_pb2.ReplicationResume(
+            source=self.port, term=servicer.term, resume_source=source, resume_seq=seq, seq=local_seq)))
+        return True
+
+    def ReceiveSnapshotChunk(self, chunk):
+        """
+        Appends a chunk of a catch-up snapshot to the partial snapshot file
+        and installs the snapshot once all of it arrived and its checksum
+        matches. Chunks that do not continue the transfer are dropped and
+        asked for again once the transfer stalls.
+        """
+        download = self.download
+        if download is None or download["id"] != chunk.snapshot_id:
+            if chunk.offset != 0:
+                return
+            if download is not None:
+                download["file"].close()
+            path = self.servicer_object.state_file + ".partial"
+            download = {
+                "id": chunk.snapshot_id,
+                "source": chunk.port,
+                "term": chunk.term,
+                "total": chunk.total,
+                "checksum": chunk.checksum,
+                # CRC32 of the chunks received so far
+                "received_checksum": 0,
+                "offset": 0,
+                "window_end": SNAPSHOT_WINDOW_CHUNKS * SNAPSHOT_CHUNK_BYTES,
+                "path": path,
+                "file": open(path, "wb"),
+                }
+            self.download = download
+            # operations are applied again on top of the new snapshot
+            self.servicer_object.replication_source = None
+        if chunk.offset != download["offset"] or zlib.crc32(chunk.data) != chunk.chunk_checksum:
+            return
+        download["file"].write(chunk.data)
+        download["received_checksum"] = zlib.crc32(chunk.data, download["received_checksum"])
+        download["offset"] += len(chunk.data)
+        self.catch_up_iter = self.iter_value
+        if download["offset"] < download["total"]:
+            if download["offset"] >= download["window_end"]:
+                # the window arrived, ask for the next one
+                download["window_end"] = download["offset"] + SNAPSHOT_WINDOW_CHUNKS * SNAPSHOT_CHUNK_BYTES
+                self.SendTo(download["source"], chat_pb2.ReplicaMessage(
+                    snapshot_request=chat_pb2.SnapshotRequest(
+                        port=self.port, snapshot_id=download["id"], offset=download["offset"])))
+            return
+        self.download = None
+        download["file"].close()
+        if download["received_checksum"] != download["checksum"]:
+            os.remove(download["path"])
+            self.servicer_object.commit_log.error(
+                f"Snapshot {download['id']} from {download['source']} failed its checksum")
+            return
+        # read back user by user, the file is never loaded whole
+        installed = self.servicer_object.install_transfer_snapshot(download["path"], download["source"])
+        os.remove(download["path"])
+        if not installed:
+            return
+        if self.servicer_object.replication_source == download["source"]:
+            self.servicer_object.set_data_term(download["term"])
+        # the primary starts shipping operations once it hears where to start
+        self.SendTo(download["source"], self.AckMessage())
+
+    def StartElections(self):
+        """
+        Arms the election timer. From now on a server that does not hear
+        from a primary of its term for an election timeout stands for
+        election.
+        """
+        self.elections = True
+        # leases are only sound while elections respect them, the lease
+        # starts out lapsed
+        self.servicer_object.lease_expiry = time.monotonic()
+        self.ResetElectionTimer()
+
+    def ResetElectionTimer(self, low=ELECTION_TIMEOUT_MIN, high=ELECTION_TIMEOUT_MAX):
+        # Called on the event loop whenever the primary is heard from or a
+        # vote is cast, each election timeout is drawn anew
+        if self.election_timer is not None:
+            self.election_timer.cancel()
+            self.election_timer = None
+        if self.elections and self.servicer_object.server_state != ServerState.PRIMARY:
+            self.election_timer = self.loop.call_later(random.uniform(low, high), self.StartElection)
+
+    def Quorum(self):
+        # Votes needed to win an election, a majority of the membership
+        return len(self.servicer_object.membership.replicas) // 2 + 1
+
+    def LivePeers(self):
+        """
+        Returns:
+            dict: port -> (position, (data_term, applied_seq)) of the
+            members the failure detector does not suspect.
+        """
+        members = self.servicer_object.membership.replicas
+        return {port: status for port, status in self.peer_status.items()
+                if port in members and not self.detector.suspected(port)}
+
+    def QuorumKnown(self):
+        # Whether this server and the members it hears from make a majority,
+        # without one no election can be won
+        return len(self.LivePeers()) + 1 >= self.Quorum()
+
+    def StartElection(self):
+        """
+        Stands for primary in the next term: votes for itself and asks every
+        peer for its vote. If no candidate wins before the next election
+        timeout, a new election is started in the term after. Only members of
+        the cluster stand for election, and only once the failure detector
+        suspects the primary of the current term.
+        """
+        self.election_timer = None
+        servicer = self.servicer_object
+        if servicer.server_state in (ServerState.PRIMARY, ServerState.BROKEN):
+            return
+        if self.port not in servicer.membership.replicas:
+            self.ResetElectionTimer()
+            return
+        if self.KnownPrimary() is not None:
+            # the primary is late, but no later than it has been before.
+            # Looked at again a random while later, so that the replicas do
+            # not all stand at once when it is suspected.
+            self.ResetElectionTimer(REFRESH_TIME, ELECTION_TIMEOUT_MAX - ELECTION_TIMEOUT_MIN)
+            return
+        live = self.LivePeers()
+        if len(live) + 1 < self.Quorum():
+            # too few replicas are up to win, standing would only run up
+            # the term
+            self.ResetElectionTimer()
+            return
+        if any(position != f"{ServerState.PRIMARY}" and log_position > servicer.log_position()
+               for position, log_position in live.values()):
+            # a replica with a more recent state is up and stands instead,
+            # this one would not get its vote
+            self.ResetElectionTimer()
+            return
+        servicer.set_term(servicer.term + 1, voted_for=self.port)
+        servicer.server_state = ServerState.ELECTION
+        print(f"Standing for election in term {servicer.term}: {self.port}")
+        self.votes = {self.port}
+        data_term, applied_seq = servicer.log_position()
+        msg = chat_pb2.ReplicaMessage(vote_request=chat_pb2.VoteRequest(
+            term=servicer.term, port=self.port, data_term=data_term, applied_seq=applied_seq))
+        for port in self.sockets_dict.keys():
+            self.SendHeartbeat(port, msg)
+        self.ResetElectionTimer()
+        self.CountVotes()
+
+    def ObserveTerm(self, term):
+        """
+        Moves to `term` if a peer is in a later term than this server,
+        stepping down if this server is primary or candidate.
+
+        Returns:
+            bool: False if `term` is earlier than this server's term, the
+            message carrying it comes from a deposed primary or an old
+            election.
+        """
+        servicer = self.servicer_object
+        if term < servicer.term:
+            return False
+        if term > servicer.term:
+            servicer.set_term(term)
+            if servicer.server_state in (ServerState.PRIMARY, ServerState.ELECTION):
+                print(f"Stepping down in term {term}: {self.port}")
+                servicer.server_state = ServerState.SECONDARY
+            # primaries of earlier terms are no longer followed
+            now = servicer.utc_time_gen.now().timestamp()
+            for port, (pos, _) in list(self.replica_metadata.items()):
+                if pos == f"{ServerState.PRIMARY}":
+                    self.replica_metadata[port] = (f"{ServerState.BROKEN}", now)
+            self.ResetElectionTimer()
+        return True
+
+    def ReceiveVoteRequest(self, request):
+        """
+        Votes for the candidate if this server has not voted for anyone else
+        in the term and the candidate's state is at least as recent as its
+        own, so the most up-to-date replicas win elections. The vote is
+        written to disk before it is sent.
+
+        While the primary may still hold a lease, that is while this server
+        is primary with a valid lease or heard from the primary within
+        ELECTION_TIMEOUT_MIN, the request is ignored altogether.
+        """
+        servicer = self.servicer_object
+        if (servicer.lease_expiry is not None and servicer.has_lease()) or \
+                (self.primary_heard is not None and time.monotonic() - self.primary_heard < ELECTION_TIMEOUT_MIN):
+            return
+        self.ObserveTerm(request.term)
+        granted = (request.term == servicer.term and
+                   servicer.server_state != ServerState.PRIMARY and
+                   servicer.voted_for in (None, request.port) and
+                   (request.data_term, request.applied_seq) >= servicer.log_position())
+        if granted:
+            servicer.set_term(request.term, voted_for=request.port)
+            self.ResetElectionTimer()
+        self.SendHeartbeat(request.port, chat_pb2.ReplicaMessage(vote=chat_pb2.Vote(
+            term=servicer.term, port=self.port, granted=granted)))
+
+    def ReceiveVote(self, vote):
+        self.ObserveTerm(vote.term)
+        servicer = self.servicer_object
+        if servicer.server_state == ServerState.ELECTION and vote.term == servicer.term and vote.granted:
+            self.votes.add(vote.port)
+            self.CountVotes()
+
+    def CountVotes(self):
+        # Becomes primary once a majority of the members voted for this server
+        servicer = self.servicer_object
+        if servicer.server_state != ServerState.ELECTION:
+            return
+        if len(self.votes & set(servicer.membership.replicas)) >= self.Quorum():
+            self.BecomePrimary()
+
+    def BecomePrimary(self):
+        """
+        Takes over as primary of the current term and tells the peers right
+        away, rather than on the next tick.
+        """
+        servicer = self.servicer_object
+        servicer.server_state = ServerState.PRIMARY
+        servicer.set_data_term(servicer.term)
+        # operations committed from now on are this server's own, the
+        # secondaries resume from where their state is in its log
+        servicer.replication_source = self.port
+        if self.election_timer is not None:
+            self.election_timer.cancel()
+            self.election_timer = None
+        # peers are resynced before they get operations from this server
+        self.peer_acked = {}
+        self.peer_sent = {}
+        self.peer_waiting_since = {}
+        for port in list(servicer.replica_acks):
+            servicer.record_replica_ack(port, None)
+        # the lease starts with the acks of this term's heartbeats
+        self.peer_heartbeat_acked = {}
+        self.primary_heard = None
+        if servicer.lease_expiry is not None:
+            servicer.lease_expiry = time.monotonic()
+        print(f"This Server is the new primary in term {servicer.term}: {self.port}")
+        self.SendHeartbeats()
+
+    def FollowPrimary(self, port):
+        """
+        Follows the primary at `port`, which sent a heartbeat in this server's
+        term: an election this server stands in is lost and the election
+        timer starts over. State from an earlier primary is kept, the next
+        catch-up request asks this one to resume from it, see CatchUpRequest.
+        """
+        servicer = self.servicer_object
+        if servicer.server_state == ServerState.ELECTION:
+            servicer.server_state = ServerState.SECONDARY
+        self.primary_heard = time.monotonic()
+        self.ResetElectionTimer()
+
+
+def serve(position,
+          external_port,
+          internal_port,
+          log_file,
+          timeout=None,
+          checkpoint_interval=storage.checkpoint.DEFAULT_CHECKPOINT_INTERVAL,
+          checkpoint_bytes=storage.checkpoint.DEFAULT_CHECKPOINT_BYTES,
+          wal_archive_dir=None,
+          durability=storage.wal.DEFAULT_DURABILITY,
+          wal_batch_window=storage.wal.DEFAULT_BATCH_WINDOW,
+          wal_queue_size=storage.wal.DEFAULT_QUEUE_SIZE,
+          inbox_segments=False,
+          storage_backend=storage.backends.DEFAULT_BACKEND,
+          sqlite_batch=storage.backends.DEFAULT_SQLITE_BATCH,
+          replication_mode=DEFAULT_REPLICATION_MODE,
+          replication_timeout=DEFAULT_REPLICATION_TIMEOUT,
+          replication_waiters=DEFAULT_REPLICATION_WAITERS,
+          cluster_config=None,
+          log_dir="logs"):
     """
     This function sets up a gRPC server and starts a thread for inter-server communication.
     The `position` parameter specifies the position of the server in the system (primary or secondary).
     The `external_port` parameter specifies the port number that external clients will use to connect to the server.
     The `internal_port` parameter specifies the port number that other instances of the server will use to communicate with this instance.
+    The `checkpoint_interval` and `checkpoint_bytes` parameters set how often (in seconds and in bytes of
+    write-ahead log) a snapshot is taken and the log is compacted. Compacted log segments are moved to
+    `wal_archive_dir` if it is given and deleted otherwise.
+    The `durability` parameter selects when replies are released relative to the write-ahead log
+    ("none", "async" or "fsync-per-batch"), and `wal_batch_window` how long the log writer waits
+    for more operations before committing a batch. `wal_queue_size` bounds the number of operations
+    waiting for the log writer thread, request handlers block before replying once it is full.
+    With `inbox_segments`, undelivered messages are kept in per-user segment files under `log_dir` instead of in memory.
+    `storage_backend` selects where the state lives ("memory" or "sqlite"), with the SQLite backend
+    committing every `sqlite_batch` operations and at every checkpoint.
+    `replication_mode` selects when the primary replies to a write: right away ("async"), once one
+    secondary acknowledged it ("semi-sync") or once all of them did ("sync"), waiting at most
+    `replication_timeout` seconds, with at most `replication_waiters` writes waiting at a time.
+    `cluster_config` is the JSON membership file the replicas are read from and changes to the
+    membership are written to, the default replicas are used if it is not given.
+    The state, write-ahead log and election state of the server are kept under `log_dir`.
     """
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    servicer_object = ChatServer(position=position, log_filename=log_file)
+    cluster = membership.Membership.load(cluster_config) if cluster_config is not None else membership.Membership()
+    # writes waiting for acknowledgements get workers of their own
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=RPC_WORKERS + replication_waiters))
+    servicer_object = ChatServer(position=position,
+                                 log_filename=log_file,
+                                 log_dir=log_dir,
+                                 durability=durability,
+                                 wal_batch_window=wal_batch_window,
+                                 wal_queue_size=wal_queue_size,
+                                 inbox_segments=inbox_segments,
+                                 storage_backend=storage_backend,
+                                 sqlite_batch=sqlite_batch,
+                                 replication_mode=replication_mode,
+                                 replication_timeout=replication_timeout,
+                                 replication_waiters=replication_waiters,
+                                 cluster=cluster)
     chat_pb2_grpc.add_ChatServerServicer_to_server(servicer_object, server)
     server.add_insecure_port('[::]:' + external_port)
     interface = ServerInterface(
@@ -787,8 +2564,14 @@ def serve(position, external_port, internal_port, log_file, timeout=None):
         port=internal_port)
     interface_thread = th.Thread(
         target=interface.inter_server_communication_thread)
+    checkpointer = storage.checkpoint.Checkpointer(
+        servicer_object,
+        interval=checkpoint_interval,
+        max_wal_bytes=checkpoint_bytes,
+        archive_dir=wal_archive_dir)
     server.start()
     interface_thread.start()
+    checkpointer.start()
 
     print("Server started, listening on " + internal_port)
     server.wait_for_termination()
@@ -813,6 +2596,76 @@ if __name__ == '__main__':
         '--timeout',
         default=None,
         help="option that determines the number of seconds till death")
+    parser.add_argument(
+        '--checkpoint-interval',
+        type=float,
+        default=storage.checkpoint.DEFAULT_CHECKPOINT_INTERVAL,
+        help="seconds between state snapshots / write-ahead log compaction")
+    parser.add_argument(
+        '--checkpoint-bytes',
+        type=int,
+        default=storage.checkpoint.DEFAULT_CHECKPOINT_BYTES,
+        help="bytes of write-ahead log that trigger an early snapshot")
+    parser.add_argument(
+        '--wal-archive-dir',
+        default=None,
+        help="move compacted write-ahead log segments here instead of deleting them")
+    parser.add_argument(
+        '--durability',
+        choices=storage.wal.DURABILITY_MODES,
+        default=storage.wal.DEFAULT_DURABILITY,
+        help="none: no fsync, async: fsync in the background, "
+             "fsync-per-batch: reply once the batch is fsynced")
+    parser.add_argument(
+        '--wal-batch-window',
+        type=float,
+        default=storage.wal.DEFAULT_BATCH_WINDOW,
+        help="seconds the log writer waits to gather a group commit batch")
+    parser.add_argument(
+        '--wal-queue-size',
+        type=int,
+        default=storage.wal.DEFAULT_QUEUE_SIZE,
+        help="operations that may wait for the log writer before requests block")
+    parser.add_argument(
+        '--inbox-segments',
+        action='store_true',
+        help="keep inboxes in per-user segment files under the log directory instead of in memory")
+    parser.add_argument(
+        '--storage',
+        choices=storage.backends.BACKENDS,
+        default=storage.backends.DEFAULT_BACKEND,
+        help="where the server state is kept, sqlite stores it in state_store_<log_file>.db under the log directory")
+    parser.add_argument(
+        '--sqlite-batch',
+        type=int,
+        default=storage.backends.DEFAULT_SQLITE_BATCH,
+        help="operations per SQLite transaction")
+    parser.add_argument(
+        '--replication-mode',
+        choices=REPLICATION_MODES,
+        default=DEFAULT_REPLICATION_MODE,
+        help="async: reply to writes right away, semi-sync: once one secondary acknowledged them, "
+             "sync: once every secondary did")
+    parser.add_argument(
+        '--replication-timeout',
+        type=float,
+        default=DEFAULT_REPLICATION_TIMEOUT,
+        help="seconds a write waits for secondary acknowledgements before it is replied to anyway")
+    parser.add_argument(
+        '--replication-waiters',
+        type=int,
+        default=DEFAULT_REPLICATION_WAITERS,
+        help="writes that may wait for secondary acknowledgements at the same time, each holding a "
+             "request thread, further writes are replied to without waiting")
+    parser.add_argument(
+        '--cluster-config',
+        default=None,
+        help="JSON file listing the replicas of the cluster, kept up to date as replicas are added "
+             "and removed, the default three replicas if not set")
+    parser.add_argument(
+        '--log-dir',
+        default="logs",
+        help="directory for the state, write-ahead log and election state of the server")
     args = parser.parse_args()
     if args.position == 'p':
         position = ServerState.PRIMARY
@@ -820,4 +2673,22 @@ if __name__ == '__main__':
         position = ServerState.SECONDARY
 
     print(args)
-    serve(position, args.external_port, args.internal_port, args.log_file, args.timeout)
+    serve(position,
+          args.external_port,
+          args.internal_port,
+          args.log_file,
+          args.timeout,
+          checkpoint_interval=args.checkpoint_interval,
+          checkpoint_bytes=args.checkpoint_bytes,
+          wal_archive_dir=args.wal_archive_dir,
+          durability=args.durability,
+          wal_batch_window=args.wal_batch_window,
+          wal_queue_size=args.wal_queue_size,
+          inbox_segments=args.inbox_segments,
+          storage_backend=args.storage,
+          sqlite_batch=args.sqlite_batch,
+          replication_mode=args.replication_mode,
+          replication_timeout=args.replication_timeout,
+          replication_waiters=args.replication_waiters,
+          cluster_config=args.cluster_config,
+          log_dir=args.log_dir)
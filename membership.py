@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import threading as th
+from collections import namedtuple
+
+import grpc
+
+import chat_pb2
+import chat_pb2_grpc
+
+SECONDARY_ERROR_CODE = "Secondary server response"
+
+# host, port clients connect to, port of the replication service
+Replica = namedtuple("Replica", ["host", "external_port", "internal_port"])
+
+DEFAULT_REPLICAS = [Replica("10.250.21.56", "50051", "50054"),
+                    Replica("10.250.156.238", "50052", "50055"),
+                    Replica("10.250.156.238", "50053", "50056")]
+
+# DEFAULT_REPLICAS = [Replica("0.0.0.0", "50051", "50054"),
+#                     Replica("0.0.0.0", "50052", "50055"),
+#                     Replica("0.0.0.0", "50053", "50056")]
+
+
+class Membership:
+    """
+    The replicas of the cluster, keyed by internal port, and a version that
+    every change bumps. Only the primary changes the membership, the other
+    replicas adopt any newer version they hear of.
+
+    With a `path` the membership is read from and written back to a JSON
+    file, {"version": ..., "replicas": [{"host": ..., "external_port": ...,
+    "internal_port": ...}, ...]}, so a restarted replica comes back with the
+    membership it last knew.
+    """
+
+    def __init__(self, replicas=DEFAULT_REPLICAS, version=1, path=None):
+        self.replicas = {replica.internal_port: replica for replica in replicas}
+        self.version = version
+        self.path = path
+        # request threads change the membership, the interface reads it.
+        # Changes replace `replicas` instead of mutating it, so the event
+        # loop can iterate it without taking the lock.
+        self.lock = th.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns:
+            Membership: The membership in the file at `path`, the default
+            replicas if there is no such file yet.
+        """
+        if not os.path.exists(path):
+            return cls(path=path)
+        with open(path) as config_file:
+            config = json.load(config_file)
+        replicas = [Replica(str(replica["host"]), str(replica["external_port"]), str(replica["internal_port"]))
+                    for replica in config["replicas"]]
+        return cls(replicas, config.get("version", 1), path)
+
+    def save(self):
+        # Caller must hold lock
+        if self.path is None:
+            return
+        config = {"version": self.version,
+                  "replicas": [replica._asdict() for replica in self.replicas.values()]}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as config_file:
+            json.dump(config, config_file, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def add(self, replica):
+        """
+        Adds `replica`, or updates the addresses of the replica with its
+        internal port.
+        """
+        with self.lock:
+            self.replicas = {**self.replicas, replica.internal_port: replica}
+            self.version += 1
+            self.save()
+
+    def remove(self, internal_port):
+        """
+        Returns:
+            bool: False if there is no replica with `internal_port`.
+        """
+        with self.lock:
+            if internal_port not in self.replicas:
+                return False
+            self.replicas = {port: replica for port, replica in self.replicas.items() if port != internal_port}
+            self.version += 1
+            self.save()
+            return True
+
+    def adopt(self, message):
+        """
+        Takes over the membership in `message` if it is newer than this one.
+
+        Args:
+            message (chat_pb2.ClusterMembership): The membership a peer sent.
+
+        Returns:
+            bool: False if the membership was not newer.
+        """
+        with self.lock:
+            if message.version <= self.version:
+                return False
+            self.replicas = {replica.internal_port: Replica(replica.host, replica.external_port, replica.internal_port)
+                             for replica in message.replicas}
+            self.version = message.version
+            self.save()
+            return True
+
+    def peers(self, port):
+        """
+        Returns:
+            dict: internal port -> "host:internal port" of every replica but
+            the one at `port`.
+        """
+        with self.lock:
+            return {replica.internal_port: f"{replica.host}:{replica.internal_port}"
+                    for replica in self.replicas.values() if replica.internal_port != port}
+
+    def client_addresses(self):
+        """
+        Returns:
+            (list, list): The hosts and external ports of the replicas, as
+            client.ClientStub takes them.
+        """
+        with self.lock:
+            return ([replica.host for replica in self.replicas.values()],
+                    [int(replica.external_port) for replica in self.replicas.values()])
+
+    def to_proto(self):
+        with self.lock:
+            return chat_pb2.ClusterMembership(
+                version=self.version,
+                replicas=[chat_pb2.ReplicaMember(**replica._asdict()) for replica in self.replicas.values()])
+
+
+def change_membership(membership, method, replica):
+    """
+    Sends a membership change to every replica, the primary applies it and
+    the secondaries turn it down.
+
+    Args:
+        membership (Membership): The replicas to try.
+        method (str): "AddReplica" or "RemoveReplica".
+        replica (Replica): The replica to add or remove.
+
+    Returns:
+        chat_pb2.MembershipChangeReply: The primary's reply, None if no
+        replica accepted the change.
+    """
+    request = chat_pb2.MembershipChangeRequest(version=1, replica=chat_pb2.ReplicaMember(**replica._asdict()))
+    for host, port in zip(*membership.client_addresses()):
+        with grpc.insecure_channel(f"{host}:{port}") as channel:
+            try:
+                reply = getattr(chat_pb2_grpc.ChatServerStub(channel), method)(request, timeout=5)
+            except grpc.RpcError:
+                continue
+        if reply.error_code != SECONDARY_ERROR_CODE:
+            return reply
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='membership',
+        description='Adds a replica to or removes one from a running cluster')
+    parser.add_argument('--cluster-config', default=None,
+                        help="JSON membership file listing the current replicas, the default replicas if not set")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help="add a replica, which then catches up from the primary")
+    add_parser.add_argument('host')
+    add_parser.add_argument('external_port')
+    add_parser.add_argument('internal_port')
+    remove_parser = subparsers.add_parser('remove', help="remove the replica with the given internal port")
+    remove_parser.add_argument('internal_port')
+    args = parser.parse_args()
+
+    current = Membership.load(args.cluster_config) if args.cluster_config is not None else Membership()
+    if args.command == 'add':
+        reply = change_membership(current, "AddReplica",
+                                  Replica(args.host, args.external_port, args.internal_port))
+    else:
+        reply = change_membership(current, "RemoveReplica", Replica("", "", args.internal_port))
+    if reply is None:
+        print("No primary accepted the change")
+    elif reply.error_code != "":
+        print(f"Change refused: {reply.error_code}")
+    else:
+        print(f"Membership version {reply.membership.version}:")
+        for member in reply.membership.replicas:
+            print(f"  {member.host} external {member.external_port} internal {member.internal_port}")
@@ -0,0 +1,146 @@
+import argparse
+import asyncio
+import shutil
+import socket
+import statistics
+import tempfile
+import threading as th
+import time
+from concurrent import futures
+
+from colorama import Fore, Style
+
+import chat_pb2
+import grpc_server
+import storage
+from grpc_server import ChatServer, ServerInterface, ServerState
+
+
+def FreePort() -> str:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return str(s.getsockname()[1])
+
+
+def OnLoop(interface: ServerInterface, coroutine):
+    # Runs a coroutine on the event loop of the interface and waits for it
+    return asyncio.run_coroutine_threadsafe(coroutine, interface.loop).result()
+
+
+def StartCluster(log_dir: str, mode: str, durability: str):
+    """
+    Starts a primary and two secondaries in this process, connected to each
+    other over loopback like the replicas of a real deployment, and waits
+    until both secondaries installed the primary's snapshot. gRPC's asyncio
+    support polls on one event loop per process, so the replicas share it.
+
+    Returns:
+        (ChatServer, list): The primary and the interfaces of all replicas.
+    """
+    ports = [FreePort() for _ in range(3)]
+    loop = asyncio.new_event_loop()
+    th.Thread(target=loop.run_forever, daemon=True).start()
+    interfaces = []
+    for i, port in enumerate(ports):
+        position = ServerState.PRIMARY if i == 0 else ServerState.SECONDARY
+        servicer = ChatServer(position, f"bench{i}", log_dir=log_dir, durability=durability,
+                              replication_mode=mode)
+        interface = ServerInterface(servicer, port)
+        interface.attach_loop(loop)
+        OnLoop(interface, interface.init_listening_interface())
+        interfaces.append(interface)
+    for interface in interfaces:
+        for port in ports:
+            if port != interface.port:
+                OnLoop(interface, interface.ConnectPeer(port, f"127.0.0.1:{port}"))
+    # The replication services of the peers may still be starting up
+    while not all(stream.ready for interface in interfaces for stream in interface.sockets_dict.values()):
+        time.sleep(0.01)
+
+    primary = interfaces[0]
+    asyncio.run_coroutine_threadsafe(primary.replication_task(), primary.loop)
+    for secondary in interfaces[1:]:
+        secondary.replica_metadata[primary.port] = (f"{ServerState.PRIMARY}", time.time())
+    # heartbeats keep the replicas from suspecting each other, the primary
+    # only waits for the secondaries it considers live. The secondaries ask
+    # for the primary's snapshot on their first tick
+    for interface in interfaces:
+        asyncio.run_coroutine_threadsafe(interface.heartbeat_task(), interface.loop)
+    while any(secondary.servicer_object.replication_source is None for secondary in interfaces[1:]):
+        time.sleep(0.01)
+    return primary.servicer_object, interfaces
+
+
+def StopCluster(interfaces):
+    for interface in interfaces:
+        interface.servicer_object.server_state = ServerState.BROKEN
+        OnLoop(interface, interface.ClosePeers())
+        OnLoop(interface, interface.replication_server.stop(None))
+        interface.servicer_object.wal.close()
+    interfaces[0].loop.call_soon_threadsafe(interfaces[0].loop.stop)
+
+
+def Percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def MeasureWrites(primary: ChatServer, num_writes: int, writers: int):
+    """
+    Sends num_writes messages through the SendMessage handler from
+    `writers` concurrent threads.
+
+    Returns:
+        list: The latency of every write in seconds.
+    """
+    reply = primary.CreateAccount(chat_pb2.AccountCreateRequest(
+        version=1, username="bench", password="password", fullname="bench"), None)
+
+    def Write(i):
+        start = time.perf_counter()
+        primary.SendMessage(chat_pb2.MessageRequest(
+            version=1, auth_token=reply.auth_token, username="bench",
+            recipient_username="bench", message=f"message {i}"), None)
+        return time.perf_counter() - start
+
+    with futures.ThreadPoolExecutor(max_workers=writers) as pool:
+        return list(pool.map(Write, range(num_writes)))
+
+
+def Run(num_writes: int, writers: int, durability: str) -> None:
+    """
+    Compares the write latency of the replication modes.
+    """
+    results = {}
+    for mode in grpc_server.REPLICATION_MODES:
+        log_dir = tempfile.mkdtemp()
+        primary, interfaces = StartCluster(log_dir, mode, durability)
+        latencies = MeasureWrites(primary, num_writes, writers)
+        results[mode] = latencies
+        acked = [interface.servicer_object.replicated_seq for interface in interfaces[1:]]
+        print(f"{mode}: secondaries at WAL seq {acked}, primary at {primary.wal_seq}")
+        StopCluster(interfaces)
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+    print(f"{num_writes} writes from {writers} threads, durability {durability}")
+    print(f"{'mode':<11}{'p50 (ms)':>10}{'p99 (ms)':>10}{'mean (ms)':>11}")
+    for mode, latencies in results.items():
+        print(f"{mode:<11}{Percentile(latencies, 0.5) * 1000:>10.2f}"
+              f"{Percentile(latencies, 0.99) * 1000:>10.2f}{statistics.mean(latencies) * 1000:>11.2f}")
+
+    if Percentile(results[grpc_server.REPLICATION_SYNC], 0.99) < grpc_server.REFRESH_TIME:
+        print(Fore.GREEN + "Synchronous writes are not held up by the refresh tick" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "Synchronous writes wait for the refresh tick" + Style.RESET_ALL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='replication_benchmark',
+        description='Measures p50/p99 write latency on a three replica loopback cluster per replication mode')
+    parser.add_argument('--writes', type=int, default=2000)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--durability', choices=storage.wal.DURABILITY_MODES, default=storage.wal.DURABILITY_NONE,
+                        help="write-ahead log durability mode of every replica")
+    args = parser.parse_args()
+    Run(args.writes, args.writers, args.durability)
@@ -0,0 +1,85 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from colorama import Fore, Style
+
+import chat_pb2
+from client import ClientStub
+from cluster_startup_benchmark import Stop, TimeToServing, WriteClusterConfig
+from replication_benchmark import Percentile
+
+
+class CountingStub(ClientStub):
+    # Counts the RPCs the client sends
+    def __init__(self, addresses, ports):
+        super().__init__(addresses, ports)
+        self.calls = 0
+
+    def Call(self, index, request_name, msg):
+        self.calls += 1
+        return super().Call(index, request_name, msg)
+
+
+def Send(client: CountingStub, token: str, i: int) -> float:
+    # Sends one message, returns its latency in seconds
+    start = time.perf_counter()
+    reply = client.SendMessage(chat_pb2.MessageRequest(
+        version=1, auth_token=token, username="bench", recipient_username="bench", message=f"message {i}"))
+    assert reply.error_code == "", reply.error_code
+    return time.perf_counter() - start
+
+
+def Run(num_requests: int, size: int) -> None:
+    """
+    Sends requests from one client to a loopback cluster of `size` replica
+    processes, starting at a secondary, then kills the primary and times
+    the request that has to find the new one.
+    """
+    log_dir = tempfile.mkdtemp()
+    config_path = os.path.join(log_dir, "cluster.json")
+    ports = WriteClusterConfig(config_path, size)
+    _, _, processes = TimeToServing(ports, config_path, log_dir, first_start=True)
+
+    client = CountingStub(["127.0.0.1"] * size, [external for external, _ in ports])
+    # the first replica starts as primary, the client is pointed elsewhere
+    client.primary = 1
+    reply = client.CreateAccount(chat_pb2.AccountCreateRequest(
+        version=1, username="bench", password="password", fullname="bench"))
+    redirected = client.calls
+    token = reply.auth_token
+
+    client.calls = 0
+    latencies = [Send(client, token, i) for i in range(num_requests)]
+    calls = client.calls
+
+    primary = client.primary
+    Stop([processes[primary]])
+    client.calls = 0
+    failover = Send(client, token, num_requests)
+    failover_calls = client.calls
+    Stop(processes)
+    shutil.rmtree(log_dir, ignore_errors=True)
+
+    print(f"{num_requests} requests from one client to a {size} replica cluster")
+    print(f"first request, sent to a secondary: {redirected} RPCs")
+    print(f"afterwards: {calls / num_requests:.2f} RPCs per request (fanning out sent {size}), "
+          f"p50 {Percentile(latencies, 0.5) * 1000:.2f} ms, p99 {Percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"first request after the primary was killed: {failover * 1000:.0f} ms, {failover_calls} RPCs")
+
+    if calls == num_requests:
+        print(Fore.GREEN + "Every request went to the primary alone" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "Some requests went to more than one server" + Style.RESET_ALL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='routing_benchmark',
+        description='Counts the RPCs a client sends per request, and times re-routing after the primary dies')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--replicas', type=int, default=3)
+    args = parser.parse_args()
+    Run(args.requests, args.replicas)
@@ -1,16 +1,45 @@
 import unittest
+import asyncio
+import base64
+import os
+import shutil
 import socket
+import tempfile
 import time
 import threading
 from unittest.mock import MagicMock
+import grpc_server
+import failure_detector
+import membership
 from grpc_server import ServerInterface, ChatServer, ServerState
+import chat_pb2
 import datetime 
 
+
+def incompressible(length):
+    # A message snapshot compression does not shrink
+    return base64.b64encode(os.urandom(length * 3 // 4)).decode("ascii")
+
+
+def shipped_op(seq, message):
+    # A send_message operation as shipped by a primary
+    return {"seq": seq, "time": 0.0, "op": "send_message", "args": {"recipient": "raj", "message": message}}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return str(s.getsockname()[1])
+
+
 class TestServerInterface(unittest.TestCase):
 
     def setUp(self):
         # Set up a ChatServer object with mocked methods
-        chat_server = ChatServer(position=ServerState.PRIMARY, log_filename="temp")
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        chat_server = ChatServer(position=ServerState.PRIMARY, log_filename="temp", log_dir=log_dir.name)
+        self.addCleanup(chat_server.wal.close)
         chat_server.utc_time_gen = MagicMock()
         chat_server.utc_time_gen.now.side_effect = lambda: datetime.datetime.now()
 
@@ -37,46 +66,585 @@ class TestServerInterface(unittest.TestCase):
         client_socket.close()
         server_socket.close()
 
-    def test_submit_ballot(self):
-        # Test the SubmitBallot method
-        self.server_interface.sockets_dict = {}  # Empty the sockets_dict to prevent sending messages
+    def make_candidates(self, count):
+        # Interfaces that hand messages straight to each other's HandleMessage,
+        # members of one cluster, with their election state in a fresh dir
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir, ignore_errors=True)
+        ports = [str(9100 + i) for i in range(count)]
+        members = [membership.Replica("127.0.0.1", "0", port) for port in ports]
+        interfaces = []
+        for port in ports:
+            servicer = ChatServer(ServerState.SECONDARY, f"candidate{port}", log_dir=log_dir)
+            self.addCleanup(servicer.wal.close)
+            servicer.membership = membership.Membership(members)
+            interfaces.append(ServerInterface(servicer, port))
+        for sender in interfaces:
+            for receiver in interfaces:
+                if receiver is not sender:
+                    link = MagicMock()
+                    link.send.side_effect = lambda msg, receiver=receiver: receiver.HandleMessage(msg) or True
+                    sender.heartbeat_dict[receiver.port] = link
+                    sender.sockets_dict[receiver.port] = link
+        # the readiness handshake of connections coming up
+        for interface in interfaces:
+            for port in list(interface.heartbeat_dict):
+                interface.PeerReady(port)
+        return interfaces, log_dir
+
+    def test_one_vote_per_term(self):
+        # The first candidate of a term gets the vote, a second one in the
+        # same term does not, and the vote survives a restart
+        interfaces, log_dir = self.make_candidates(3)
+        first, voter, second = interfaces
+        del voter.heartbeat_dict[second.port]
+        voter.sockets_dict.pop(second.port)
+        first.StartElection()
+        self.assertEqual(first.servicer_object.server_state, ServerState.PRIMARY)
+        self.assertEqual(first.servicer_object.term, 1)
+        self.assertEqual(voter.servicer_object.voted_for, first.port)
+
+        second.servicer_object.set_term(1, voted_for=second.port)
+        request = chat_pb2.VoteRequest(term=1, port=second.port, data_term=5, applied_seq=100)
+        voter.ReceiveVoteRequest(request)
+        self.assertEqual(voter.servicer_object.voted_for, first.port)
+        restarted = ChatServer(ServerState.PRIMARY, f"candidate{voter.port}", log_dir=log_dir)
+        self.addCleanup(restarted.wal.close)
+        self.assertEqual((restarted.term, restarted.voted_for), (1, first.port))
+        # primaries are elected once the cluster has had a term
+        self.assertEqual(restarted.server_state, ServerState.SECONDARY)
+
+    def test_vote_for_up_to_date_candidate(self):
+        # A candidate whose state is behind a majority cannot win, the most
+        # up-to-date replica can. Replicas are ordered by how much of the
+        # former primary's log they applied: the one behind installed an
+        # older snapshot of it on top of operations of its own, and has the
+        # higher state version.
+        interfaces, log_dir = self.make_candidates(3)
+        behind, ahead, other = interfaces
+        former = ChatServer(ServerState.PRIMARY, "former", log_dir=log_dir)
+        self.addCleanup(former.wal.close)
+        former.commit_operation("create_account", username="raj", password="password1", fullname="Raj",
+                                token="token", timestamp=0.0)
+        former.commit_operation("send_message", recipient="raj", message="0")
+        snapshot = former.get_transfer_snapshot("9199")
+        for message in ["1", "2"]:
+            former.commit_operation("send_message", recipient="raj", message=message)
+        for message in ["a", "b", "c", "d", "e"]:
+            behind.servicer_object.commit_operation("send_message", recipient="raj", message=message)
+        for interface in interfaces:
+            self.assertTrue(interface.servicer_object.install_transfer_snapshot(snapshot["path"], "9199"))
+        for interface in (ahead, other):
+            interface.servicer_object.apply_replicated_ops("9199", former.ops_after(snapshot["wal_seq"]))
+        self.assertGreater(behind.servicer_object.state_version, ahead.servicer_object.state_version)
+        self.assertLess(behind.servicer_object.log_position(), ahead.servicer_object.log_position())
+
+        behind.StartElection()
+        self.assertEqual(behind.servicer_object.server_state, ServerState.ELECTION)
+        self.assertEqual(behind.votes, {behind.port})
+
+        ahead.StartElection()
+        self.assertEqual(ahead.servicer_object.server_state, ServerState.PRIMARY)
+        self.assertEqual(ahead.servicer_object.term, 2)
+        # the heartbeat of the new primary ends the other election
+        self.assertEqual(behind.servicer_object.server_state, ServerState.SECONDARY)
+        self.assertEqual(behind.servicer_object.term, 2)
+        self.assertEqual(behind.KnownPrimary(), ahead.port)
+
+        # a deposed primary's operations and heartbeats are ignored
+        stale = chat_pb2.ReplicaMessage(status=chat_pb2.ServerStatusUpdate(
+            port="9199", position=f"{ServerState.PRIMARY}", term=1))
+        other.HandleMessage(stale)
+        self.assertEqual(other.replica_metadata["9199"][0], f"{ServerState.BROKEN}")
+        self.assertEqual(other.KnownPrimary(), ahead.port)
+
+        # the secondaries resume from where their state is in the new
+        # primary's log, without a snapshot
+        primary = ahead.servicer_object
+        self.assertIsNone(primary.local_seq("9199", former.wal_seq + 1))
+        for secondary in (behind, other):
+            secondary.SendTo(*secondary.CatchUpRequest())
+            self.assertEqual(secondary.servicer_object.replication_source, ahead.port)
+            self.assertEqual(secondary.servicer_object.data_term, primary.term)
+        self.assertEqual(ahead.peer_acked, {behind.port: primary.wal_seq - 2, other.port: primary.wal_seq})
+        behind.HandleMessage(ahead.ReplicationMessage(behind.port))
+        self.assertEqual(list(behind.servicer_object.user_inbox["raj"]), ["0", "1", "2"])
+        self.assertEqual(behind.servicer_object.log_position(), primary.log_position())
+        self.assertIsNone(primary.transfer_snapshot)
+
+    def test_stand_once_quorum_known(self):
+        # A replica does not stand for election before it heard from a
+        # majority, nor while a replica with a more recent state is up
+        interfaces, _ = self.make_candidates(3)
+        first, second, late = interfaces
+        for interface in interfaces:
+            interface.peer_status.clear()
+        first.StartElection()
+        self.assertEqual(first.servicer_object.server_state, ServerState.SECONDARY)
+        self.assertEqual(first.servicer_object.term, 0)
+
+        # the late replica applied more of a former primary's log
+        late.servicer_object.replication_source = "9199"
+        late.servicer_object.apply_replicated_ops("9199", [shipped_op(1, "hi")])
+        for interface in (first, second):
+            # the connections to the late replica come up
+            late.PeerReady(interface.port)
+            interface.PeerReady(late.port)
+        self.assertTrue(first.QuorumKnown())
+        first.StartElection()
+        self.assertEqual(first.servicer_object.term, 0)
+
+        late.StartElection()
+        self.assertEqual(late.servicer_object.server_state, ServerState.PRIMARY)
+        self.assertEqual(first.KnownPrimary(), late.port)
+
+    def test_phi_learns_heartbeat_intervals(self):
+        # A peer with regular heartbeats is suspected soon after one is late,
+        # one whose heartbeats come with pauses only after a longer silence
+        detector = failure_detector.PhiAccrualDetector(0.05)
+        self.assertEqual(detector.phi("regular"), 0.0)
+        pauses = [0.05, 0.05, 0.25]
+        regular = paused = 0.0
+        for i in range(60):
+            regular += 0.05
+            paused += pauses[i % len(pauses)]
+            detector.heartbeat("regular", regular)
+            detector.heartbeat("paused", paused)
+        self.assertFalse(detector.suspected("regular", regular + 0.06))
+        self.assertTrue(detector.suspected("regular", regular + 0.25))
+        self.assertFalse(detector.suspected("paused", paused + 0.25))
+        self.assertTrue(detector.suspected("paused", paused + 1.0))
+        self.assertLess(detector.phi("paused", paused + 0.25), detector.phi("paused", paused + 0.5))
+
+        # a restart is not learned as a long interval
+        detector.heartbeat("regular", regular + 10)
+        detector.heartbeat("regular", regular + 10.05)
+        self.assertTrue(detector.suspected("regular", regular + 10.3))
+        detector.remove("regular")
+        self.assertEqual(set(detector.suspicion()), {"paused"})
+
+    def test_late_primary_not_deposed(self):
+        # Once the election timeout runs out, a replica only stands if the
+        # detector suspects the primary
+        interfaces, _ = self.make_candidates(3)
+        primary, follower, other = interfaces
+        primary.StartElection()
+        self.assertEqual(follower.KnownPrimary(), primary.port)
+        now = time.monotonic()
+        with unittest.mock.patch("time.monotonic", return_value=now + grpc_server.ELECTION_TIMEOUT_MIN / 2):
+            follower.StartElection()
+        self.assertEqual(follower.servicer_object.term, 1)
+        self.assertEqual(primary.servicer_object.server_state, ServerState.PRIMARY)
+
+        # the primary has gone quiet while the other secondary has not
+        follower.detector.heartbeat(other.port, now + grpc_server.ELECTION_TIMEOUT_MAX)
+        with unittest.mock.patch("time.monotonic", return_value=now + grpc_server.ELECTION_TIMEOUT_MAX):
+            self.assertIsNone(follower.KnownPrimary())
+            follower.StartElection()
+        self.assertEqual(follower.servicer_object.term, 2)
+
+    def test_secondary_redirects_to_primary(self):
+        # A secondary's replies, streamed ones included, name the primary
+        # and its term, in the reply and in the trailing metadata
+        interfaces, _ = self.make_candidates(3)
+        primary, follower, _ = interfaces
+        servicer = follower.servicer_object
+        request = chat_pb2.AccountCreateRequest(version=1, username="raj", password="password1", fullname="Raj")
+        self.assertEqual(servicer.CreateAccount(request, None).primary.address, "")
+
+        primary.StartElection()
+        context = MagicMock()
+        reply = servicer.CreateAccount(request, context)
+        self.assertEqual(reply.error_code, grpc_server.SECONDARY_ERROR_CODE)
+        self.assertEqual((reply.primary.address, reply.primary.term), ("127.0.0.1:0", 1))
+        context.set_trailing_metadata.assert_called_with(
+            ((grpc_server.PRIMARY_ADDRESS_KEY, "127.0.0.1:0"), (grpc_server.PRIMARY_TERM_KEY, "1")))
+        replies = list(servicer.DeliverMessages(chat_pb2.RefreshRequest(version=1, username="raj"), None))
+        self.assertEqual([(r.error_code, r.primary.term) for r in replies], [(grpc_server.SECONDARY_ERROR_CODE, 1)])
+
+    def test_lease_renewed_by_majority(self):
+        # The primary serves requests while a majority acknowledged a recent
+        # heartbeat, and refuses them once its lease lapses. Replicas that
+        # just heard from it do not vote for anyone else meanwhile.
+        interfaces, _ = self.make_candidates(3)
+        primary, follower, other = interfaces
+        for interface in interfaces:
+            interface.servicer_object.lease_expiry = time.monotonic()
+        primary.StartElection()
+        servicer = primary.servicer_object
+        self.assertEqual(servicer.server_state, ServerState.PRIMARY)
+        self.assertTrue(servicer.has_lease())
+        self.assertAlmostEqual(servicer.lease_expiry - time.monotonic(), grpc_server.LEASE_TIME, delta=0.05)
+        reply = servicer.CreateAccount(chat_pb2.AccountCreateRequest(
+            version=1, username="raj", password="password1", fullname="Raj"), None)
+        self.assertEqual(reply.error_code, "")
+        read = chat_pb2.ListAccountRequest(version=1, auth_token=reply.auth_token, username="raj", regex=".*")
+        self.assertEqual(servicer.ListAccounts(read, None).account_names, "raj")
+
+        other.ReceiveVoteRequest(chat_pb2.VoteRequest(term=5, port="9199", data_term=5, applied_seq=100))
+        self.assertEqual(other.servicer_object.term, 1)
+        self.assertNotEqual(other.servicer_object.voted_for, "9199")
+
+        # one secondary is enough for a majority of three
+        del primary.heartbeat_dict[other.port], primary.sockets_dict[other.port]
+        servicer.lease_expiry = time.monotonic()
+        primary.SendHeartbeats()
+        self.assertTrue(servicer.has_lease())
+
+        # cut off from both secondaries, the lease runs out
+        del primary.heartbeat_dict[follower.port], primary.sockets_dict[follower.port]
+        with unittest.mock.patch("time.monotonic", return_value=time.monotonic() + grpc_server.LEASE_TIME):
+            primary.SendHeartbeats()
+            self.assertFalse(servicer.has_lease())
+            self.assertEqual(servicer.ListAccounts(read, None).error_code, grpc_server.SECONDARY_ERROR_CODE)
+            reply = servicer.SendMessage(chat_pb2.MessageRequest(
+                version=1, auth_token=reply.auth_token, username="raj",
+                recipient_username="raj", message="hi"), None)
+            self.assertEqual(reply.error_code, grpc_server.SECONDARY_ERROR_CODE)
+        with unittest.mock.patch("time.monotonic",
+                                 return_value=time.monotonic() + grpc_server.LEASE_TIME + grpc_server.ELECTION_TIMEOUT_MAX + 0.1):
+            primary.Tick()
+        self.assertEqual(servicer.server_state, ServerState.SECONDARY)
+
+    def start_cluster(self, servicers, reachable):
+        # Runs an interface per servicer on one event loop, connected to each
+        # other over loopback. Only the first `reachable` of them listen.
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+
+        def run(coroutine):
+            return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+        interfaces = []
+        for servicer in servicers:
+            interface = ServerInterface(servicer, free_port())
+            interface.attach_loop(loop)
+            interfaces.append(interface)
+        for interface in interfaces[:reachable]:
+            server = run(interface.init_listening_interface())
+            self.addCleanup(lambda server=server: run(server.stop(None)))
+        for sender in interfaces:
+            for receiver in interfaces:
+                if receiver is not sender:
+                    run(sender.ConnectPeer(receiver.port, f"127.0.0.1:{receiver.port}"))
+            self.addCleanup(lambda sender=sender: run(sender.ClosePeers()))
+        return interfaces, run
+
+    def wait_for(self, condition):
+        deadline = time.time() + 30
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_replicate_over_loopback(self):
+        # A lagging secondary downloads a multi-megabyte snapshot over the
+        # replication service on loopback, then follows the live operations
+        log_dir = tempfile.mkdtemp()
+        primary = ChatServer(ServerState.PRIMARY, "primary", log_dir=log_dir)
+        secondary = ChatServer(ServerState.SECONDARY, "secondary", log_dir=log_dir)
+        for i in range(50):
+            username = f"user{i}"
+            primary.commit_operation("create_account", username=username, password="pw",
+                                     fullname=username, token="tok", timestamp=0.0)
+            for _ in range(100):
+                primary.commit_operation("send_message", recipient=username, message=incompressible(1500))
+
+        interfaces, _ = self.start_cluster([primary, secondary], reachable=2)
+        primary_interface, secondary_interface = interfaces
+        wait_for = self.wait_for
+        wait_for(lambda: all(stream.ready for interface in interfaces
+                             for stream in interface.sockets_dict.values()))
+        self.assertTrue(primary_interface.SendTo(secondary_interface.port, primary_interface.StatusMessage()))
+        wait_for(lambda: primary_interface.port in secondary_interface.replica_metadata)
+        secondary_interface.SendTo(*secondary_interface.CatchUpRequest())
+        wait_for(lambda: secondary.replication_source == primary_interface.port)
+        self.assertGreater(primary.transfer_snapshot["size"], 4 * 1024 * 1024)
+        wait_for(lambda: primary_interface.peer_acked.get(secondary_interface.port) == primary.wal_seq)
+
+        # commits wake the replication task, which ships right away
+        replication = asyncio.run_coroutine_threadsafe(
+            primary_interface.replication_task(), primary_interface.loop)
+        self.addCleanup(replication.cancel)
+        primary.commit_operation("send_message", recipient="user0", message="after the resync")
+        wait_for(lambda: secondary.replicated_seq == primary.wal_seq)
+        self.assertEqual(len(secondary.user_metadata_store), 50)
+        self.assertEqual(list(secondary.user_inbox["user0"])[-1], "after the resync")
+        self.assertEqual(list(secondary.user_inbox["user49"]), list(primary.user_inbox["user49"]))
+        primary.wal.close()
+        secondary.wal.close()
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+    def test_heartbeats_with_unreachable_peer(self):
+        # On a four server cluster with one server down, a tick reaches the
+        # other two without waiting on the dead one
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir, ignore_errors=True)
+        servicers = [ChatServer(ServerState.SECONDARY, f"replica{i}", log_dir=log_dir) for i in range(4)]
+        for servicer in servicers:
+            self.addCleanup(servicer.wal.close)
+        servicers[0].server_state = ServerState.PRIMARY
+        interfaces, run = self.start_cluster(servicers, reachable=3)
+        primary_interface = interfaces[0]
+        self.wait_for(lambda: all(primary_interface.sockets_dict[interface.port].ready
+                                  for interface in interfaces[1:3]))
+        self.assertFalse(primary_interface.sockets_dict[interfaces[3].port].ready)
+
+        async def tick():
+            start = time.perf_counter()
+            primary_interface.Tick()
+            return time.perf_counter() - start
+        self.assertLess(run(tick()), grpc_server.REFRESH_TIME)
+        for interface in interfaces[1:3]:
+            self.wait_for(lambda: primary_interface.port in interface.replica_metadata)
+            self.assertEqual(interface.replica_metadata[primary_interface.port][0], f"{ServerState.PRIMARY}")
+
+    def test_heartbeats_bypass_bulk_traffic(self):
+        # A heartbeat sent after megabytes of snapshot chunks overtakes them,
+        # and carries the replication position of the sender
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir, ignore_errors=True)
+        primary = ChatServer(ServerState.PRIMARY, "primary", log_dir=log_dir)
+        secondary = ChatServer(ServerState.SECONDARY, "secondary", log_dir=log_dir)
+        self.addCleanup(primary.wal.close)
+        self.addCleanup(secondary.wal.close)
+        for i in range(5):
+            primary.commit_operation("send_message", recipient="raj", message=f"{i}")
+        interfaces, run = self.start_cluster([primary, secondary], reachable=2)
+        primary_interface, secondary_interface = interfaces
+        self.wait_for(lambda: all(stream.ready for interface in interfaces
+                                  for stream in list(interface.sockets_dict.values()) +
+                                  list(interface.heartbeat_dict.values())))
+
+        received = []
+        secondary_interface.ReceiveSnapshotChunk = lambda chunk: received.append(chunk.offset)
+        chunks = 32
+        messages = [chat_pb2.ReplicaMessage(snapshot_chunk=chat_pb2.SnapshotChunk(
+            port=primary_interface.port, offset=i, data=os.urandom(1024 * 1024))) for i in range(chunks)]
+        for msg in messages:
+            self.assertTrue(primary_interface.SendTo(secondary_interface.port, msg))
+
+        async def tick():
+            primary_interface.Tick()
+        run(tick())
+        self.wait_for(lambda: primary_interface.port in secondary_interface.replica_metadata)
+        self.assertLess(len(received), chunks)
+        self.assertEqual(secondary_interface.peer_positions[primary_interface.port], (5, primary_interface.port, 0))
+        self.wait_for(lambda: len(received) == chunks)
+
+        # a secondary's heartbeat acknowledges the operations it applied
+        secondary.replication_source = primary_interface.port
+        secondary.replicated_seq = 3
+        primary_interface.peer_acked[secondary_interface.port] = 0
+        async def secondary_tick():
+            secondary_interface.Tick()
+        run(secondary_tick())
+        self.wait_for(lambda: primary_interface.peer_acked[secondary_interface.port] == 3)
+        self.assertEqual(primary_interface.ReplicationLag(), {secondary_interface.port: 2})
+        self.assertEqual(primary.replica_acks, {secondary_interface.port: 3})
+
+    def test_snapshot_catch_up_resumes(self):
+        # A lagging secondary downloads the snapshot in chunks, resumes from
+        # the last chunk after the link drops and then tails the operations
+        log_dir = tempfile.mkdtemp()
+        primary = ChatServer(ServerState.PRIMARY, "primary", log_dir=log_dir)
+        secondary = ChatServer(ServerState.SECONDARY, "secondary", log_dir=log_dir)
+        for i in range(20):
+            username = f"user{i}"
+            primary.commit_operation("create_account", username=username, password="pw",
+                                     fullname=username, token="tok", timestamp=0.0)
+            for _ in range(100):
+                primary.commit_operation("send_message", recipient=username, message=incompressible(1000))
+        primary_interface = ServerInterface(primary, "9000")
+        secondary_interface = ServerInterface(secondary, "9001")
+        secondary_interface.replica_metadata["9000"] = (f"{ServerState.PRIMARY}", time.time())
+
+        link = {"up": True, "chunks": []}
+        def connect(sender, receiver):
+            def send(msg):
+                if not link["up"]:
+                    return False
+                if msg.WhichOneof("body") == "snapshot_chunk":
+                    link["chunks"].append(msg.snapshot_chunk.offset)
+                    if len(link["chunks"]) == 3:
+                        link["up"] = False
+                receiver.HandleMessage(msg)
+                return True
+            sender.sockets_dict[receiver.port] = MagicMock()
+            sender.sockets_dict[receiver.port].send.side_effect = send
+        connect(primary_interface, secondary_interface)
+        connect(secondary_interface, primary_interface)
+
+        secondary_interface.SendTo(*secondary_interface.CatchUpRequest())
+        chunk_bytes = grpc_server.SNAPSHOT_CHUNK_BYTES
+        self.assertEqual(link["chunks"], [0, chunk_bytes, 2 * chunk_bytes])
+        self.assertEqual(secondary_interface.download["offset"], 3 * chunk_bytes)
+        self.assertIsNone(secondary.replication_source)
+        # no new request while the transfer is fresh
+        self.assertIsNone(secondary_interface.CatchUpRequest())
+
+        link["up"] = True
+        secondary_interface.iter_value += grpc_server.RETRANSMIT_ITERS
+        secondary_interface.SendTo(*secondary_interface.CatchUpRequest())
+        total = primary.transfer_snapshot["size"]
+        self.assertGreater(total, grpc_server.SNAPSHOT_WINDOW_CHUNKS * chunk_bytes)
+        self.assertEqual(link["chunks"], list(range(0, total, chunk_bytes)))
+        self.assertIsNone(secondary_interface.download)
+        self.assertFalse(os.path.exists(secondary.state_file + ".partial"))
+        self.assertEqual(secondary.replication_source, "9000")
+        self.assertEqual(secondary.replicated_seq, primary.wal_seq)
+        self.assertEqual(len(secondary.user_inbox["user19"]), 100)
+
+        # from here on only operations are shipped
+        primary_interface.ReceiveAck("9001", "9000", secondary.replicated_seq)
+        primary.commit_operation("send_message", recipient="user0", message="live")
+        secondary_interface.HandleMessage(primary_interface.ReplicationMessage("9001"))
+        self.assertEqual(list(secondary.user_inbox["user0"])[-1], "live")
+        self.assertEqual(secondary.replicated_seq, primary.wal_seq)
+        primary.wal.close()
+        secondary.wal.close()
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+    def test_add_and_remove_replica(self):
+        # A replica added to a running cluster is connected to by every
+        # member, catches up from the primary and follows its operations.
+        # Once removed it is disconnected and stops taking part.
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir, ignore_errors=True)
+        primary = ChatServer(ServerState.PRIMARY, "primary", log_dir=log_dir)
+        secondary = ChatServer(ServerState.SECONDARY, "secondary", log_dir=log_dir)
+        newcomer = ChatServer(ServerState.SECONDARY, "newcomer", log_dir=log_dir)
+        for servicer in (primary, secondary, newcomer):
+            self.addCleanup(servicer.wal.close)
+        for i in range(10):
+            primary.commit_operation("send_message", recipient="raj", message=f"{i}")
+        interfaces, run = self.start_cluster([primary, secondary], reachable=2)
+        primary_interface, secondary_interface = interfaces
+        members = [membership.Replica("127.0.0.1", "0", interface.port) for interface in interfaces]
+        config = os.path.join(log_dir, "cluster.json")
+        primary.membership = membership.Membership(members, path=config)
+        secondary.membership = membership.Membership(members)
+
+        # the new replica only knows the primary until it is added
+        newcomer_interface = ServerInterface(newcomer, free_port())
+        newcomer_interface.attach_loop(primary_interface.loop)
+        newcomer.membership = membership.Membership(members[:1])
+        server = run(newcomer_interface.init_listening_interface())
+        self.addCleanup(lambda: run(server.stop(None)))
+        self.addCleanup(lambda: run(newcomer_interface.ClosePeers()))
+        interfaces.append(newcomer_interface)
+
+        async def apply():
+            newcomer_interface.ApplyMembership()
+        run(apply())
+
+        async def ticks():
+            while True:
+                for interface in interfaces:
+                    interface.Tick()
+                await asyncio.sleep(0.05)
+        ticking = asyncio.run_coroutine_threadsafe(ticks(), primary_interface.loop)
+        self.addCleanup(ticking.cancel)
+        replication = asyncio.run_coroutine_threadsafe(
+            primary_interface.replication_task(), primary_interface.loop)
+        self.addCleanup(replication.cancel)
 
-        # Call the SubmitBallot method
-        self.server_interface.SubmitBallot()
+        request = chat_pb2.MembershipChangeRequest(version=1, replica=chat_pb2.ReplicaMember(
+            host="127.0.0.1", external_port="0", internal_port=newcomer_interface.port))
+        self.assertEqual(secondary.AddReplica(request, None).error_code, grpc_server.SECONDARY_ERROR_CODE)
+        # changes replace the replicas, a tick iterating the old ones is unaffected
+        before = primary.membership.replicas
+        reply = primary.AddReplica(request, None)
+        self.assertEqual(len(before), 2)
+        self.assertEqual(reply.error_code, "")
+        self.assertEqual(reply.membership.version, 2)
+        self.assertEqual(len(reply.membership.replicas), 3)
+        self.assertEqual(membership.Membership.load(config).peers(primary_interface.port),
+                         primary.membership.peers(primary_interface.port))
 
-        # Check if the ballot_box has an entry for the current server
-        self.assertIn(self.port, [entry[0] for entry in self.server_interface.ballot_box])
+        self.wait_for(lambda: newcomer.membership.version == 2 and secondary.membership.version == 2)
+        self.wait_for(lambda: newcomer.replication_source == primary_interface.port)
+        self.wait_for(lambda: newcomer_interface.port in secondary_interface.sockets_dict)
+        primary.commit_operation("send_message", recipient="raj", message="after the join")
+        self.wait_for(lambda: newcomer.replicated_seq == primary.wal_seq)
+        self.assertEqual(list(newcomer.user_inbox["raj"])[-1], "after the join")
+        self.assertIn(newcomer_interface.port, primary.replicas)
 
-    def test_trigger_election(self):
-        # Test the TriggerElection method
-        self.server_interface.sockets_dict = {}  # Empty the sockets_dict to prevent sending messages
+        remove = chat_pb2.MembershipChangeRequest(version=1, replica=chat_pb2.ReplicaMember(
+            internal_port=primary_interface.port))
+        self.assertEqual(primary.RemoveReplica(remove, None).error_code, "Cannot remove the primary")
+        remove.replica.internal_port = newcomer_interface.port
+        self.assertEqual(primary.RemoveReplica(remove, None).error_code, "")
+        self.wait_for(lambda: newcomer.server_state == ServerState.BROKEN)
+        self.wait_for(lambda: newcomer_interface.port not in primary_interface.sockets_dict and
+                      newcomer_interface.port not in secondary_interface.sockets_dict)
+        self.assertNotIn(newcomer_interface.port, primary.replicas)
+        self.assertEqual(newcomer_interface.sockets_dict, {})
 
-        # Call the TriggerElection method
-        self.server_interface.TriggerElection()
 
-        # Check if the election_time is True and the ballot_box is empty
-        self.assertFalse(self.server_interface.election_time)
-        self.assertEqual(len(self.server_interface.ballot_box), 0)
+    def test_failover_over_loopback(self):
+        # Once the primary of a three replica cluster dies, the others elect
+        # a new one in the next term well within a second. The remaining
+        # secondary resumes from the new primary's log rather than
+        # downloading a snapshot.
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir, ignore_errors=True)
+        servicers = [ChatServer(ServerState.SECONDARY, f"replica{i}", log_dir=log_dir) for i in range(3)]
+        for servicer in servicers:
+            self.addCleanup(servicer.wal.close)
+        interfaces, run = self.start_cluster(servicers, reachable=3)
+        members = [membership.Replica("127.0.0.1", "0", interface.port) for interface in interfaces]
+        for servicer in servicers:
+            servicer.membership = membership.Membership(members)
+        self.wait_for(lambda: all(stream.ready for interface in interfaces
+                                  for stream in interface.heartbeat_dict.values()))
 
-    def test_get_election_winner(self):
-        # Test the GetElectionWinner method
+        async def start():
+            for interface in interfaces:
+                interface.StartElections()
+                replication = asyncio.ensure_future(interface.replication_task())
+                self.addCleanup(interfaces[0].loop.call_soon_threadsafe, replication.cancel)
+            return [asyncio.ensure_future(interface.heartbeat_task()) for interface in interfaces]
+        tasks = run(start())
+        for task in tasks:
+            self.addCleanup(interfaces[0].loop.call_soon_threadsafe, task.cancel)
 
-        # Create a sample ballot box
-        sample_ballot_box = [
-            (self.port, 80, self.server_interface.servicer_object.utc_time_gen.now().timestamp()),
-            ("9001", 90, self.server_interface.servicer_object.utc_time_gen.now().timestamp() - 10),
-            ("9002", 70, self.server_interface.servicer_object.utc_time_gen.now().timestamp() - 5)
-        ]
-        self.server_interface.ballot_box = sample_ballot_box
-        self.server_interface.election_time = True
+        def primaries():
+            return [i for i, servicer in enumerate(servicers) if servicer.server_state == ServerState.PRIMARY]
+        self.wait_for(lambda: len(primaries()) == 1)
+        old = primaries()[0]
+        old_term = servicers[old].term
+        survivors = [i for i in range(3) if i != old]
+        servicers[old].commit_operation("create_account", username="raj", password="pw", fullname="Raj",
+                                        token="tok", timestamp=0.0)
+        for message in ["a", "b"]:
+            servicers[old].commit_operation("send_message", recipient="raj", message=message)
+        self.wait_for(lambda: all(servicers[i].replication_source == interfaces[old].port and
+                                  servicers[i].replicated_seq == servicers[old].wal_seq for i in survivors))
 
-        # Call the GetElectionWinner method
-        with unittest.mock.patch("time.sleep", return_value=None):  # Mock time.sleep to avoid waiting
-            self.server_interface.GetElectionWinner()
+        async def crash():
+            tasks[old].cancel()
+            interfaces[old].elections = False
+            servicers[old].server_state = ServerState.BROKEN
+            await interfaces[old].ClosePeers()
+            await interfaces[old].replication_server.stop(None)
+        start_time = time.perf_counter()
+        run(crash())
+        self.wait_for(lambda: any(servicers[i].server_state == ServerState.PRIMARY for i in survivors))
+        failover_time = time.perf_counter() - start_time
+        self.assertLess(failover_time, 1.0)
+        new = [i for i in survivors if servicers[i].server_state == ServerState.PRIMARY][0]
+        self.assertGreater(servicers[new].term, old_term)
+        follower = [i for i in survivors if i != new][0]
+        self.wait_for(lambda: interfaces[follower].KnownPrimary() == interfaces[new].port)
+        self.assertEqual(servicers[follower].term, servicers[new].term)
 
-        # Check if the election_time is False, and the server_state is PRIMARY for the winning server
-        self.assertFalse(self.server_interface.election_time)
-        self.assertEqual(self.server_interface.servicer_object.server_state, ServerState.SECONDARY)
+        self.wait_for(lambda: servicers[follower].replication_source == interfaces[new].port)
+        servicers[new].commit_operation("send_message", recipient="raj", message="c")
+        self.wait_for(lambda: servicers[follower].replicated_seq == servicers[new].wal_seq)
+        self.assertEqual(list(servicers[follower].user_inbox["raj"]), ["a", "b", "c"])
+        self.assertIsNone(servicers[new].transfer_snapshot)
 
 
 if __name__ == '__main__':
@@ -1,15 +1,29 @@
 import unittest
 import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
 from datetime import datetime, timedelta
-from collections import defaultdict
-from unittest.mock import MagicMock
-from grpc_server import ChatServer
+from collections import defaultdict, deque
+from unittest.mock import MagicMock, patch
+import chat_pb2
+import storage
+import grpc_server
+from grpc_server import ChatServer, ServerInterface, ServerState
 
 from colorama import Fore, Style
 
 class TestChatServer(unittest.TestCase):
     def setUp(self):
-        self.chat_server = ChatServer(1, "test")
+        self.log_dir = tempfile.mkdtemp()
+        self.chat_server = ChatServer(1, "test", log_dir=self.log_dir)
+
+    def tearDown(self):
+        self.chat_server.wal.close()
+        shutil.rmtree(self.log_dir, ignore_errors=True)
 
     def test_get_state(self):
         expected_state = {
@@ -58,11 +72,643 @@ class TestChatServer(unittest.TestCase):
         self.assertEqual(self.chat_server.token_hub, state["token_hub"])
         self.assertEqual(self.chat_server.state_save_time, state["time"])
 
+    def test_wal_recovery(self):
+        # Mutations are only appended to the WAL, a restarted server must
+        # rebuild the same state by replaying it
+        server = self.chat_server
+        server.server_state = ServerState.PRIMARY
+        reply = server.CreateAccount(chat_pb2.AccountCreateRequest(
+            version=1, username="alice", password="pw", fullname="Alice"), None)
+        server.CreateAccount(chat_pb2.AccountCreateRequest(
+            version=1, username="bob", password="pw", fullname="Bob"), None)
+        for text in ["one", "two", "three"]:
+            server.SendMessage(chat_pb2.MessageRequest(
+                version=1, auth_token=reply.auth_token, username="alice",
+                recipient_username="bob", message=text), None)
+        server.wal.close()
+
+        recovered = ChatServer(ServerState.SECONDARY, "test", log_dir=self.log_dir)
+        self.assertEqual(recovered.wal_seq, 5)
+        self.assertEqual(list(recovered.user_inbox["bob"]),
+                         ["[alice]: one", "[alice]: two", "[alice]: three"])
+        self.assertEqual(tuple(recovered.user_metadata_store["alice"]), ("pw", "Alice"))
+        self.assertEqual(recovered.token_hub["alice"][0], reply.auth_token)
+
+        # a snapshot covers the log up to its sequence, only the tail is replayed
+        recovered.write_state()
+        recovered.commit_operation("pop_message", username="bob")
+        recovered.wal.close()
+        restarted = ChatServer(ServerState.SECONDARY, "test", log_dir=self.log_dir)
+        self.assertEqual(restarted.wal_seq, 6)
+        self.assertEqual(list(restarted.user_inbox["bob"]),
+                         ["[alice]: two", "[alice]: three"])
+        restarted.wal.close()
+
+    def test_checkpoint_compacts_wal(self):
+        server = self.chat_server
+        server.server_state = ServerState.PRIMARY
+        server.wal.segment_bytes = 256
+        reply = server.CreateAccount(chat_pb2.AccountCreateRequest(
+            version=1, username="alice", password="pw", fullname="Alice"), None)
+        for i in range(20):
+            server.SendMessage(chat_pb2.MessageRequest(
+                version=1, auth_token=reply.auth_token, username="alice",
+                recipient_username="alice", message=f"msg {i}"), None)
+        self.assertGreater(len(server.wal.segments()), 1)
+
+        checkpointer = storage.checkpoint.Checkpointer(server, interval=0)
+        self.assertTrue(checkpointer.due())
+        self.assertEqual(checkpointer.run_once(), 21)
+        self.assertEqual(len(server.wal.segments()), 0)
+        self.assertFalse(checkpointer.due())
+
+        # the log keeps numbering after the snapshot and recovery only replays the tail
+        server.SendMessage(chat_pb2.MessageRequest(
+            version=1, auth_token=reply.auth_token, username="alice",
+            recipient_username="alice", message="tail"), None)
+        server.wal.close()
+        restarted = ChatServer(ServerState.SECONDARY, "test", log_dir=self.log_dir)
+        self.assertEqual(restarted.snapshot_seq, 21)
+        self.assertEqual(restarted.wal_seq, 22)
+        self.assertEqual(len(restarted.user_inbox["alice"]), 21)
+        restarted.wal.close()
+
+    def test_operation_shipping(self):
+        primary = self.chat_server
+        primary.server_state = ServerState.PRIMARY
+        tokens = {}
+        for name in ["alice", "bob"]:
+            tokens[name] = primary.CreateAccount(chat_pb2.AccountCreateRequest(
+                version=1, username=name, password="pw", fullname=name), None).auth_token
+        secondary = ChatServer(ServerState.SECONDARY, "replica", log_dir=self.log_dir)
+        interface = ServerInterface(primary, "50054")
+        secondary_interface = ServerInterface(secondary, "50055")
+        # messages sent to a peer are handled by it right away
+        for sender, receiver in ((interface, secondary_interface), (secondary_interface, interface)):
+            sender.sockets_dict[receiver.port] = MagicMock()
+            sender.sockets_dict[receiver.port].send.side_effect = (
+                lambda msg, receiver=receiver: receiver.HandleMessage(msg) or True)
+
+        # a peer that never installed a snapshot from this primary asks for one
+        self.assertIsNone(interface.ReplicationMessage("50055"))
+        secondary_interface.replica_metadata["50054"] = (f"{ServerState.PRIMARY}", time.time())
+        # the installed snapshot is written out after the locks are released
+        locked_while_written = []
+        encode_snapshot_file = secondary.encode_snapshot_file
+
+        def encode_unlocked(*args):
+            locked_while_written.append(secondary.metadata_lock.locked() or secondary.inbox_lock.locked())
+            return encode_snapshot_file(*args)
+        secondary.encode_snapshot_file = encode_unlocked
+        secondary_interface.SendTo(*secondary_interface.CatchUpRequest())
+        self.assertEqual(locked_while_written, [False])
+        self.assertEqual(secondary.replication_source, "50054")
+        self.assertEqual(secondary.replicated_seq, primary.wal_seq)
+        self.assertEqual(set(secondary.user_metadata_store.keys()), {"alice", "bob"})
+        self.assertIsNone(interface.ReplicationMessage("50055"))
+        interface.ReceiveAck("50055", "50054", secondary.replicated_seq)
+        self.assertIsNone(interface.ReplicationMessage("50055"))
+
+        # afterwards only the new operations are shipped
+        primary.SendMessage(chat_pb2.MessageRequest(
+            version=1, auth_token=tokens["alice"], username="alice",
+            recipient_username="bob", message="hi"), None)
+        # shipping does not wait for an operation being applied
+        with primary.version_lock:
+            msg = interface.ReplicationMessage("50055")
+        self.assertEqual(msg.WhichOneof("body"), "operations")
+        self.assertEqual(msg.operations.source, "50054")
+        self.assertEqual([op.op for op in msg.operations.ops], ["send_message"])
+        secondary_interface.HandleMessage(msg)
+        self.assertEqual(secondary.replicated_seq, primary.wal_seq)
+        self.assertEqual(interface.peer_acked["50055"], primary.wal_seq)
+        # a retransmitted batch is not applied twice
+        secondary_interface.HandleMessage(msg)
+        self.assertEqual(secondary.replicated_seq, primary.wal_seq)
+        self.assertEqual(list(secondary.user_inbox["bob"]), ["[alice]: hi"])
+        interface.ReceiveAck("50055", "50054", secondary.replicated_seq)
+
+        # operations after a gap wait for the missing ones
+        primary.commit_operation("send_message", recipient="bob", message="lost")
+        primary.commit_operation("send_message", recipient="bob", message="next")
+        self.assertEqual(
+            secondary.apply_replicated_ops("50054", primary.ops_after(primary.wal_seq - 1)),
+            primary.wal_seq - 2)
+        # as do operations from another primary
+        self.assertEqual(
+            secondary.apply_replicated_ops("50056", primary.ops_after(primary.wal_seq - 2)),
+            primary.wal_seq - 2)
+        interface.ReplicationMessage("50055")
+        # without an ack the operations are sent again from the last ack
+        interface.iter_value += grpc_server.RETRANSMIT_ITERS
+        msg = interface.ReplicationMessage("50055")
+        self.assertEqual(len(msg.operations.ops), 2)
+        secondary_interface.HandleMessage(msg)
+        self.assertEqual(list(secondary.user_inbox["bob"]), ["[alice]: hi", "lost", "next"])
+
+        # a peer behind the backlog gets a full state again
+        primary.op_backlog = deque(primary.op_backlog, maxlen=2)
+        for message in ["a", "b", "c"]:
+            primary.commit_operation("send_message", recipient="alice", message=message)
+        self.assertIsNone(primary.ops_after(interface.peer_acked["50055"]))
+        self.assertIsNone(interface.ReplicationMessage("50055"))
+        self.assertEqual(list(secondary.user_inbox["alice"]), ["a", "b", "c"])
+        self.assertEqual(secondary.replicated_seq, primary.wal_seq)
+        secondary.wal.close()
+
+    def test_replication_modes(self):
+        primary = self.chat_server
+        primary.server_state = ServerState.PRIMARY
+        primary.replicas = {"50055", "50056"}
+        primary.replication_timeout = 5.0
+
+        def ack_later(port, seq):
+            threading.Timer(0.05, primary.record_replica_ack, args=(port, seq)).start()
+
+        # async replies without waiting for anyone
+        seq = primary.commit_operation("send_message", recipient="raj", message="a")
+        self.assertTrue(primary.wait_for_replication(seq))
+
+        # semi-sync waits for one secondary
+        primary.replication_mode = grpc_server.REPLICATION_SEMI_SYNC
+        seq = primary.commit_operation("send_message", recipient="raj", message="b")
+        ack_later("50055", seq)
+        start = time.perf_counter()
+        self.assertTrue(primary.wait_for_replication(seq))
+        self.assertGreaterEqual(time.perf_counter() - start, 0.04)
+
+        # sync waits for all of them, an older ack does not count
+        primary.replication_mode = grpc_server.REPLICATION_SYNC
+        seq = primary.commit_operation("send_message", recipient="raj", message="c")
+        primary.record_replica_ack("50055", seq)
+        primary.record_replica_ack("50056", seq - 1)
+        ack_later("50056", seq)
+        self.assertTrue(primary.wait_for_replication(seq))
+        self.assertEqual(primary.replica_acks, {"50055": seq, "50056": seq})
+
+        # a missing secondary only holds the write up until the timeout
+        primary.replication_timeout = 0.05
+        seq = primary.commit_operation("send_message", recipient="raj", message="d")
+        primary.record_replica_ack("50055", seq)
+        self.assertFalse(primary.wait_for_replication(seq))
+
+        # a secondary that is down is not waited for, also when it goes down
+        # during the wait
+        primary.replication_timeout = 5.0
+        down = {"50056"}
+        primary.replica_live = lambda port: port not in down
+        start = time.perf_counter()
+        self.assertTrue(primary.wait_for_replication(seq))
+        down.clear()
+        seq = primary.commit_operation("send_message", recipient="raj", message="e")
+        primary.record_replica_ack("50055", seq)
+        threading.Timer(0.05, down.add, args=("50056",)).start()
+        self.assertTrue(primary.wait_for_replication(seq))
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+        # writes beyond the most that may wait do not hold a worker
+        primary.replication_waiters = threading.BoundedSemaphore(0)
+        seq = primary.commit_operation("send_message", recipient="raj", message="f")
+        start = time.perf_counter()
+        self.assertFalse(primary.wait_for_replication(seq))
+        self.assertLess(time.perf_counter() - start, 0.05)
+
+        # secondaries never wait
+        primary.server_state = ServerState.SECONDARY
+        self.assertTrue(primary.wait_for_replication(seq + 1))
+        with self.assertRaises(ValueError):
+            ChatServer(ServerState.PRIMARY, "bad", log_dir=self.log_dir, replication_mode="quorum")
+
+    def test_json_state_file_conversion(self):
+        # state files written in the old JSON format are converted to the
+        # streaming snapshot format and still load
+        state_file = os.path.join(self.log_dir, "state_store_legacy.txt")
+        with open(state_file, "w") as f:
+            json.dump({
+                "time": 1681151745.8,
+                "user_inbox": {"raj": ["[aakash]: hi"], "aakash": []},
+                "user_metadata_store": {"raj": ["raj", "Raj"], "aakash": ["aakash", "Aakash"]},
+                "token_hub": {"raj": ["ad07", 1681151733.3], "aakash": ["c749", 1681151730.4]},
+                "commit_hash": 1852062467483784961}, f)
+        json_size = os.path.getsize(state_file)
+
+        legacy = ChatServer(ServerState.SECONDARY, "legacy", log_dir=self.log_dir)
+        self.assertEqual(legacy.user_inbox["raj"], ["[aakash]: hi"])
+        legacy.wal.close()
+
+        self.assertTrue(storage.snapshot.convert_json_state_file(state_file))
+        self.assertFalse(storage.snapshot.convert_json_state_file(state_file))
+        self.assertLess(os.path.getsize(state_file), json_size)
+        converted = ChatServer(ServerState.SECONDARY, "legacy", log_dir=self.log_dir)
+        self.assertEqual(converted.user_inbox["raj"], ["[aakash]: hi"])
+        self.assertEqual(tuple(converted.user_metadata_store["aakash"]), ("aakash", "Aakash"))
+        self.assertEqual(tuple(converted.token_hub["raj"]), ("ad07", 1681151733.3))
+        converted.wal.close()
+
+    def test_streaming_snapshot(self):
+        # snapshots are written and read back user by user, and damaged
+        # files are rejected instead of half loaded
+        state_file = os.path.join(self.log_dir, "stream.snap")
+        writer = storage.snapshot.SnapshotWriter(state_file, time=5.0, state_version=7, wal_seq=3)
+        inbox = [f"[raj]: message {i}" for i in range(5000)]
+        for i in range(20):
+            writer.write_user(f"user{i}", ("pw", f"User {i}"), ("tok", 1.5), inbox)
+        # inboxes are read once, in batches, whatever iterable they are
+        writer.write_user("streamed", ("pw", "Streamed"), ("tok", 1.5), iter(inbox))
+        writer.write_user("empty", ("pw", "Empty"), ("tok", 1.5), iter([]))
+        writer.close()
+
+        header, users, _ = storage.snapshot.read_snapshot_file(state_file)
+        self.assertEqual(header, {"time": 5.0, "state_version": 7, "wal_seq": 3})
+        users = list(users)
+        self.assertEqual(len(users), 22)
+        self.assertEqual(users[19], ("user19", ("pw", "User 19"), ("tok", 1.5), inbox))
+        self.assertEqual(users[20], ("streamed", ("pw", "Streamed"), ("tok", 1.5), inbox))
+        self.assertEqual(users[21], ("empty", ("pw", "Empty"), ("tok", 1.5), []))
+
+        # an inbox block whose checksum does not match its payload
+        _, users, reader = storage.snapshot.read_snapshot_file(state_file, lazy_inboxes=True)
+        list(users)
+        offset, _ = reader.inbox_blocks["user3"]
+        reader.close()
+        with open(state_file, "r+b") as f:
+            f.seek(offset + 4)
+            f.write(b"\0\0\0\0")
+        _, users, reader = storage.snapshot.read_snapshot_file(state_file, lazy_inboxes=True)
+        list(users)
+        self.assertEqual(reader.read_inbox("user2"), inbox)
+        with self.assertRaises(storage.snapshot.SnapshotError):
+            reader.read_inbox("user3")
+        reader.close()
+
+        with open(state_file, "rb") as f:
+            raw_bytes = f.read()
+        with open(state_file, "wb") as f:
+            f.write(raw_bytes[:len(raw_bytes) // 2])
+        with self.assertRaises(storage.snapshot.SnapshotError):
+            list(storage.snapshot.read_snapshot_file(state_file)[1])
+
+    def test_lazy_state_loading(self):
+        # inboxes of an indexed snapshot are loaded when first touched and
+        # the rest by the warm-up thread
+        for i in range(50):
+            self.chat_server.apply_operation("create_account", {
+                "username": f"user{i}", "password": "pw", "fullname": f"User {i}",
+                "token": "tok", "timestamp": 0.0})
+            self.chat_server.apply_operation("send_message", {
+                "recipient": f"user{i}", "message": f"[raj]: hi {i}"})
+        self.chat_server.apply_operation("create_account", {
+            "username": "empty", "password": "pw", "fullname": "Empty",
+            "token": "tok", "timestamp": 0.0})
+        self.chat_server.write_state()
+        self.chat_server.wal.close()
+
+        _, users, reader = storage.snapshot.read_snapshot_file(
+            self.chat_server.state_file, lazy_inboxes=True)
+        eager = {}
+        pending = []
+        for username, _, _, inbox in users:
+            if inbox is None:
+                pending.append(username)
+            else:
+                eager[username] = inbox
+        self.assertEqual(eager, {"empty": []})
+        inboxes = storage.lazy.LazyInboxes(reader, pending, eager)
+        self.assertEqual(len(inboxes), 51)
+        self.assertIn("user7", inboxes)
+        self.assertEqual(inboxes["user7"], ["[raj]: hi 7"])
+        self.assertEqual(len(inboxes.pending), 49)
+        self.assertEqual(inboxes["nobody"], [])
+        del inboxes["user8"]
+        self.assertNotIn("user8", inboxes)
+        # a copy for a checkpoint leaves the inboxes on disk, and reads them
+        # after the mapping closed the snapshot
+        frozen = inboxes.freeze()
+        self.assertEqual(len(inboxes.pending), 48)
+        self.assertEqual(inboxes.warm_up(threading.Lock()), 48)
+        self.assertIsNone(inboxes.reader)
+        self.assertEqual(frozen["user9"], ["[raj]: hi 9"])
+        self.assertEqual(frozen["user7"], ["[raj]: hi 7"])
+        self.assertEqual(frozen["user8"], [])
+        frozen.close()
+        self.assertEqual(inboxes["user9"], ["[raj]: hi 9"])
+
+        self.chat_server = ChatServer(ServerState.SECONDARY, "test", log_dir=self.log_dir)
+        self.chat_server.warm_up_thread.join()
+        self.assertEqual(len(self.chat_server.user_inbox.pending), 0)
+        self.assertEqual(self.chat_server.user_inbox["user42"], ["[raj]: hi 42"])
+        self.assertEqual(json.loads(self.chat_server.get_state())["user_inbox"]["user3"],
+                         ["[raj]: hi 3"])
+
+    def test_inbox_segments(self):
+        # inboxes kept in segment files behave like the in-memory lists and
+        # only their head is held in memory
+        self.chat_server.wal.close()
+        inbox_dir = os.path.join(self.log_dir, "inboxes_test")
+        self.chat_server = ChatServer(ServerState.PRIMARY, "test", log_dir=self.log_dir,
+                                      inbox_segments=True)
+        for username in ("raj", "aakash"):
+            self.chat_server.commit_operation("create_account", username=username,
+                                              password="pw", fullname=username,
+                                              token="tok", timestamp=0.0)
+        messages = [f"[aakash]: message {i}" for i in range(100)]
+        for message in messages:
+            self.chat_server.commit_operation("send_message", recipient="raj", message=message)
+        inbox = self.chat_server.user_inbox["raj"]
+        self.assertIsInstance(inbox, storage.inbox.SegmentInbox)
+        self.assertEqual(len(inbox), 100)
+        self.assertLessEqual(len(inbox.head), storage.inbox.HEAD_MESSAGES)
+        self.assertEqual(list(inbox), messages)
+
+        for i in range(40):
+            self.assertEqual(self.chat_server.user_inbox["raj"][0], messages[i])
+            self.chat_server.commit_operation("pop_message", username="raj")
+        self.assertEqual(list(inbox), messages[40:])
+        self.assertEqual(json.loads(self.chat_server.get_state())["user_inbox"]["raj"], messages[40:])
+
+        # a frozen copy keeps the messages of its moment, however the
+        # segments change after it was taken
+        frozen = self.chat_server.user_inbox.freeze()
+        self.assertEqual(len(frozen["raj"]), 60)
+        self.assertEqual(list(frozen["aakash"]), [])
+        self.chat_server.commit_operation("send_message", recipient="aakash", message="[raj]: hi")
+        self.chat_server.commit_operation("pop_message", username="aakash")
+        self.chat_server.commit_operation("send_message", recipient="raj", message="[aakash]: later")
+        self.chat_server.commit_operation("pop_message", username="raj")
+        self.assertEqual(list(frozen["raj"]), messages[40:])
+        frozen.close()
+        self.assertFalse(os.path.exists(frozen.directory))
+        messages.append("[aakash]: later")
+        messages.pop(40)
+
+        # a checkpoint streams the linked segments, a restart rebuilds them
+        self.chat_server.checkpoint()
+        self.chat_server.commit_operation("delete_account", username="aakash")
+        self.assertEqual(len(os.listdir(inbox_dir)), 1)
+        self.chat_server.wal.close()
+        self.chat_server = ChatServer(ServerState.PRIMARY, "test", log_dir=self.log_dir,
+                                      inbox_segments=True)
+        self.assertEqual(list(self.chat_server.user_inbox["raj"]), messages[40:])
+        self.assertNotIn("aakash", self.chat_server.user_inbox)
+
+        inbox = self.chat_server.user_inbox["raj"]
+        while len(inbox) > 0:
+            inbox.pop(0)
+        self.assertEqual(os.path.getsize(inbox.path), 0)
+
+    def test_sqlite_backend(self):
+        # the request handlers run unchanged on the SQLite backend, which
+        # takes the place of the snapshot file across restarts
+        self.chat_server.wal.close()
+        self.chat_server = ChatServer(ServerState.PRIMARY, "test", log_dir=self.log_dir,
+                                      storage_backend=storage.backends.BACKEND_SQLITE,
+                                      sqlite_batch=4)
+        server = self.chat_server
+        tokens = {}
+        for username in ("raj", "aakash"):
+            reply = server.CreateAccount(chat_pb2.AccountCreateRequest(
+                version=1, username=username, password="pw", fullname=username.title()), None)
+            self.assertEqual(reply.error_code, "")
+            tokens[username] = reply.auth_token
+        for i in range(3):
+            reply = server.SendMessage(chat_pb2.MessageRequest(
+                version=1, auth_token=tokens["aakash"], username="aakash",
+                recipient_username="raj", message=f"hi {i}"), None)
+            self.assertEqual(reply.error_code, "")
+        reply = server.ListAccounts(chat_pb2.ListAccountRequest(
+            version=1, auth_token=tokens["raj"], username="raj", regex=".*"), None)
+        self.assertEqual(reply.error_code, "")
+        self.assertEqual({name.strip() for name in reply.account_names.split(",")}, {"raj", "aakash"})
+        # a message is only removed once the stream asks for the next one,
+        # a client gone by then gets it again
+        request = chat_pb2.RefreshRequest(version=1, auth_token=tokens["raj"], username="raj")
+        context = MagicMock()
+        context.is_active.return_value = True
+        replies = server.DeliverMessages(request, context)
+        self.assertEqual(next(replies).message, "[aakash]: hi 0")
+        context.is_active.return_value = False
+        self.assertEqual(list(replies), [])
+        self.assertEqual(len(server.user_inbox["raj"]), 3)
+        context.is_active.return_value = True
+        replies = server.DeliverMessages(request, context)
+        self.assertEqual(next(replies).message, "[aakash]: hi 0")
+        self.assertEqual(next(replies).message, "[aakash]: hi 1")
+        self.assertEqual(list(server.user_inbox["raj"]), ["[aakash]: hi 1", "[aakash]: hi 2"])
+        self.assertEqual(json.loads(server.get_state())["user_metadata_store"]["raj"], ["pw", "Raj"])
+
+        # the batch committed after 4 of the 6 operations, the rest comes from the WAL.
+        # Closing the connection drops the open transaction like a crash would
+        server.wal.close()
+        server.storage.close()
+        self.chat_server = ChatServer(ServerState.PRIMARY, "test", log_dir=self.log_dir,
+                                      storage_backend=storage.backends.BACKEND_SQLITE)
+        self.assertEqual(self.chat_server.snapshot_seq, 4)
+        self.assertEqual(list(self.chat_server.user_inbox["raj"]), ["[aakash]: hi 1", "[aakash]: hi 2"])
+        self.assertEqual(self.chat_server.token_hub["raj"][0], tokens["raj"])
+
+        # a checkpoint commits the database instead of writing a snapshot file
+        self.assertEqual(self.chat_server.checkpoint(), self.chat_server.wal_seq)
+        self.assertFalse(os.path.exists(self.chat_server.state_file))
+        self.assertEqual(self.chat_server.storage.recovered()["wal_seq"], self.chat_server.wal_seq)
+
+    def test_commit_log(self):
+        # snapshots are recorded with the checksum of their contents
+        self.chat_server.commit_operation("create_account", username="raj", password="pw",
+                                          fullname="Raj", token="tok", timestamp=0.0)
+        seq = self.chat_server.checkpoint()
+        with open(self.chat_server.state_file, "rb") as f:
+            checksum = zlib.crc32(f.read())
+        last = self.chat_server.commit_log.last_good()
+        self.assertEqual((last["checksum"], last["wal_seq"]), (checksum, seq))
+        self.assertEqual(self.chat_server.prev_commit_hash, checksum)
+
+        # a restart checks the snapshot against the commit and refuses a
+        # corrupted one, whose operations the log no longer holds
+        self.chat_server.wal.close()
+        restarted = ChatServer(ServerState.SECONDARY, "test", log_dir=self.log_dir)
+        self.assertEqual(restarted.snapshot_seq, seq)
+        restarted.wal.close()
+        with open(self.chat_server.state_file, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last_byte = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last_byte[0] ^ 0xff]))
+        with self.assertRaises(storage.snapshot.SnapshotError):
+            ChatServer(ServerState.SECONDARY, "test", log_dir=self.log_dir).wal.close()
+        self.chat_server = ChatServer(ServerState.SECONDARY, "fresh", log_dir=self.log_dir)
+
+        # segments rotate, the index stays sparse and lookups seek
+        commit_dir = os.path.join(self.log_dir, "commits")
+        commit_log = storage.commitlog.CommitLog(commit_dir, segment_bytes=2048, max_segments=4)
+        for i in range(1, 101):
+            commit_log.commit(i, float(i), i, i)
+            if i % 10 == 0:
+                commit_log.error(f"Failing state {i}")
+        segments = commit_log.segments()
+        self.assertEqual(len(segments), 4)
+        self.assertLess(len(commit_log.index), 20)
+        self.assertEqual(commit_log.lookup(97)["wal_seq"], 97)
+        self.assertEqual(commit_log.lookup(segments[0])["id"], segments[0])
+        self.assertIsNone(commit_log.lookup(1))
+        commit_log.close()
+
+        # a torn record at the end is cut off and the last good commit found
+        with open(commit_log.segment_path(segments[-1]), "ab") as f:
+            f.write(b'0badc0de {"id": 101, "kind": "com')
+        commit_log = storage.commitlog.CommitLog(commit_dir, segment_bytes=2048, max_segments=4)
+        self.assertEqual(commit_log.last_good()["id"], 100)
+        self.assertEqual(commit_log.commit(7, 101.0, 101, 101)["id"], 101)
+        self.assertEqual(commit_log.lookup(101)["checksum"], 7)
+        commit_log.close()
+
+    def test_group_commit(self):
+        # concurrent writers waiting in sync share one fsync per batch
+        real_fsync = os.fsync
+        fsync_calls = []
+        def counting_fsync(fd):
+            fsync_calls.append(fd)
+            real_fsync(fd)
+
+        wal = storage.wal.WriteAheadLog(os.path.join(self.log_dir, "group"),
+                                        durability=storage.wal.DURABILITY_FSYNC,
+                                        batch_window=0.05)
+        def writer(i):
+            seq = wal.append("pop_message", {"username": str(i)}, 0.0)
+            wal.sync(seq)
+            self.assertGreaterEqual(wal.durable_seq, seq)
+
+        with patch("os.fsync", side_effect=counting_fsync):
+            threads = [threading.Thread(target=writer, args=(i,)) for i in range(16)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wal.close()
+        self.assertLess(len(fsync_calls), 16)
+        self.assertEqual([r["seq"] for r in wal.replay()], list(range(1, 17)))
+
+        # without durability nothing is ever fsynced
+        fsync_calls.clear()
+        with patch("os.fsync", side_effect=counting_fsync):
+            wal = storage.wal.WriteAheadLog(os.path.join(self.log_dir, "none"),
+                                            durability=storage.wal.DURABILITY_NONE)
+            wal.sync(wal.append("pop_message", {"username": "a"}, 0.0))
+            wal.close()
+        self.assertEqual(len(fsync_calls), 0)
+        self.assertEqual(len(list(wal.replay())), 1)
+
+    def test_failed_batch_fails_the_log(self):
+        # a batch that cannot be encoded or written fails the sync of its
+        # records and of every later one, nothing is written after the gap
+        wal = storage.wal.WriteAheadLog(os.path.join(self.log_dir, "failing"),
+                                        durability=storage.wal.DURABILITY_FSYNC)
+        with self.assertRaises(TypeError):
+            wal.sync(wal.append("pop_message", {"username": {"not", "json"}}, 0.0))
+        with self.assertRaises(TypeError):
+            wal.sync(wal.append("pop_message", {"username": "after"}, 0.0))
+        self.assertEqual((wal.stats()["failed_seq"], wal.stats()["durable_seq"]), (1, 0))
+        wal.close()
+        self.assertEqual(list(wal.replay()), [])
+
+        wal = storage.wal.WriteAheadLog(os.path.join(self.log_dir, "unsynced"),
+                                        durability=storage.wal.DURABILITY_FSYNC)
+        with patch("os.fsync", side_effect=OSError("disk gone")):
+            with self.assertRaises(OSError):
+                wal.sync(wal.append("pop_message", {"username": "unsynced"}, 0.0))
+        with self.assertRaises(OSError):
+            wal.sync(wal.append("pop_message", {"username": "after"}, 0.0))
+        self.assertEqual(wal.stats()["durable_seq"], 0)
+        wal.close()
+        # the record whose fsync failed was written, only not acknowledged
+        self.assertEqual([r["args"]["username"] for r in wal.replay()], ["unsynced"])
+
+        # the server stops serving once its log failed
+        server = self.chat_server
+        server.server_state = ServerState.PRIMARY
+        with patch("os.fsync", side_effect=OSError("disk gone")):
+            with self.assertRaises(OSError):
+                server.CreateAccount(chat_pb2.AccountCreateRequest(
+                    version=1, username="raj", password="pw", fullname="Raj"), None)
+        self.assertEqual(server.server_state, ServerState.BROKEN)
+        self.assertFalse(server.has_lease())
+        reply = server.CreateAccount(chat_pb2.AccountCreateRequest(
+            version=1, username="aakash", password="pw", fullname="Aakash"), None)
+        self.assertEqual(reply.error_code, grpc_server.SECONDARY_ERROR_CODE)
+
+    def test_writer_queue_backpressure(self):
+        wal = storage.wal.WriteAheadLog(os.path.join(self.log_dir, "bounded"),
+                                        durability=storage.wal.DURABILITY_ASYNC,
+                                        queue_size=2)
+        # stall the writer thread on the segment files
+        wal.write_lock.acquire()
+        wal.append("pop_message", {"username": "0"}, 0.0)
+        while wal.queue.qsize() > 0:
+            time.sleep(0.01)
+        # appending never blocks, even past the queue size
+        for i in range(1, 4):
+            wal.append("pop_message", {"username": str(i)}, 0.0)
+        wal.sync(2)
+        stalled = threading.Thread(target=wal.sync, args=(3,))
+        stalled.start()
+        stalled.join(0.2)
+        # one batch is held by the stalled writer and more than the queue
+        # size is waiting before the record
+        self.assertTrue(stalled.is_alive())
+        self.assertEqual(wal.stats()["queue_depth"], 3)
+        self.assertEqual(wal.stats()["lag_records"], 4)
+
+        wal.write_lock.release()
+        stalled.join(5)
+        self.assertFalse(stalled.is_alive())
+        wal.flush()
+        stats = wal.stats()
+        self.assertEqual(stats["lag_records"], 0)
+        self.assertEqual(stats["max_queue_depth"], 3)
+        wal.close()
+        self.assertEqual(len(list(wal.replay())), 4)
+
 if __name__ == "__main__":
     test_obj = TestChatServer()
     test_obj.setUp()
     test_obj.test_get_state()
     test_obj.test_get_state_time_created()
     test_obj.test_set_state()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_wal_recovery()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_checkpoint_compacts_wal()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_operation_shipping()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_replication_modes()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_json_state_file_conversion()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_streaming_snapshot()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_lazy_state_loading()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_inbox_segments()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_sqlite_backend()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_commit_log()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_group_commit()
+    test_obj.tearDown()
+    test_obj.setUp()
+    test_obj.test_writer_queue_backpressure()
+    test_obj.tearDown()
     print("Final Result:")
-    print(Fore.GREEN + "Passed 3/3 Tests!")
+    print(Fore.GREEN + "Passed 15/15 Tests!")
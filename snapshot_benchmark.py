@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from colorama import Fore, Style
+
+import storage
+
+
+def BuildState(num_users: int, messages_per_user: int):
+    """
+    Builds a synthetic server state with `num_users` accounts that each
+    have `messages_per_user` undelivered messages.
+
+    Returns:
+        (dict, dict, dict): The metadata store, token hub and inboxes.
+    """
+    usernames = [f"user{i}" for i in range(num_users)]
+    user_metadata_store = {u: ("password", f"Full Name {u}") for u in usernames}
+    token_hub = {u: ("ad0773ecebaea0e2ac2dc62cf36000", 1681151733.382239) for u in usernames}
+    user_inbox = {
+        u: [f"[{usernames[(i + j) % num_users]}]: message number {j} for \"{u}\""
+            for j in range(messages_per_user)]
+        for i, u in enumerate(usernames)}
+    return user_metadata_store, token_hub, user_inbox
+
+
+def Timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def PeakMemory(func):
+    """
+    Returns:
+        float: The peak Python heap allocated while running `func`, in MB.
+        Memory allocated by protobuf's C implementation is not seen.
+    """
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak / 1e6
+
+
+def ProcStatus(field: str) -> int:
+    # A kB value from /proc/self/status
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def PeakRSS(func):
+    """
+    Returns:
+        float: How far the resident set grew while running `func`, in MB,
+        counting every allocation. None where the peak cannot be reset,
+        outside Linux.
+    """
+    try:
+        # resets VmHWM, the peak resident set, to the current one
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        before = ProcStatus("VmRSS")
+    except (OSError, KeyError):
+        return None
+    result = func()
+    peak = ProcStatus("VmHWM")
+    del result
+    return (peak - before) * 1024 / 1e6
+
+
+def WriteStream(path, user_metadata_store, token_hub, user_inbox):
+    writer = storage.snapshot.SnapshotWriter(path, time=time.time())
+    for username, metadata in user_metadata_store.items():
+        writer.write_user(username, metadata, token_hub[username], user_inbox[username])
+    writer.close()
+
+
+def ReadStream(path):
+    _, users, _ = storage.snapshot.read_snapshot_file(path)
+    return {username: inbox for username, _, _, inbox in users}
+
+
+def Run(num_users: int, messages_per_user: int) -> None:
+    """
+    Compares the JSON state encoding with the binary and streaming
+    snapshot encodings.
+    """
+    user_metadata_store, token_hub, user_inbox = BuildState(num_users, messages_per_user)
+    print(f"State: {num_users} users, {num_users * messages_per_user} messages")
+    stream_path = os.path.join(tempfile.mkdtemp(), "state_store_benchmark.txt")
+
+    # extra memory needed to save a state that is already in memory. The
+    # resident set is measured before anything else, memory freed earlier
+    # is kept by the allocator and would hide the growth. For the same
+    # reason the stream goes before the binary encoding.
+    def EncodeBinary():
+        return storage.snapshot.encode_state(user_metadata_store, token_hub, user_inbox, time=time.time())
+
+    def SaveStream():
+        WriteStream(stream_path, user_metadata_store, token_hub, user_inbox)
+    stream_rss = PeakRSS(SaveStream)
+    binary_rss = PeakRSS(EncodeBinary)
+    binary_peak = PeakMemory(EncodeBinary)
+    stream_peak = PeakMemory(SaveStream)
+
+    json_bytes, json_encode = Timed(lambda: json.dumps({
+        "time": time.time(),
+        "user_inbox": user_inbox,
+        "user_metadata_store": user_metadata_store,
+        "token_hub": token_hub}).encode("ascii"))
+    _, json_decode = Timed(lambda: json.loads(json_bytes))
+
+    binary_bytes, binary_encode = Timed(lambda: storage.snapshot.encode_state(
+        user_metadata_store, token_hub, user_inbox, time=time.time()))
+    decoded, binary_decode = Timed(lambda: storage.snapshot.decode_state(binary_bytes))
+    assert decoded["users"]["user0"]["inbox"] == user_inbox["user0"]
+
+    _, stream_encode = Timed(lambda: WriteStream(stream_path, user_metadata_store, token_hub, user_inbox))
+    inboxes, stream_decode = Timed(lambda: ReadStream(stream_path))
+    assert inboxes["user0"] == user_inbox["user0"]
+    del inboxes
+    stream_size = os.path.getsize(stream_path)
+
+    print(f"{'format':<8}{'size (MB)':>12}{'encode (s)':>12}{'decode (s)':>12}")
+    print(f"{'json':<8}{len(json_bytes) / 1e6:>12.1f}{json_encode:>12.3f}{json_decode:>12.3f}")
+    print(f"{'binary':<8}{len(binary_bytes) / 1e6:>12.1f}{binary_encode:>12.3f}{binary_decode:>12.3f}")
+    print(f"{'stream':<8}{stream_size / 1e6:>12.1f}{stream_encode:>12.3f}{stream_decode:>12.3f}")
+    json_size, binary_size = len(json_bytes), len(binary_bytes)
+    os.remove(stream_path)
+    print(f"Peak Python heap while saving: binary {binary_peak:.1f} MB, stream {stream_peak:.1f} MB")
+    if stream_rss is not None:
+        print(f"Peak resident set growth while saving: binary {binary_rss:.1f} MB, stream {stream_rss:.1f} MB")
+        binary_peak, stream_peak = binary_rss, stream_rss
+
+    if binary_size < json_size and binary_encode + binary_decode < json_encode + json_decode:
+        print(Fore.GREEN + "Binary snapshot is smaller and faster" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "Binary snapshot is not smaller and faster" + Style.RESET_ALL)
+    if stream_peak < binary_peak:
+        print(Fore.GREEN + "Streaming snapshot saves in bounded memory" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "Streaming snapshot does not save memory" + Style.RESET_ALL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='snapshot_benchmark',
+        description='Compares JSON, binary and streaming state snapshot encodings')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages-per-user', type=int, default=100)
+    args = parser.parse_args()
+    Run(args.users, args.messages_per_user)
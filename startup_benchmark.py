@@ -0,0 +1,99 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent import futures
+
+import grpc
+from colorama import Fore, Style
+
+import chat_pb2
+import chat_pb2_grpc
+import storage
+from grpc_server import ChatServer, ServerState
+from snapshot_benchmark import BuildState
+
+
+def WriteSnapshot(log_dir: str, num_users: int, messages_per_user: int) -> None:
+    """
+    Writes a synthetic state as the snapshot of a server named "bench".
+    """
+    user_metadata_store, token_hub, user_inbox = BuildState(num_users, messages_per_user)
+    writer = storage.snapshot.SnapshotWriter(
+        os.path.join(log_dir, "state_store_bench.txt"), time=time.time())
+    for username, metadata in user_metadata_store.items():
+        writer.write_user(username, metadata, token_hub[username], user_inbox[username])
+    writer.close()
+
+
+def TimeToFirstRPC(snapshot_dir: str, lazy_inboxes: bool):
+    """
+    Boots a primary from a copy of the snapshot in `snapshot_dir` and
+    times the first Login and the first DeliverMessages.
+
+    Returns:
+        (float, float, float): Seconds from boot to the Login reply, to the
+        first delivered message and until every inbox is in memory.
+    """
+    log_dir = tempfile.mkdtemp()
+    shutil.copy(os.path.join(snapshot_dir, "state_store_bench.txt"), log_dir)
+
+    start = time.perf_counter()
+    chat_server = ChatServer(ServerState.PRIMARY, "bench", log_dir=log_dir, lazy_inboxes=lazy_inboxes)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    chat_pb2_grpc.add_ChatServerServicer_to_server(chat_server, server)
+    port = server.add_insecure_port("localhost:0")
+    server.start()
+
+    with grpc.insecure_channel(f"localhost:{port}") as channel:
+        stub = chat_pb2_grpc.ChatServerStub(channel)
+        login = stub.Login(chat_pb2.LoginRequest(username="user1", password="password"))
+        first_login = time.perf_counter() - start
+        assert login.error_code == "", login.error_code
+        replies = stub.DeliverMessages(chat_pb2.RefreshRequest(
+            version=1, auth_token=login.auth_token, username="user1"))
+        next(iter(replies))
+        replies.cancel()
+        first_delivery = time.perf_counter() - start
+
+    if chat_server.warm_up_thread is not None:
+        chat_server.warm_up_thread.join()
+    fully_loaded = time.perf_counter() - start
+
+    server.stop(None)
+    chat_server.wal.close()
+    shutil.rmtree(log_dir, ignore_errors=True)
+    return first_login, first_delivery, fully_loaded
+
+
+def Run(num_users: int, messages_per_user: int) -> None:
+    """
+    Compares server startup with inboxes loaded eagerly and lazily.
+    """
+    snapshot_dir = tempfile.mkdtemp()
+    WriteSnapshot(snapshot_dir, num_users, messages_per_user)
+    print(f"State: {num_users} users, {num_users * messages_per_user} messages")
+
+    eager = TimeToFirstRPC(snapshot_dir, lazy_inboxes=False)
+    lazy = TimeToFirstRPC(snapshot_dir, lazy_inboxes=True)
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    print(f"{'loading':<8}{'Login (s)':>12}{'Deliver (s)':>13}{'all loaded (s)':>16}")
+    for name, (first_login, first_delivery, fully_loaded) in (("eager", eager), ("lazy", lazy)):
+        print(f"{name:<8}{first_login:>12.3f}{first_delivery:>13.3f}{fully_loaded:>16.3f}")
+
+    if lazy[0] < eager[0]:
+        print(Fore.GREEN + "Lazy loading answers the first RPC sooner" + Style.RESET_ALL)
+    else:
+        print(Fore.RED + "Lazy loading does not answer the first RPC sooner" + Style.RESET_ALL)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='startup_benchmark',
+        description='Measures the time from server boot to the first RPC with eager and lazy inbox loading')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages-per-user', type=int, default=100)
+    args = parser.parse_args()
+    Run(args.users, args.messages_per_user)
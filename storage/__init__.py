@@ -0,0 +1,7 @@
+from . import wal
+from . import checkpoint
+from . import snapshot
+from . import lazy
+from . import inbox
+from . import backends
+from . import commitlog
@@ -0,0 +1,335 @@
+import sqlite3
+import threading as th
+from collections import defaultdict
+from collections.abc import MutableMapping
+
+BACKEND_MEMORY = "memory"
+BACKEND_SQLITE = "sqlite"
+BACKENDS = (BACKEND_MEMORY, BACKEND_SQLITE)
+DEFAULT_BACKEND = BACKEND_MEMORY
+# operations applied before the SQLite transaction is committed without
+# waiting for the next checkpoint
+DEFAULT_SQLITE_BATCH = 1000
+
+
+class MemoryBackend:
+    """
+    Keeps the state in plain dictionaries. Nothing is persisted by the
+    backend itself, the server writes snapshot files at checkpoints.
+    """
+
+    persistent = False
+
+    def create(self):
+        """
+        Returns:
+            (mapping, mapping, mapping): Empty user metadata store, token hub
+            and user inboxes.
+        """
+        return {}, {}, defaultdict(list)
+
+    def install(self, user_metadata_store, token_hub, user_inbox):
+        """
+        Makes the given state the current one.
+
+        Returns:
+            (mapping, mapping, mapping): The mappings to use from now on.
+        """
+        return user_metadata_store, token_hub, user_inbox
+
+    def recovered(self):
+        """
+        Returns:
+            dict: time, state_version and wal_seq of the state the backend
+            persisted, None if the state has to come from a snapshot.
+        """
+        return None
+
+    def operation_applied(self, wal_seq, state_version, time):
+        pass
+
+    def commit(self, wal_seq, state_version, time):
+        pass
+
+    def close(self):
+        pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    fullname TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    username TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS inboxes (
+    username TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_user ON messages (username, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+
+class SQLiteTable(MutableMapping):
+    """
+    username -> (value, value) mapping over a two column table, used for
+    the accounts (password, fullname) and the tokens (token, timestamp).
+    """
+
+    def __init__(self, backend, table, columns):
+        self.backend = backend
+        first, second = columns
+        # the statements are built once, sqlite3 keeps them prepared
+        self.select_sql = f"SELECT {first}, {second} FROM {table} WHERE username = ?"
+        self.contains_sql = f"SELECT 1 FROM {table} WHERE username = ?"
+        self.upsert_sql = f"INSERT OR REPLACE INTO {table} (username, {first}, {second}) VALUES (?, ?, ?)"
+        self.delete_sql = f"DELETE FROM {table} WHERE username = ?"
+        self.keys_sql = f"SELECT username FROM {table} ORDER BY username"
+        self.count_sql = f"SELECT COUNT(*) FROM {table}"
+        self.clear_sql = f"DELETE FROM {table}"
+
+    def __getitem__(self, username):
+        row = self.backend.fetchone(self.select_sql, (username,))
+        if row is None:
+            raise KeyError(username)
+        return row
+
+    def __setitem__(self, username, value):
+        first, second = value
+        self.backend.execute(self.upsert_sql, (username, first, second))
+
+    def __delitem__(self, username):
+        if self.backend.execute(self.delete_sql, (username,)) == 0:
+            raise KeyError(username)
+
+    def __contains__(self, username):
+        return self.backend.fetchone(self.contains_sql, (username,)) is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self.backend.fetchall(self.keys_sql, ())])
+
+    def __len__(self):
+        return self.backend.fetchone(self.count_sql, ())[0]
+
+    def load(self, items):
+        # Replaces the whole table in one statement batch
+        self.backend.execute(self.clear_sql, ())
+        self.backend.executemany(
+            self.upsert_sql, ((username, first, second) for username, (first, second) in items))
+
+
+class SQLiteInbox:
+    """
+    List-like view of one user's queued messages, supporting the list
+    operations the server uses on inboxes: append, pop(0), [0], len and
+    iteration.
+    """
+
+    def __init__(self, backend, username):
+        self.backend = backend
+        self.username = username
+
+    def append(self, message):
+        self.backend.execute(
+            "INSERT INTO messages (username, message) VALUES (?, ?)", (self.username, message))
+
+    def pop(self, index=0):
+        """
+        Removes and returns the oldest message.
+        """
+        if index != 0:
+            raise IndexError("only the oldest message can be popped from an inbox")
+        row = self.backend.fetchone(
+            "SELECT id, message FROM messages WHERE username = ? ORDER BY id LIMIT 1", (self.username,))
+        if row is None:
+            raise IndexError("inbox is empty")
+        self.backend.execute("DELETE FROM messages WHERE id = ?", (row[0],))
+        return row[1]
+
+    def __getitem__(self, index):
+        if index == 0:
+            row = self.backend.fetchone(
+                "SELECT message FROM messages WHERE username = ? ORDER BY id LIMIT 1", (self.username,))
+            if row is None:
+                raise IndexError("inbox is empty")
+            return row[0]
+        return list(self)[index]
+
+    def __len__(self):
+        return self.backend.fetchone(
+            "SELECT COUNT(*) FROM messages WHERE username = ?", (self.username,))[0]
+
+    def __iter__(self):
+        return iter([row[0] for row in self.backend.fetchall(
+            "SELECT message FROM messages WHERE username = ? ORDER BY id", (self.username,))])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"SQLiteInbox({self.username!r})"
+
+
+class SQLiteInboxes(MutableMapping):
+    """
+    username -> `SQLiteInbox` mapping. Like the defaultdict it replaces,
+    looking up a user without an inbox creates an empty one.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getitem__(self, username):
+        self.backend.execute("INSERT OR IGNORE INTO inboxes (username) VALUES (?)", (username,))
+        return SQLiteInbox(self.backend, username)
+
+    def __setitem__(self, username, messages):
+        self.backend.execute("INSERT OR IGNORE INTO inboxes (username) VALUES (?)", (username,))
+        self.backend.execute("DELETE FROM messages WHERE username = ?", (username,))
+        self.backend.executemany(
+            "INSERT INTO messages (username, message) VALUES (?, ?)",
+            ((username, message) for message in messages))
+
+    def __delitem__(self, username):
+        if self.backend.execute("DELETE FROM inboxes WHERE username = ?", (username,)) == 0:
+            raise KeyError(username)
+        self.backend.execute("DELETE FROM messages WHERE username = ?", (username,))
+
+    def __contains__(self, username):
+        return self.backend.fetchone(
+            "SELECT 1 FROM inboxes WHERE username = ?", (username,)) is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self.backend.fetchall(
+            "SELECT username FROM inboxes ORDER BY username", ())])
+
+    def __len__(self):
+        return self.backend.fetchone("SELECT COUNT(*) FROM inboxes", ())[0]
+
+    def load(self, items):
+        self.backend.execute("DELETE FROM inboxes", ())
+        self.backend.execute("DELETE FROM messages", ())
+        for username, messages in items:
+            self[username] = messages
+
+
+class SQLiteBackend:
+    """
+    Keeps the state in a SQLite database in WAL mode, with indexed tables
+    for accounts, tokens and queued messages.
+
+    Operations are applied inside one open transaction that is committed
+    every `batch_size` operations and at every checkpoint, together with
+    the write-ahead log sequence it covers. The database then takes the
+    place of the snapshot file: at startup the state is whatever the last
+    commit holds, and the server replays the log records after its sequence.
+    """
+
+    persistent = True
+
+    def __init__(self, path, batch_size=DEFAULT_SQLITE_BATCH):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending_operations = 0
+        # one connection is shared by the request threads, statements are
+        # serialized on this lock
+        self.lock = th.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+            self.connection.commit()
+        self.user_metadata_store = SQLiteTable(self, "accounts", ("password", "fullname"))
+        self.token_hub = SQLiteTable(self, "tokens", ("token", "timestamp"))
+        self.user_inbox = SQLiteInboxes(self)
+
+    def execute(self, sql, params):
+        """
+        Returns:
+            int: The number of rows changed.
+        """
+        with self.lock:
+            return self.connection.execute(sql, params).rowcount
+
+    def executemany(self, sql, rows):
+        with self.lock:
+            self.connection.executemany(sql, rows)
+
+    def fetchone(self, sql, params):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def create(self):
+        return self.user_metadata_store, self.token_hub, self.user_inbox
+
+    def install(self, user_metadata_store, token_hub, user_inbox):
+        self.user_metadata_store.load(list(user_metadata_store.items()))
+        self.token_hub.load(list(token_hub.items()))
+        self.user_inbox.load(list(user_inbox.items()))
+        return self.create()
+
+    def recovered(self):
+        rows = dict(self.fetchall("SELECT key, value FROM meta", ()))
+        if "wal_seq" not in rows:
+            return None
+        return {
+            "time": rows["time"],
+            "state_version": int(rows["state_version"]),
+            "wal_seq": int(rows["wal_seq"]),
+            }
+
+    def operation_applied(self, wal_seq, state_version, time):
+        """
+        Counts an applied operation and commits the batch once it is full.
+        Called while no other operation is being applied.
+        """
+        self.pending_operations += 1
+        if self.pending_operations >= self.batch_size:
+            self.commit(wal_seq, state_version, time)
+
+    def commit(self, wal_seq, state_version, time):
+        """
+        Commits the open transaction together with the log position and
+        state version it brings the database to.
+        """
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (("time", time or 0.0), ("state_version", state_version), ("wal_seq", wal_seq)))
+            self.connection.commit()
+            self.pending_operations = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def open_backend(name, sqlite_path=None, sqlite_batch=DEFAULT_SQLITE_BATCH):
+    """
+    Args:
+        name (str): One of BACKENDS.
+        sqlite_path (str): Database file for the SQLite backend.
+        sqlite_batch (int): Operations per SQLite transaction.
+    """
+    if name == BACKEND_MEMORY:
+        return MemoryBackend()
+    if name == BACKEND_SQLITE:
+        return SQLiteBackend(sqlite_path, sqlite_batch)
+    raise ValueError(f"Unknown storage backend: {name}")
@@ -0,0 +1,272 @@
+import bisect
+import json
+import os
+import struct
+import threading as th
+import time
+import zlib
+
+SEGMENT_PREFIX = "commits_"
+SEGMENT_SUFFIX = ".log"
+INDEX_FILE = "index"
+DEFAULT_SEGMENT_BYTES = 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 8
+# every INDEX_INTERVAL-th commit (and the first commit of every segment)
+# gets an index entry
+INDEX_INTERVAL = 32
+# commit id, first commit id of the segment, byte offset in the segment
+INDEX_ENTRY = struct.Struct(">QQQ")
+
+COMMIT = "commit"
+ERROR = "error"
+
+
+class CommitLog:
+    """
+    Segmented log of the snapshots (commits) a server has written, plus
+    the states it failed to install.
+
+    Every record is one line holding the CRC32 of its JSON body followed by
+    the body, {"id": ..., "kind": "commit", "time": ..., "checksum": ...,
+    "wal_seq": ..., "state_version": ...} for commits where checksum is the
+    CRC32 of the snapshot file. Segments are named after the first commit
+    id they hold, rotate once they grow past `segment_bytes`, and only the
+    newest `max_segments` are kept.
+
+    A sparse index file maps every INDEX_INTERVAL-th commit id to its
+    segment and offset, so looking up a commit or finding the last intact
+    one reads at most INDEX_INTERVAL commits instead of the whole log.
+    """
+
+    def __init__(self,
+                 directory,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_segments=DEFAULT_MAX_SEGMENTS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.lock = th.Lock()
+        self.active_file = None
+        self.active_first_id = None
+        os.makedirs(directory, exist_ok=True)
+        self.index = self.read_index()
+        self.recover()
+
+    def segment_path(self, first_id):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{first_id:020d}{SEGMENT_SUFFIX}")
+
+    def segments(self):
+        """
+        Returns:
+            list: The first commit ids of the segments, oldest first.
+        """
+        first_ids = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    first_ids.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(first_ids)
+
+    def read_index(self):
+        # A torn entry at the end of the index is dropped
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, "rb") as index_file:
+            raw_bytes = index_file.read()
+        usable = len(raw_bytes) - len(raw_bytes) % INDEX_ENTRY.size
+        return [INDEX_ENTRY.unpack_from(raw_bytes, offset)
+                for offset in range(0, usable, INDEX_ENTRY.size)]
+
+    def write_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as index_file:
+            for entry in self.index:
+                index_file.write(INDEX_ENTRY.pack(*entry))
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def encode(record):
+        body = json.dumps(record, sort_keys=True)
+        return f"{zlib.crc32(body.encode('utf-8')):08x} {body}\n".encode("utf-8")
+
+    @staticmethod
+    def decode(line):
+        # Returns the record of an intact line, None for a torn or corrupt one
+        if not line.endswith(b"\n") or len(line) < 10:
+            return None
+        checksum, body = line[:8], line[9:-1]
+        try:
+            if int(checksum, 16) != zlib.crc32(body):
+                return None
+            return json.loads(body)
+        except ValueError:
+            return None
+
+    def read_records(self, first_id, offset=0):
+        """
+        Yields (offset, end offset, record) for the intact records of a
+        segment from `offset` on, stopping at the first torn or corrupt one.
+        """
+        with open(self.segment_path(first_id), "rb") as segment:
+            segment.seek(offset)
+            for line in segment:
+                record = self.decode(line)
+                if record is None:
+                    return
+                yield offset, offset + len(line), record
+                offset += len(line)
+
+    def scan_start(self, first_id):
+        # Offset of the last index entry in the segment, where a scan for
+        # its last commit can start
+        for _, segment_id, offset in reversed(self.index):
+            if segment_id == first_id:
+                return offset
+            if segment_id < first_id:
+                break
+        return 0
+
+    def recover(self):
+        """
+        Cuts a torn record off the newest segment, drops index entries that
+        point past the cut, and finds the next commit id.
+        """
+        self.next_id = 1
+        self.last_commit = None
+        segments = self.segments()
+        if len(segments) == 0:
+            return
+        first_id = segments[-1]
+        path = self.segment_path(first_id)
+        good_offset = self.scan_start(first_id)
+        for _, good_offset, _ in self.read_records(first_id, good_offset):
+            pass
+        if good_offset < os.path.getsize(path):
+            print(f"Truncating torn commit log record in {path} at offset {good_offset}")
+            with open(path, "r+b") as segment:
+                segment.truncate(good_offset)
+        kept = [entry for entry in self.index
+                if entry[1] in segments and not (entry[1] == first_id and entry[2] >= good_offset)]
+        if kept != self.index:
+            self.index = kept
+            self.write_index()
+        self.last_commit = self.last_good()
+        if self.last_commit is not None:
+            self.next_id = self.last_commit["id"] + 1
+
+    def last_good(self):
+        """
+        Returns:
+            dict: The newest intact commit record, None if there is none.
+            Only the newest segment holding a commit is read, from its last
+            index entry on.
+        """
+        for first_id in reversed(self.segments()):
+            last = None
+            for _, _, record in self.read_records(first_id, self.scan_start(first_id)):
+                if record["kind"] == COMMIT:
+                    last = record
+            if last is not None:
+                return last
+        return None
+
+    def lookup(self, commit_id):
+        """
+        Returns:
+            dict: The commit record with `commit_id`, None if it is not in
+            the log (anymore).
+        """
+        position = bisect.bisect_right(self.index, (commit_id, float("inf"), float("inf")))
+        if position == 0:
+            return None
+        _, first_id, offset = self.index[position - 1]
+        if not os.path.exists(self.segment_path(first_id)):
+            return None
+        for _, _, record in self.read_records(first_id, offset):
+            if record["kind"] == COMMIT and record["id"] == commit_id:
+                return record
+            if record["kind"] == COMMIT and record["id"] > commit_id:
+                break
+        return None
+
+    def roll_segment(self, first_id):
+        # Caller must hold lock
+        if self.active_file is not None:
+            self.active_file.close()
+        self.active_file = open(self.segment_path(first_id), "ab")
+        self.active_first_id = first_id
+        segments = self.segments()
+        if len(segments) > self.max_segments:
+            dropped = segments[:len(segments) - self.max_segments]
+            for dropped_id in dropped:
+                os.remove(self.segment_path(dropped_id))
+            self.index = [entry for entry in self.index if entry[1] not in dropped]
+            self.write_index()
+
+    def append(self, record, sync=False):
+        # Caller must hold lock
+        line = self.encode(record)
+        if self.active_file is None:
+            segments = self.segments()
+            if len(segments) > 0 and os.path.getsize(self.segment_path(segments[-1])) < self.segment_bytes:
+                self.roll_segment(segments[-1])
+            else:
+                self.roll_segment(self.next_id)
+        elif self.active_file.tell() >= self.segment_bytes:
+            self.roll_segment(self.next_id)
+        offset = self.active_file.tell()
+        self.active_file.write(line)
+        self.active_file.flush()
+        if sync:
+            os.fsync(self.active_file.fileno())
+        return offset
+
+    def commit(self, checksum, state_time, wal_seq, state_version):
+        """
+        Records a snapshot.
+
+        Args:
+            checksum (int): CRC32 of the snapshot contents, None if the
+            snapshot is not a file.
+            state_time (float): Time of the state.
+            wal_seq (int): WAL sequence number the snapshot covers.
+            state_version (int): State version of the snapshot.
+
+        Returns:
+            dict: The commit record.
+        """
+        with self.lock:
+            record = {
+                "id": self.next_id,
+                "kind": COMMIT,
+                "time": state_time,
+                "checksum": checksum,
+                "wal_seq": wal_seq,
+                "state_version": state_version,
+                }
+            offset = self.append(record, sync=True)
+            first_in_segment = len(self.index) == 0 or self.index[-1][1] != self.active_first_id
+            if first_in_segment or record["id"] % INDEX_INTERVAL == 0:
+                entry = (record["id"], self.active_first_id, offset)
+                self.index.append(entry)
+                with open(self.index_path, "ab") as index_file:
+                    index_file.write(INDEX_ENTRY.pack(*entry))
+            self.next_id += 1
+            self.last_commit = record
+            return record
+
+    def error(self, message):
+        """
+        Records a state that could not be installed.
+        """
+        with self.lock:
+            self.append({"kind": ERROR, "time": time.time(), "message": message})
+
+    def close(self):
+        with self.lock:
+            if self.active_file is not None:
+                self.active_file.close()
+                self.active_file = None
@@ -0,0 +1,279 @@
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+SEGMENT_SUFFIX = ".inbox"
+MESSAGE_LENGTH = struct.Struct(">I")
+# messages of a queue kept decoded in memory
+HEAD_MESSAGES = 16
+# delivered bytes at the front of a segment before it is rewritten
+COMPACT_BYTES = 1024 * 1024
+# messages decoded at a time while an inbox is iterated
+READ_BATCH_MESSAGES = 1024
+# prefix of the directories holding frozen segments, see SegmentInboxes.freeze
+FROZEN_PREFIX = "checkpoint_"
+
+
+def read_messages(path, start, end):
+    """
+    Yields the messages stored in the segment file at `path` between the
+    byte offsets `start` and `end`, decoded through an mmap.
+    """
+    if start >= end:
+        return
+    with open(path, "rb") as segment:
+        with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            offset = start
+            while offset < end:
+                (length,) = MESSAGE_LENGTH.unpack_from(mapped, offset)
+                offset += MESSAGE_LENGTH.size
+                yield mapped[offset:offset + length].decode("utf-8")
+                offset += length
+
+
+def replace_file(path, data=b""):
+    # Puts a new file with data at path by a rename, the old file is never
+    # changed in place
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as replacement:
+        replacement.write(data)
+    os.replace(tmp_path, path)
+
+
+class SegmentInbox:
+    """
+    Queue of undelivered messages for one user, kept in an append-only
+    segment file of length prefixed UTF-8 records.
+
+    Only the next few messages (the head) are decoded and held in memory,
+    they are read through an mmap of the segment when the head runs empty.
+    Delivered messages are skipped by moving the start offset forward, the
+    file is emptied once everything is delivered and rewritten once the
+    delivered prefix grows past `COMPACT_BYTES`.
+
+    Supports the list operations the server uses on inboxes: append,
+    pop(0), [0], len and iteration.
+
+    The bytes a segment file holds are never changed in place, it is only
+    appended to or replaced by a rename. A hard link to it therefore keeps
+    the messages it holds at that moment, see `SegmentInboxes.freeze`.
+    """
+
+    def __init__(self, path, messages=()):
+        self.path = path
+        self.start = 0
+        self.size = 0
+        self.count = 0
+        # decoded messages between start and head_end
+        self.head = []
+        self.head_end = 0
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as segment:
+            self.write(segment, messages)
+        os.replace(tmp_path, self.path)
+
+    def write(self, segment, messages):
+        records = []
+        for message in messages:
+            encoded = message.encode("utf-8")
+            records.append(MESSAGE_LENGTH.pack(len(encoded)) + encoded)
+            # the head keeps following the tail while it is not full
+            if self.head_end == self.size and len(self.head) < HEAD_MESSAGES:
+                self.head.append(message)
+                self.head_end += len(records[-1])
+            self.size += len(records[-1])
+            self.count += 1
+        segment.write(b"".join(records))
+
+    def read(self, offset, limit=None):
+        # Decodes the messages from offset on, at most limit of them
+        messages = []
+        if offset >= self.size:
+            return messages, offset
+        with open(self.path, "rb") as segment:
+            with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                while offset < self.size and (limit is None or len(messages) < limit):
+                    (length,) = MESSAGE_LENGTH.unpack_from(mapped, offset)
+                    offset += MESSAGE_LENGTH.size
+                    messages.append(mapped[offset:offset + length].decode("utf-8"))
+                    offset += length
+        return messages, offset
+
+    def fill_head(self):
+        messages, self.head_end = self.read(self.head_end, HEAD_MESSAGES - len(self.head))
+        self.head.extend(messages)
+
+    def append(self, message):
+        with open(self.path, "ab") as segment:
+            self.write(segment, [message])
+
+    def pop(self, index=0):
+        """
+        Removes and returns the oldest message.
+        """
+        if index != 0:
+            raise IndexError("only the oldest message can be popped from an inbox")
+        message = self[0]
+        self.head.pop(0)
+        self.start += MESSAGE_LENGTH.size + len(message.encode("utf-8"))
+        self.count -= 1
+        if self.count == 0:
+            replace_file(self.path)
+            self.start = self.size = self.head_end = 0
+        elif self.start >= COMPACT_BYTES and self.start * 2 >= self.size:
+            self.compact()
+        return message
+
+    def compact(self):
+        # Rewrites the segment without the delivered messages
+        tmp_path = self.path + ".tmp"
+        with open(self.path, "rb") as segment:
+            with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with open(tmp_path, "wb") as compacted:
+                    compacted.write(mapped[self.start:self.size])
+        os.replace(tmp_path, self.path)
+        self.head_end -= self.start
+        self.size -= self.start
+        self.start = 0
+
+    def remove(self):
+        os.remove(self.path)
+
+    def link(self, path):
+        """
+        Hard links the segment at `path`.
+
+        Returns:
+            FrozenInbox: The messages of the inbox now, read from the link.
+        """
+        os.link(self.path, path)
+        return FrozenInbox(path, self.start, self.size, self.count)
+
+    def __getitem__(self, index):
+        if index == 0:
+            if self.count == 0:
+                raise IndexError("inbox is empty")
+            if len(self.head) == 0:
+                self.fill_head()
+            return self.head[0]
+        return list(self)[index]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        # callers hold the inbox lock until they are done iterating
+        return read_messages(self.path, self.start, self.size)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"SegmentInbox({self.path!r}, {self.count} messages)"
+
+
+class FrozenInbox:
+    """
+    The messages a `SegmentInbox` held when it was linked, read from the
+    link without any lock.
+    """
+
+    def __init__(self, path, start, end, count):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return read_messages(self.path, self.start, self.end)
+
+
+class FrozenInboxes(dict):
+    """
+    username -> `FrozenInbox` mapping returned by `SegmentInboxes.freeze`.
+    `close` removes the links.
+    """
+
+    # directories of the copies of this process that are not closed yet
+    open_directories = set()
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        FrozenInboxes.open_directories.add(directory)
+
+    def __missing__(self, username):
+        return ()
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        FrozenInboxes.open_directories.discard(self.directory)
+
+
+class SegmentInboxes(dict):
+    """
+    username -> `SegmentInbox` mapping backed by one segment file per user
+    in `directory`, used in place of the in-memory defaultdict of lists.
+
+    The segments only spill the inboxes out of memory, the snapshot and the
+    write-ahead log remain the durable copy of the state, so the directory
+    is emptied when the mapping is created and the inboxes are rebuilt
+    from them. Callers hold the inbox lock, as for the plain dictionary.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(SEGMENT_SUFFIX) or name.endswith(SEGMENT_SUFFIX + ".tmp"):
+                os.remove(os.path.join(directory, name))
+
+    def segment_path(self, username):
+        # usernames are hex encoded to be safe as file names
+        return os.path.join(self.directory, username.encode("utf-8").hex() + SEGMENT_SUFFIX)
+
+    def __setitem__(self, username, messages):
+        dict.__setitem__(self, username, SegmentInbox(self.segment_path(username), messages))
+
+    def __missing__(self, username):
+        self[username] = []
+        return dict.__getitem__(self, username)
+
+    def pop(self, username, *default):
+        if username not in self:
+            return dict.pop(self, username, *default)
+        inbox = dict.pop(self, username)
+        messages = list(inbox)
+        inbox.remove()
+        return messages
+
+    def __delitem__(self, username):
+        self.pop(username)
+
+    def freeze(self):
+        """
+        Takes a consistent copy of every non-empty inbox without reading
+        them: each segment is hard linked into a directory of its own, with
+        the offsets of its undelivered messages. Callers hold the inbox
+        lock while freezing, not while reading the copy. Copies left by an
+        earlier process are removed.
+
+        Returns:
+            FrozenInboxes: The copy, to be closed once it has been read.
+        """
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(FROZEN_PREFIX) and path not in FrozenInboxes.open_directories:
+                shutil.rmtree(path, ignore_errors=True)
+        frozen = FrozenInboxes(tempfile.mkdtemp(prefix=FROZEN_PREFIX, dir=self.directory))
+        for username, inbox in self.items():
+            if len(inbox) > 0:
+                frozen[username] = inbox.link(
+                    os.path.join(frozen.directory, os.path.basename(inbox.path)))
+        return frozen
@@ -0,0 +1,156 @@
+import threading as th
+
+
+class LazyInboxes(dict):
+    """
+    username -> inbox mapping whose inboxes are read from an indexed
+    snapshot the first time they are touched.
+
+    Users in `pending` are part of the mapping but their inboxes are still
+    on disk. Lookups load them through `reader.read_inbox`, whole mapping
+    operations (iteration, items, len, ...) load everything first. Missing
+    users get an empty inbox, like the defaultdict it replaces. Callers hold
+    the inbox lock, as for the plain dictionary.
+    """
+
+    def __init__(self, reader, pending, *args):
+        super().__init__(*args)
+        self.reader = reader
+        self.pending = set(pending)
+        # a user is read from disk once even if the warm-up thread and a
+        # reader not holding the inbox lock ask for it at the same time
+        self.load_lock = th.Lock()
+        self.close_if_loaded()
+
+    def close_if_loaded(self):
+        if len(self.pending) == 0 and self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def load(self, username):
+        with self.load_lock:
+            if username not in self.pending:
+                return dict.__getitem__(self, username)
+            inbox = self.reader.read_inbox(username)
+            dict.__setitem__(self, username, inbox)
+            self.pending.discard(username)
+            self.close_if_loaded()
+            return inbox
+
+    def load_all(self):
+        for username in list(self.pending):
+            self.load(username)
+
+    def warm_up(self, lock, stop_event=None):
+        """
+        Loads the remaining inboxes one at a time, holding `lock` only for
+        one user so that request handlers are not held up.
+
+        Returns:
+            int: The number of inboxes loaded.
+        """
+        loaded = 0
+        while stop_event is None or not stop_event.is_set():
+            with lock:
+                if len(self.pending) == 0:
+                    break
+                self.load(next(iter(self.pending)))
+            loaded += 1
+        return loaded
+
+    def freeze(self):
+        """
+        Copies the mapping without loading the inboxes still on disk, which
+        the copy reads from the snapshot when they are looked up. Called
+        with the inbox lock held.
+
+        Returns:
+            FrozenLazyInboxes: The copy, to be closed once written.
+        """
+        with self.load_lock:
+            loaded = {username: list(inbox) for username, inbox in dict.items(self)}
+            reader = self.reader.fork(self.pending) if len(self.pending) > 0 else None
+            return FrozenLazyInboxes(reader, loaded)
+
+    def start_warm_up(self, lock):
+        thread = th.Thread(target=self.warm_up, args=(lock,), daemon=True)
+        thread.start()
+        return thread
+
+    def __missing__(self, username):
+        if username in self.pending:
+            return self.load(username)
+        inbox = []
+        dict.__setitem__(self, username, inbox)
+        return inbox
+
+    def __contains__(self, username):
+        return dict.__contains__(self, username) or username in self.pending
+
+    def __setitem__(self, username, inbox):
+        self.pending.discard(username)
+        dict.__setitem__(self, username, inbox)
+        self.close_if_loaded()
+
+    def __delitem__(self, username):
+        if username in self.pending:
+            self.pending.discard(username)
+            self.close_if_loaded()
+            return
+        dict.__delitem__(self, username)
+
+    def get(self, username, default=None):
+        if username in self:
+            return self[username]
+        return default
+
+    def pop(self, username, *default):
+        if username in self.pending:
+            self.load(username)
+        return dict.pop(self, username, *default)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.pending)
+
+    def __iter__(self):
+        self.load_all()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+    def copy(self):
+        self.load_all()
+        return dict(self)
+
+
+class FrozenLazyInboxes(dict):
+    """
+    username -> inbox mapping returned by `LazyInboxes.freeze`. Inboxes the
+    copy was taken without are read from the snapshot on lookup and not
+    kept, every inbox is looked up once when the copy is written. `close`
+    closes the snapshot.
+    """
+
+    def __init__(self, reader, *args):
+        super().__init__(*args)
+        self.reader = reader
+
+    def __missing__(self, username):
+        if self.reader is not None and username in self.reader.inbox_blocks:
+            return self.reader.read_inbox(username)
+        return []
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
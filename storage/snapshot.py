@@ -0,0 +1,537 @@
+import argparse
+import itertools
+import json
+import os
+import struct
+import zlib
+
+import chat_pb2
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+# streaming snapshot files start with this marker, followed by one zlib
+# stream of records. Each record is a 4 byte length, a 4 byte CRC32 of the
+# payload and the payload, a header record comes first and an end marker last.
+SNAPSHOT_MAGIC = b"CHATSNP1"
+# indexed snapshot files, see SnapshotWriter, end with the offset of their
+# index and the marker again
+INDEXED_SNAPSHOT_MAGIC = b"CHATSNP2"
+RECORD_HEADER = struct.Struct(">II")
+SNAPSHOT_FOOTER = struct.Struct(">Q8s")
+END_OF_SNAPSHOT = 0xFFFFFFFF
+READ_CHUNK_BYTES = 64 * 1024
+DEFAULT_COMPRESSION_LEVEL = 6
+# messages of an inbox encoded at a time while it is written to a snapshot
+INBOX_BATCH_MESSAGES = 1024
+
+
+class SnapshotError(ValueError):
+    """
+    Raised for snapshot files that are truncated or fail their checksums.
+    """
+
+
+def encode_state(user_metadata_store,
+                 token_hub,
+                 user_inbox,
+                 usernames=None,
+                 deleted=(),
+                 time=None,
+                 state_version=0,
+                 base_version=0,
+                 full=True,
+                 wal_seq=0,
+                 source=""):
+    """
+    Encodes server state as a `ServerStateBackupUpdate` protobuf.
+
+    Args:
+        user_metadata_store (dict): username -> (password, fullname).
+        token_hub (dict): username -> (token, timestamp).
+        user_inbox (dict): username -> list of undelivered messages.
+        usernames (iterable): The users to include, all of them if None.
+        deleted (iterable): Users deleted since `base_version`.
+        time (float): Time the state was taken.
+        state_version (int): State version the encoded state brings a reader to.
+        base_version (int): State version the delta starts from.
+        full (bool): True if the encoded users replace the whole state.
+        wal_seq (int): WAL sequence covered, for snapshots written to disk
+        and for resyncs.
+        source (str): Internal port of the primary resyncing a replica, empty
+        for any other state.
+
+    Returns:
+        bytes: The serialized message.
+    """
+    if usernames is None:
+        usernames = user_metadata_store.keys()
+    update = chat_pb2.ServerStateBackupUpdate(
+        version=SNAPSHOT_FORMAT_VERSION,
+        time=time or 0.0,
+        state_version=state_version,
+        base_version=base_version,
+        full=full,
+        wal_seq=wal_seq,
+        source=source,
+        deleted=deleted)
+    for username in usernames:
+        password, fullname = user_metadata_store[username]
+        token, timestamp = token_hub[username]
+        record = update.users.add(
+            username=username,
+            password=password,
+            fullname=fullname,
+            auth_token=token,
+            token_timestamp=timestamp)
+        record.inbox.extend(user_inbox[username])
+    return update.SerializeToString()
+
+
+def decode_state(raw_bytes):
+    """
+    Decodes a `ServerStateBackupUpdate` produced by `encode_state`.
+
+    Returns:
+        dict: The state with the keys time, state_version, base_version,
+        full, wal_seq, source, deleted and users, where users maps every username
+        to {"metadata": (password, fullname), "token": (token, timestamp),
+        "inbox": [messages]}.
+
+    Raises:
+        google.protobuf.message.DecodeError: If the bytes are not a valid message.
+    """
+    update = chat_pb2.ServerStateBackupUpdate.FromString(raw_bytes)
+    users = {}
+    for record in update.users:
+        users[record.username] = {
+            "metadata": (record.password, record.fullname),
+            "token": (record.auth_token, record.token_timestamp),
+            "inbox": list(record.inbox),
+            }
+    return {
+        "time": update.time,
+        "state_version": update.state_version,
+        "base_version": update.base_version,
+        "full": update.full,
+        "wal_seq": update.wal_seq,
+        "source": update.source,
+        "users": users,
+        "deleted": list(update.deleted),
+        }
+
+
+def is_json_state(raw_bytes):
+    """
+    Returns:
+        bool: True for state files written in the old JSON format.
+    """
+    return raw_bytes.lstrip()[:1] == b"{"
+
+
+def state_from_json(raw_bytes):
+    """
+    Decodes a state file in the old JSON format into the dictionary layout
+    returned by `decode_state`.
+    """
+    state = json.loads(raw_bytes)
+    users = {}
+    for username, (password, fullname) in state["user_metadata_store"].items():
+        token, timestamp = state["token_hub"][username]
+        users[username] = {
+            "metadata": (password, fullname),
+            "token": (token, timestamp),
+            "inbox": list(state["user_inbox"].get(username, [])),
+            }
+    return {
+        "time": state["time"] or 0.0,
+        "state_version": state.get("state_version", 0),
+        "base_version": 0,
+        "full": True,
+        "wal_seq": state.get("wal_seq", 0),
+        "users": users,
+        "deleted": [],
+        }
+
+
+def encode_decoded_state(state):
+    """
+    Re-encodes a dictionary returned by `decode_state` or `state_from_json`.
+    """
+    users = state["users"]
+    return encode_state(
+        {username: record["metadata"] for username, record in users.items()},
+        {username: record["token"] for username, record in users.items()},
+        {username: record["inbox"] for username, record in users.items()},
+        deleted=state["deleted"],
+        time=state["time"],
+        state_version=state["state_version"],
+        base_version=state["base_version"],
+        full=state["full"],
+        wal_seq=state["wal_seq"])
+
+
+class RecordStream:
+    """
+    Reads length and CRC32 framed records from a zlib stream starting at
+    the current position of `file`, keeping only one compressed chunk and
+    one decompressed window in memory.
+    """
+
+    def __init__(self, file, path):
+        self.file = file
+        self.path = path
+        self.decompressor = zlib.decompressobj()
+        self.buffer = bytearray()
+
+    def fill(self):
+        compressed = self.decompressor.unconsumed_tail
+        if len(compressed) == 0:
+            compressed = self.file.read(READ_CHUNK_BYTES)
+        if len(compressed) == 0:
+            raise SnapshotError(f"{self.path} is truncated")
+        try:
+            self.buffer += self.decompressor.decompress(compressed, READ_CHUNK_BYTES)
+        except zlib.error as e:
+            raise SnapshotError(f"{self.path} is corrupt: {e}")
+
+    def read_record(self):
+        """
+        Returns:
+            bytes: The next record payload, or None at the end marker.
+        """
+        while len(self.buffer) < RECORD_HEADER.size:
+            self.fill()
+        length, checksum = RECORD_HEADER.unpack_from(self.buffer)
+        if length == END_OF_SNAPSHOT:
+            return None
+        while len(self.buffer) < RECORD_HEADER.size + length:
+            self.fill()
+        payload = bytes(self.buffer[RECORD_HEADER.size:RECORD_HEADER.size + length])
+        del self.buffer[:RECORD_HEADER.size + length]
+        if zlib.crc32(payload) != checksum:
+            raise SnapshotError(f"{self.path} has a record failing its checksum")
+        return payload
+
+
+def frame_record(payload):
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+class SnapshotWriter:
+    """
+    Writes an indexed snapshot file one user at a time, so the encoded
+    state never has to exist in memory as a whole. The file is written next
+    to `path` and renamed over it by `close`.
+
+    Layout: the magic marker, a compressed header block, one compressed
+    block per non-empty inbox, then the index (a zlib stream of framed
+    `UserRecord`s holding the metadata, token and inbox block location of
+    every user) and a footer with the offset of the index. Blocks are framed
+    by their compressed length and the CRC32 of their uncompressed payload.
+    """
+
+    def __init__(self,
+                 path,
+                 time=None,
+                 state_version=0,
+                 wal_seq=0,
+                 compression_level=DEFAULT_COMPRESSION_LEVEL):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.file = open(self.tmp_path, "wb")
+        # CRC32 of everything written, recorded in the commit log
+        self.checksum = 0
+        self.write(INDEXED_SNAPSHOT_MAGIC)
+        self.offset = len(INDEXED_SNAPSHOT_MAGIC)
+        self.compression_level = compression_level
+        # the index is compressed as it grows, only its compressed bytes are kept
+        self.index_compressor = zlib.compressobj(compression_level)
+        self.index_chunks = []
+        self.users_written = 0
+        header = chat_pb2.ServerStateBackupUpdate(
+            version=SNAPSHOT_FORMAT_VERSION,
+            time=time or 0.0,
+            state_version=state_version,
+            full=True,
+            wal_seq=wal_seq)
+        self.write_block(header.SerializeToString())
+
+    def write(self, data):
+        self.file.write(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+
+    def write_block(self, payload):
+        compressed = zlib.compress(payload, self.compression_level)
+        block = RECORD_HEADER.pack(len(compressed), zlib.crc32(payload)) + compressed
+        self.write(block)
+        self.offset += len(block)
+        return len(block)
+
+    def write_inbox(self, username, inbox):
+        """
+        Writes the block of one inbox, encoding and compressing
+        INBOX_BATCH_MESSAGES messages at a time. Parsed protobuf messages
+        concatenate their repeated fields, so the batches still decode as
+        one `UserRecord`, and only the compressed block is held in memory.
+
+        Returns:
+            int: The length of the block, 0 if the inbox is empty and no
+            block was written.
+        """
+        compressor = zlib.compressobj(self.compression_level)
+        payload = chat_pb2.UserRecord(username=username).SerializeToString()
+        checksum = zlib.crc32(payload)
+        compressed = [compressor.compress(payload)]
+        messages = iter(inbox)
+        empty = True
+        while True:
+            batch = list(itertools.islice(messages, INBOX_BATCH_MESSAGES))
+            if len(batch) == 0:
+                break
+            empty = False
+            payload = chat_pb2.UserRecord(inbox=batch).SerializeToString()
+            checksum = zlib.crc32(payload, checksum)
+            compressed.append(compressor.compress(payload))
+        if empty:
+            return 0
+        compressed.append(compressor.flush())
+        self.write(RECORD_HEADER.pack(sum(len(chunk) for chunk in compressed), checksum))
+        for chunk in compressed:
+            self.write(chunk)
+        length = RECORD_HEADER.size + sum(len(chunk) for chunk in compressed)
+        self.offset += length
+        return length
+
+    def write_user(self, username, metadata, token, inbox):
+        """
+        Appends one user to the snapshot.
+
+        Args:
+            username (str): The username.
+            metadata (tuple): (password, fullname).
+            token (tuple): (token, timestamp).
+            inbox (iterable): Undelivered messages, read once.
+        """
+        password, fullname = metadata
+        auth_token, timestamp = token
+        entry = chat_pb2.UserRecord(
+            username=username,
+            password=password,
+            fullname=fullname,
+            auth_token=auth_token,
+            token_timestamp=timestamp)
+        offset = self.offset
+        length = self.write_inbox(username, inbox)
+        if length > 0:
+            entry.inbox_offset = offset
+            entry.inbox_length = length
+        self.index_chunks.append(
+            self.index_compressor.compress(frame_record(entry.SerializeToString())))
+        self.users_written += 1
+
+    def close(self):
+        """
+        Writes the index and footer, fsyncs the file and atomically replaces
+        the previous snapshot with it.
+        """
+        index_offset = self.offset
+        self.index_chunks.append(
+            self.index_compressor.compress(RECORD_HEADER.pack(END_OF_SNAPSHOT, 0)))
+        self.index_chunks.append(self.index_compressor.flush())
+        for chunk in self.index_chunks:
+            self.write(chunk)
+        self.write(SNAPSHOT_FOOTER.pack(index_offset, INDEXED_SNAPSHOT_MAGIC))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class SnapshotReader:
+    """
+    Reads a snapshot file written by `SnapshotWriter`, or a streaming
+    snapshot without an index, incrementally. Every record is checked
+    against its CRC32.
+
+    For indexed snapshots the inboxes can be left on disk and read one at a
+    time with `read_inbox` while the reader is open.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        magic = self.file.read(len(SNAPSHOT_MAGIC))
+        self.indexed = magic == INDEXED_SNAPSHOT_MAGIC
+        if self.indexed:
+            header = self.read_block(len(INDEXED_SNAPSHOT_MAGIC))
+            self.file.seek(-SNAPSHOT_FOOTER.size, os.SEEK_END)
+            index_offset, footer_magic = SNAPSHOT_FOOTER.unpack(self.file.read(SNAPSHOT_FOOTER.size))
+            if footer_magic != INDEXED_SNAPSHOT_MAGIC:
+                self.file.close()
+                raise SnapshotError(f"{path} is truncated")
+            self.file.seek(index_offset)
+        elif magic == SNAPSHOT_MAGIC:
+            header = None
+        else:
+            self.file.close()
+            raise SnapshotError(f"{path} is not a streaming snapshot")
+        self.records = RecordStream(self.file, path)
+        if header is None:
+            header = self.records.read_record()
+        header = chat_pb2.ServerStateBackupUpdate.FromString(header)
+        self.header = {
+            "time": header.time,
+            "state_version": header.state_version,
+            "wal_seq": header.wal_seq,
+            }
+        # username -> (offset, length) of the inbox blocks not read yet
+        self.inbox_blocks = {}
+
+    def read_block(self, offset, length=None):
+        # os.pread leaves the file position of the index stream alone
+        fd = self.file.fileno()
+        compressed_length, checksum = RECORD_HEADER.unpack(os.pread(fd, RECORD_HEADER.size, offset))
+        if length is not None and length != RECORD_HEADER.size + compressed_length:
+            raise SnapshotError(f"{self.path} has an index entry not matching its block")
+        compressed = os.pread(fd, compressed_length, offset + RECORD_HEADER.size)
+        try:
+            payload = zlib.decompress(compressed)
+        except zlib.error as e:
+            raise SnapshotError(f"{self.path} is corrupt: {e}")
+        if zlib.crc32(payload) != checksum:
+            raise SnapshotError(f"{self.path} has a block failing its checksum")
+        return payload
+
+    def users(self, lazy_inboxes=False):
+        """
+        Yields (username, (password, fullname), (token, timestamp), inbox)
+        for every user in the snapshot.
+
+        Args:
+            lazy_inboxes (bool): For indexed snapshots, yield None instead of
+            every non-empty inbox and leave it to `read_inbox`. The file is
+            then kept open.
+        """
+        try:
+            while True:
+                payload = self.records.read_record()
+                if payload is None:
+                    break
+                record = chat_pb2.UserRecord.FromString(payload)
+                inbox = list(record.inbox)
+                if record.inbox_length > 0:
+                    self.inbox_blocks[record.username] = (record.inbox_offset, record.inbox_length)
+                    inbox = None if lazy_inboxes else self.read_inbox(record.username)
+                yield (record.username,
+                       (record.password, record.fullname),
+                       (record.auth_token, record.token_timestamp),
+                       inbox)
+        finally:
+            if not lazy_inboxes or len(self.inbox_blocks) == 0:
+                self.close()
+
+    def read_inbox(self, username):
+        """
+        Reads the inbox of one user from its block.
+
+        Returns:
+            list: The undelivered messages of the user.
+        """
+        offset, length = self.inbox_blocks.pop(username)
+        return list(chat_pb2.UserRecord.FromString(self.read_block(offset, length)).inbox)
+
+    def fork(self, usernames):
+        """
+        Returns:
+            SnapshotReader: A reader of the inboxes of `usernames` still on
+            disk, through a file descriptor of its own, so it stays usable
+            once this reader is closed or the file is replaced.
+        """
+        forked = SnapshotReader.__new__(SnapshotReader)
+        forked.path = self.path
+        forked.file = os.fdopen(os.dup(self.file.fileno()), "rb")
+        forked.indexed = self.indexed
+        forked.records = None
+        forked.header = self.header
+        forked.inbox_blocks = {username: self.inbox_blocks[username] for username in usernames}
+        return forked
+
+    def close(self):
+        self.file.close()
+
+
+def decoded_state_users(state):
+    # Adapts a dictionary returned by decode_state to the SnapshotReader.users layout
+    for username, record in state["users"].items():
+        yield username, record["metadata"], record["token"], record["inbox"]
+
+
+def read_snapshot_file(path, lazy_inboxes=False):
+    """
+    Opens a state store file in any of the formats written so far: indexed
+    and streaming snapshots, single protobuf messages and the old JSON files.
+
+    Args:
+        path (str): The state file.
+        lazy_inboxes (bool): Leave non-empty inboxes of indexed snapshots on
+        disk, see `SnapshotReader.users`.
+
+    Returns:
+        (dict, iterator, SnapshotReader): The header with time,
+        state_version and wal_seq, an iterator over the users as yielded by
+        `SnapshotReader.users`, and the reader to load the left out inboxes
+        from, None for formats that are read whole.
+    """
+    with open(path, "rb") as state_file:
+        magic = state_file.read(len(SNAPSHOT_MAGIC))
+    if magic in (SNAPSHOT_MAGIC, INDEXED_SNAPSHOT_MAGIC):
+        reader = SnapshotReader(path)
+        return reader.header, reader.users(lazy_inboxes), reader
+    with open(path, "rb") as state_file:
+        raw_bytes = state_file.read()
+    if is_json_state(raw_bytes):
+        state = state_from_json(raw_bytes)
+    else:
+        state = decode_state(raw_bytes)
+    header = {key: state[key] for key in ("time", "state_version", "wal_seq")}
+    return header, decoded_state_users(state), None
+
+
+def convert_json_state_file(path, out_path=None):
+    """
+    Rewrites an older state store file (JSON, a single protobuf message or
+    a streaming snapshot without an index) as an indexed snapshot.
+
+    Args:
+        path (str): The state file.
+        out_path (str): Where to write the converted file, in place if None.
+
+    Returns:
+        bool: False if the file was already an indexed snapshot.
+    """
+    with open(path, "rb") as state_file:
+        if state_file.read(len(INDEXED_SNAPSHOT_MAGIC)) == INDEXED_SNAPSHOT_MAGIC:
+            return False
+    header, users, _ = read_snapshot_file(path)
+    writer = SnapshotWriter(out_path or path, **header)
+    for user in users:
+        writer.write_user(*user)
+    writer.close()
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='python -m storage.snapshot',
+        description='Converts older state store files to the indexed snapshot format')
+    parser.add_argument('paths', nargs='+', help='state store files to convert in place')
+    args = parser.parse_args()
+    for path in args.paths:
+        if convert_json_state_file(path):
+            print(f"Converted {path}")
+        else:
+            print(f"{path} is already an indexed snapshot")
@@ -0,0 +1,393 @@
+import json
+import os
+import queue
+import shutil
+import threading as th
+import time
+
+SEGMENT_PREFIX = "segment_"
+SEGMENT_SUFFIX = ".log"
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+
+# none: records reach the OS page cache, nothing is fsynced
+# async: every batch is fsynced but replies do not wait for it
+# fsync-per-batch: replies wait until the batch holding their record is fsynced
+DURABILITY_NONE = "none"
+DURABILITY_ASYNC = "async"
+DURABILITY_FSYNC = "fsync-per-batch"
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_ASYNC, DURABILITY_FSYNC)
+DEFAULT_DURABILITY = DURABILITY_FSYNC
+DEFAULT_BATCH_WINDOW = 0.0
+DEFAULT_QUEUE_SIZE = 10000
+
+
+class WriteAheadLog:
+    """
+    Append-only, segmented operation log for the chat server state.
+
+    Every mutation is written as a single JSON line of the form
+    {"seq": ..., "time": ..., "op": ..., "args": {...}}. Segment files are
+    named after the first sequence number they hold, and a new segment is
+    started once the active one grows past `segment_bytes`, so recovery can
+    skip whole segments that are already covered by a snapshot.
+
+    Appends only put the operation on a queue, so the caller never encodes,
+    touches the disk or waits. A dedicated writer thread group-commits
+    everything queued since its last pass with one write and (depending on
+    the durability mode) one fsync, then wakes the callers blocked in `sync`.
+    Once `queue_size` records are waiting, `sync` blocks until the writer
+    catches up, pushing back on the request handlers after they released
+    their locks rather than while they hold them.
+    A batch that cannot be written fails the `sync` of its records and of
+    every record appended after them. Those are not written either, replay
+    stops at the first gap and would drop them, so the log takes no more
+    records until the process restarts.
+    """
+
+    def __init__(self,
+                 directory,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 durability=DEFAULT_DURABILITY,
+                 batch_window=DEFAULT_BATCH_WINDOW,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.durability = durability
+        self.batch_window = batch_window
+
+        # serializes sequence assignment with the queue put so that the
+        # queue is always in sequence order
+        self.append_lock = th.Lock()
+        self.queue = queue.Queue()
+        self.queue_size = queue_size
+
+        # guards the positions below
+        self.lock = th.Lock()
+        self.batch_durable = th.Condition(self.lock)
+        self.last_seq = 0
+        # last sequence written to a segment file and last one made durable
+        self.written_seq = 0
+        self.durable_seq = 0
+        # error of the first batch that could not be written and its first
+        # sequence, the log holds no record from there on. Kept apart from
+        # the positions above, which only ever cover records on disk
+        self.write_error = None
+        self.failed_seq = None
+        # total bytes written by this process, used for size based checkpoints
+        self.appended_bytes = 0
+        # seconds between queueing and writing for the last batch
+        self.write_lag = 0.0
+        self.max_queue_depth = 0
+
+        # guards the segment files
+        self.write_lock = th.Lock()
+        self.active_file = None
+        self.active_size = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.recover_tail()
+        self.writer = th.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
+
+    def segment_path(self, first_seq):
+        return os.path.join(
+            self.directory, f"{SEGMENT_PREFIX}{first_seq:020d}{SEGMENT_SUFFIX}")
+
+    def segments(self):
+        """
+        Lists the segment files of the log in sequence order.
+
+        Returns:
+            list: (first_seq, path) pairs sorted by first_seq.
+        """
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                try:
+                    first_seq = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                except ValueError:
+                    continue
+                segments.append((first_seq, os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def read_segment(self, path):
+        """
+        Reads every intact record of a segment file.
+
+        Returns:
+            (list, int): The decoded records and the byte offset just past the
+            last intact record. A torn or corrupt line ends the segment.
+        """
+        records = []
+        good_offset = 0
+        with open(path, "rb") as segment:
+            for line in segment:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                records.append(record)
+                good_offset += len(line)
+        return records, good_offset
+
+    def recover_tail(self):
+        """
+        Finds the last sequence number on disk and cuts off a partially
+        written record at the end of the newest segment, so that new appends
+        never follow garbage.
+        """
+        segments = self.segments()
+        if len(segments) == 0:
+            return
+        first_seq, path = segments[-1]
+        records, good_offset = self.read_segment(path)
+        if good_offset < os.path.getsize(path):
+            print(f"Truncating torn WAL record in {path} at offset {good_offset}")
+            with open(path, "r+b") as segment:
+                segment.truncate(good_offset)
+        self.last_seq = records[-1]["seq"] if len(records) > 0 else first_seq - 1
+        self.written_seq = self.last_seq
+        self.durable_seq = self.last_seq
+
+    def close_active(self):
+        # Caller must hold write_lock
+        if self.active_file is not None:
+            self.active_file.flush()
+            if self.durability != DURABILITY_NONE:
+                os.fsync(self.active_file.fileno())
+            self.active_file.close()
+            self.active_file = None
+
+    def roll_segment(self, first_seq):
+        # Caller must hold write_lock
+        self.close_active()
+        self.active_file = open(self.segment_path(first_seq), "ab")
+        self.active_size = self.active_file.tell()
+
+    def write_batch(self, batch):
+        """
+        Encodes and writes a batch of queued operations with a single flush
+        and fsync. Segments are still rolled on record boundaries.
+        """
+        # encoded up front, a record that cannot be encoded fails the batch
+        # before any of it is written
+        lines = [(seq, (json.dumps(
+            {"seq": seq, "time": timestamp, "op": op, "args": args}) + "\n").encode("utf-8"))
+            for seq, timestamp, op, args, _ in batch]
+        written_bytes = 0
+        with self.write_lock:
+            for seq, line in lines:
+                if self.active_file is None or self.active_size >= self.segment_bytes:
+                    self.roll_segment(seq)
+                self.active_file.write(line)
+                self.active_size += len(line)
+                written_bytes += len(line)
+            self.active_file.flush()
+            if self.durability != DURABILITY_NONE:
+                os.fsync(self.active_file.fileno())
+            # published before write_lock is released so truncate never
+            # mistakes a freshly written segment for a covered one
+            with self.lock:
+                self.written_seq = batch[-1][0]
+                self.durable_seq = self.written_seq
+                self.appended_bytes += written_bytes
+                self.write_lag = time.time() - batch[0][4]
+                self.batch_durable.notify_all()
+
+    def fail_batch(self, batch, error):
+        """
+        Records that `batch` could not be written: the callers syncing on its
+        records, or on any later one, get the error of the first failed
+        batch. The active segment is closed, it may end in a torn record.
+        """
+        with self.write_lock:
+            try:
+                if self.active_file is not None:
+                    self.active_file.close()
+            except OSError:
+                pass
+            self.active_file = None
+            with self.lock:
+                if self.failed_seq is None:
+                    self.failed_seq = batch[0][0]
+                    self.write_error = error
+                self.batch_durable.notify_all()
+
+    def writer_loop(self):
+        closing = False
+        while not closing:
+            batch = [self.queue.get()]
+            if self.batch_window > 0 and batch[0] is not None:
+                # let concurrent writers join this batch
+                time.sleep(self.batch_window)
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                closing = True
+                batch = [item for item in batch if item is not None]
+            if len(batch) == 0:
+                continue
+            if self.failed_seq is not None:
+                # records after a failed batch would follow a gap
+                self.fail_batch(batch, self.write_error)
+                continue
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                # whatever went wrong, the writer must live on, callers
+                # blocked in sync would otherwise wait forever
+                print("WAL write failed:", e)
+                self.fail_batch(batch, e)
+
+    def append(self, op, args, timestamp):
+        """
+        Appends one operation record to the log.
+
+        Args:
+            op (str): The operation type.
+            args (dict): JSON-serializable operation arguments.
+            timestamp (float): Time the operation was applied.
+
+        Returns:
+            int: The sequence number assigned to the record. Pass it to
+            `sync` before acknowledging the operation.
+
+        Never blocks, the back-pressure of a full queue is applied by `sync`.
+        """
+        with self.append_lock:
+            seq = self.last_seq + 1
+            self.queue.put_nowait((seq, timestamp, op, args, time.time()))
+            with self.lock:
+                self.last_seq = seq
+                self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+            return seq
+
+    def stats(self):
+        """
+        Returns:
+            dict: Queue depth and how far the writer trails the appenders,
+            both in records and in seconds for the last written batch.
+        """
+        with self.lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "queue_size": self.queue_size,
+                "lag_records": self.last_seq - self.written_seq,
+                "lag_seconds": self.write_lag,
+                "last_seq": self.last_seq,
+                "durable_seq": self.durable_seq,
+                "failed_seq": self.failed_seq,
+            }
+
+    def sync(self, seq):
+        """
+        Blocks until the record `seq` is as durable as the durability mode
+        promises. Only the fsync-per-batch mode waits for the record itself,
+        the other modes only wait while more than `queue_size` records
+        before it are still queued.
+
+        Raises:
+            Exception: The error the first failed batch failed with, usually
+            an OSError, if the record is in or after that batch.
+        """
+        with self.lock:
+            while seq - self.written_seq > self.queue_size and self.failed_seq is None:
+                self.batch_durable.wait()
+            if self.durability == DURABILITY_FSYNC:
+                while self.durable_seq < seq and (self.failed_seq is None or seq < self.failed_seq):
+                    self.batch_durable.wait()
+            if self.failed_seq is not None and seq >= self.failed_seq:
+                raise self.write_error
+
+    def flush(self):
+        """
+        Blocks until everything appended so far has been written out,
+        whatever the durability mode, or until a batch failed.
+        """
+        with self.lock:
+            target = self.last_seq
+            while self.written_seq < target and self.failed_seq is None:
+                self.batch_durable.wait()
+
+    def advance_to(self, seq):
+        """
+        Moves the log position forward to `seq` without writing records, used
+        when a snapshot already covers operations the log no longer holds.
+        The next append starts a fresh segment at seq + 1.
+        """
+        with self.append_lock:
+            self.flush()
+            with self.write_lock:
+                with self.lock:
+                    if seq <= self.last_seq:
+                        return
+                    self.last_seq = seq
+                    self.written_seq = seq
+                    self.durable_seq = seq
+                self.close_active()
+
+    def replay(self, after_seq=0):
+        """
+        Yields the records with a sequence number greater than `after_seq`
+        in log order.
+        """
+        segments = self.segments()
+        for i, (first_seq, path) in enumerate(segments):
+            # the whole segment precedes after_seq if the next one starts at or before it
+            if i + 1 < len(segments) and segments[i + 1][0] <= after_seq + 1:
+                continue
+            records, _ = self.read_segment(path)
+            for record in records:
+                if record["seq"] > after_seq:
+                    yield record
+
+    def truncate(self, upto_seq, archive_dir=None):
+        """
+        Drops the segments whose records are all covered by a snapshot at
+        `upto_seq`. Segments are moved to `archive_dir` instead of being
+        deleted when it is given.
+
+        Returns:
+            int: The number of segments removed from the log directory.
+        """
+        with self.write_lock:
+            with self.lock:
+                written_seq = self.written_seq
+            if upto_seq >= written_seq:
+                # everything on disk is covered, the next batch starts a new segment
+                self.close_active()
+            segments = self.segments()
+            removable = []
+            for i, (first_seq, path) in enumerate(segments):
+                if i + 1 < len(segments):
+                    covered = segments[i + 1][0] <= upto_seq + 1
+                else:
+                    covered = self.active_file is None and written_seq <= upto_seq
+                if covered:
+                    removable.append(path)
+            if archive_dir is not None:
+                os.makedirs(archive_dir, exist_ok=True)
+            for path in removable:
+                if archive_dir is not None:
+                    shutil.move(path, os.path.join(archive_dir, os.path.basename(path)))
+                else:
+                    os.remove(path)
+            return len(removable)
+
+    def close(self):
+        """
+        Writes out the queued records and stops the writer thread.
+        """
+        with self.append_lock:
+            self.queue.put(None)
+        self.writer.join()
+        with self.write_lock:
+            self.close_active()